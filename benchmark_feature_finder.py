@@ -0,0 +1,425 @@
+# Benchmarks for the feature finder
+#
+# Writes synthetic gene and region files at one or more sizes, times
+# stream_find_features, then create_gene_list, create_region_list,
+# sort_intervals and find_features on them separately, and saves the timings
+# and memory peaks as JSON so runs from different releases can be compared.
+# Sizes above --max-load-size are only streamed, as the lists would not fit
+# in memory. With --workers, find_features_parallel is also timed with each
+# number of worker processes, to show how the join scales.
+#
+# Memory is measured as the process's peak RSS, which only ever grows: a
+# phase's peak_rss_kb is the most used by it or any phase before it, and its
+# peak_growth_kb is how far it pushed that peak up. Streaming runs first so
+# its peak is its own.
+#
+# Usage:
+#     python benchmark_feature_finder.py --sizes 1000,100000 -o results.json
+#     python benchmark_feature_finder.py --compare old.json results.json
+
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+from feature_finder import (create_gene_list, create_region_list,
+                            find_features, find_features_parallel,
+                            sort_intervals,
+                            stream_find_features, FeatureIndex,
+                            DEFAULT_RUN_SIZE)
+
+
+# hg19 chromosome lengths, used to spread the synthetic intervals around
+CHROM_SIZES = [
+    ('chr1', 249250621), ('chr2', 243199373), ('chr3', 198022430),
+    ('chr4', 191154276), ('chr5', 180915260), ('chr6', 171115067),
+    ('chr7', 159138663), ('chr8', 146364022), ('chr9', 141213431),
+    ('chr10', 135534747), ('chr11', 135006516), ('chr12', 133851895),
+    ('chr13', 115169878), ('chr14', 107349540), ('chr15', 102531392),
+    ('chr16', 90354753), ('chr17', 81195210), ('chr18', 78077248),
+    ('chr19', 59128983), ('chr20', 63025520), ('chr21', 48129895),
+    ('chr22', 51304566), ('chrX', 155270560), ('chrY', 59373566),
+]
+
+GENE_HEADER = ('#hg19.refGene.chrom\thg19.refGene.strand\t'
+               'hg19.refGene.txStart\thg19.refGene.txEnd\t'
+               'hg19.refGene.exonCount\thg19.refGene.exonStarts\t'
+               'hg19.refGene.exonEnds\thg19.kgXref.geneSymbol\t'
+               'hg19.kgXref.refseq\n')
+
+REGION_HEADER = ('browser position chr1:26339-26399\n'
+                 'track name="synthetic"\n'
+                 '#Chromosome\tStartPosition\tEndPosition\tRegionName\t'
+                 'Score\tnProbes\n')
+
+# The steps timed, in the order they run
+PHASES = ('stream_find_features', 'create_gene_list', 'create_region_list',
+          'sort_intervals', 'index', 'find_features')
+
+# The steps that hold every gene and region in memory, skipped for sizes
+# above max_load_size
+LOAD_PHASES = PHASES[1:]
+
+MAX_LOAD_SIZE = 1000000
+
+# Genes sit in clusters (gene-dense bands); about this many genes per
+# cluster, spread around its centre with this standard deviation
+GENES_PER_CLUSTER = 40
+CLUSTER_SPREAD = 500000
+
+
+def _cluster_centres(rand, count):
+    """Returns count (chrom, position) pairs, spread over the genome in
+    proportion to chromosome length
+
+    """
+
+    total = sum(size for chrom, size in CHROM_SIZES)
+    centres = []
+    for i in xrange(count):
+        offset = rand.randint(0, total - 1)
+        for chrom, size in CHROM_SIZES:
+            if offset < size:
+                centres.append((chrom, offset))
+                break
+            offset -= size
+    return centres
+
+
+def _position_near(rand, centres):
+    """Returns (chrom, position) near a random cluster centre"""
+
+    chrom, centre = rand.choice(centres)
+    size = dict(CHROM_SIZES)[chrom]
+    position = int(rand.gauss(centre, CLUSTER_SPREAD))
+    return chrom, min(max(position, 0), size - 1)
+
+
+def write_gene_file(filename, count, rand):
+    """
+    Writes a refGene-like file of count transcripts, in no particular order:
+    lognormal transcript lengths (median about 20 kb), a geometric number of
+    exons (mean about 8) at random places inside the transcript, both
+    strands, clustered along the genome.
+    Returns the cluster centres so regions can be put near the same genes.
+
+    """
+
+    centres = _cluster_centres(rand, max(1, count // GENES_PER_CLUSTER))
+
+    with open(filename, 'w') as fp:
+        fp.write(GENE_HEADER)
+        for i in xrange(count):
+            chrom, tx_start = _position_near(rand, centres)
+            length = max(200, int(rand.lognormvariate(math.log(20000), 1.0)))
+            tx_end = tx_start + length
+
+            exon_count = min(int(rand.expovariate(1 / 8.0)) + 1,
+                             max(1, length // 100))
+            # Exon boundaries: first exon at txStart, last one at txEnd
+            inner = sorted(rand.sample(xrange(tx_start + 1, tx_end - 1),
+                                       2 * (exon_count - 1)))
+            bounds = [tx_start] + inner + [tx_end]
+            exon_starts = bounds[0::2]
+            exon_ends = bounds[1::2]
+
+            symbol = 'SYN{}'.format(i)
+            fp.write('\t'.join([
+                chrom, rand.choice('+-'), str(tx_start), str(tx_end),
+                str(exon_count),
+                ''.join(str(s) + ',' for s in exon_starts),
+                ''.join(str(e) + ',' for e in exon_ends),
+                symbol + ',', 'NM_{:06d},'.format(i)]) + '\n')
+
+    return centres
+
+
+def write_region_file(filename, count, rand, centres=None):
+    """
+    Writes a region file like region_file: mostly single 60 bp probes with
+    some multi-probe regions up to a few kb. Half of them are near the gene
+    clusters in centres (if given), the rest are anywhere.
+
+    """
+
+    if centres is None:
+        centres = _cluster_centres(rand, max(1, count // GENES_PER_CLUSTER))
+    anywhere = _cluster_centres(rand, max(1, count // 10))
+
+    with open(filename, 'w') as fp:
+        fp.write(REGION_HEADER)
+        for i in xrange(count):
+            chrom, start = _position_near(rand,
+                                          rand.choice([centres, anywhere]))
+            probes = 1 if rand.random() < 0.7 else rand.randint(2, 40)
+            end = start + 60 * probes
+            score = rand.gauss(0, 4)
+            fp.write('{}\t{}\t{}\tregion_{}\t{:.4f}\t{}\n'.format(
+                chrom, start, end, i, score, probes))
+
+
+def _peak_rss_kb():
+    """Returns the most memory this process has used so far, in kB"""
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024  # Reported in bytes there
+    return peak
+
+
+def _timed(results, name, function, *args, **kwargs):
+    """Runs function, recording its time, the memory peak after it and how
+    much it raised that peak
+
+    """
+
+    peak_before = _peak_rss_kb()
+    started = time.time()
+    value = function(*args, **kwargs)
+    seconds = time.time() - started
+    peak = _peak_rss_kb()
+    results[name] = {'seconds': seconds, 'peak_rss_kb': peak,
+                     'peak_growth_kb': peak - peak_before}
+    return value
+
+
+def _stream_hits(region_filename, gene_filename, run_size, tmp_dir):
+    """Runs stream_find_features to the end, keeping only the hit count"""
+
+    return sum(len(features) for region, features in stream_find_features(
+        region_filename, gene_filename, run_size, tmp_dir))
+
+
+def run_benchmark(size, work_dir, seed=0, region_ratio=0.5,
+                  max_load_size=MAX_LOAD_SIZE, run_size=DEFAULT_RUN_SIZE,
+                  workers=()):
+    """
+    Writes a synthetic gene file of size transcripts and a region file of
+    size * region_ratio regions into work_dir, then times each step. Returns
+    a dict of results.
+
+    The files are streamed through stream_find_features, holding run_size
+    intervals at a time, and then, unless size is more than max_load_size,
+    loaded and searched in memory. find_features_parallel is then timed
+    with each number of processes in workers; the results are under
+    "parallel", with each one's speedup over find_features.
+
+    """
+
+    rand = random.Random(seed)
+    gene_filename = os.path.join(work_dir, 'genes_{}'.format(size))
+    region_filename = os.path.join(work_dir, 'regions_{}'.format(size))
+    region_count = max(1, int(size * region_ratio))
+
+    started = time.time()
+    centres = write_gene_file(gene_filename, size, rand)
+    write_region_file(region_filename, region_count, rand, centres)
+    generate_seconds = time.time() - started
+
+    phases = {}
+    parallel = {}
+    hits = _timed(phases, 'stream_find_features', _stream_hits,
+                  region_filename, gene_filename, run_size, work_dir)
+
+    if size <= max_load_size:
+        # The loaders are told not to sort, so sorting is timed on its own
+        genes = _timed(phases, 'create_gene_list', create_gene_list,
+                       gene_filename, presorted=True)
+        regions = _timed(phases, 'create_region_list', create_region_list,
+                         region_filename, presorted=True)
+        _timed(phases, 'sort_intervals', sort_intervals, genes)
+        sort_intervals(regions)
+        index = _timed(phases, 'index', FeatureIndex, genes)
+        found = _timed(phases, 'find_features', find_features, regions,
+                       index)
+        hits = sum(len(features) for features in found.itervalues())
+        del found
+
+        serial_seconds = phases['find_features']['seconds']
+        for count in workers:
+            timing = {}
+            _timed(timing, 'join', find_features_parallel, regions, index,
+                   workers=count)
+            seconds = timing['join']['seconds']
+            parallel[str(count)] = {
+                'seconds': seconds,
+                'speedup': serial_seconds / seconds if seconds else 0.0}
+
+    return {
+        'size': size,
+        'genes': size,
+        'regions': region_count,
+        'hits': hits,
+        'generate_seconds': generate_seconds,
+        'phases': phases,
+        'parallel': parallel,
+    }
+
+
+def _child_main(connection, args):
+    """Runs in the child process: sends back (results, None), or (None, the
+    traceback) if the benchmark failed
+
+    """
+
+    try:
+        connection.send((run_benchmark(*args), None))
+    except Exception:
+        connection.send((None, traceback.format_exc()))
+    finally:
+        connection.close()
+
+
+def _run_in_child(args):
+    """Runs one benchmark in a child process, so memory peaks don't carry
+    over from one size to the next. It isn't a pool worker (those are
+    daemons), so it can start the pools find_features_parallel uses.
+
+    """
+
+    receiver, sender = multiprocessing.Pipe(False)
+    child = multiprocessing.Process(target=_child_main, args=(sender, args))
+    child.start()
+    sender.close()
+    try:
+        run, error = receiver.recv()
+    except EOFError:
+        run, error = None, 'the benchmark process died'
+    finally:
+        child.join()
+    if error is not None:
+        raise RuntimeError('Benchmark of size {} failed: {}'.format(
+            args[0], error))
+    return run
+
+
+def _environment():
+    """Returns what is needed to tell where a set of results came from"""
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        revision = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=here,
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'revision': revision,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def compare(old_results, new_results, out=sys.stdout):
+    """Prints new/old time ratios for each size and phase both runs have"""
+
+    old_runs = dict((run['size'], run) for run in old_results['runs'])
+    for run in new_results['runs']:
+        old = old_runs.get(run['size'])
+        if old is None:
+            continue
+        for phase in PHASES:
+            if phase not in old['phases'] or phase not in run['phases']:
+                continue
+            old_seconds = old['phases'][phase]['seconds']
+            new_seconds = run['phases'][phase]['seconds']
+            ratio = new_seconds / old_seconds if old_seconds else float('inf')
+            out.write('{:>10} {:<20} {:9.3f} s -> {:9.3f} s  x{:.2f}\n'.format(
+                run['size'], phase, old_seconds, new_seconds, ratio))
+        old_parallel = old.get('parallel', {})
+        for count in sorted(run.get('parallel', {}), key=int):
+            if count not in old_parallel:
+                continue
+            old_seconds = old_parallel[count]['seconds']
+            new_seconds = run['parallel'][count]['seconds']
+            ratio = new_seconds / old_seconds if old_seconds else float('inf')
+            out.write('{:>10} {:<20} {:9.3f} s -> {:9.3f} s  x{:.2f}\n'.format(
+                run['size'], 'parallel x' + count, old_seconds, new_seconds,
+                ratio))
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+        description='Time the feature finder on synthetic inputs.')
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='comma separated transcript counts '
+                             '(default %(default)s)')
+    parser.add_argument('--region-ratio', type=float, default=0.5,
+                        help='regions per transcript (default %(default)s)')
+    parser.add_argument('--max-load-size', type=int, default=MAX_LOAD_SIZE,
+                        help='only stream sizes above this, without loading '
+                             'them into memory (default %(default)s)')
+    parser.add_argument('--workers', default='',
+                        help='comma separated process counts to time '
+                             'find_features_parallel with, e.g. 1,2,4,8')
+    parser.add_argument('--run-size', type=int, default=DEFAULT_RUN_SIZE,
+                        help='intervals held at once when streaming '
+                             '(default %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir',
+                        help='keep the synthetic files here instead of in a '
+                             'temporary directory')
+    parser.add_argument('-o', '--output',
+                        help='write the results here as JSON')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two result files and exit')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as old, open(args.compare[1]) as new:
+            compare(json.load(old), json.load(new))
+        return
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    workers = [int(count) for count in args.workers.split(',') if count]
+
+    work_dir = args.work_dir or tempfile.mkdtemp()
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+
+    try:
+        runs = []
+        for size in sizes:
+            run = _run_in_child((size, work_dir, args.seed, args.region_ratio,
+                                 args.max_load_size, args.run_size, workers))
+            runs.append(run)
+            for phase in PHASES:
+                if phase not in run['phases']:
+                    continue
+                print '{:>10} {:<20} {:9.3f} s {:10d} kB (+{} kB)'.format(
+                    size, phase, run['phases'][phase]['seconds'],
+                    run['phases'][phase]['peak_rss_kb'],
+                    run['phases'][phase]['peak_growth_kb'])
+            for count in workers:
+                if str(count) not in run['parallel']:
+                    continue
+                timing = run['parallel'][str(count)]
+                print '{:>10} {:<20} {:9.3f} s  x{:.2f} speedup'.format(
+                    size, 'parallel x{}'.format(count), timing['seconds'],
+                    timing['speedup'])
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir)
+
+    results = {'environment': _environment(), 'runs': runs}
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,8 +5,223 @@
 # Last Updated: April 11, 2013
 
 
-from operator import attrgetter
-from collections import defaultdict
+import argparse
+import cPickle as pickle
+import csv
+import errno
+import gc
+import glob
+import gzip
+import hashlib
+import json
+import logging
+import marshal
+import mmap
+import multiprocessing
+import os
+import Queue
+import random
+import re
+import socket
+import SocketServer
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+from heapq import heapify, heappop, heapreplace, merge
+from itertools import chain, compress, count, imap, islice, izip, repeat
+from multiprocessing.pool import ThreadPool
+from operator import (add, and_, attrgetter, ge, gt, itemgetter, le, lt,
+                      mul, sub)
+
+try:
+    import numpy
+except ImportError:  # The batch pair functions fall back to array
+    numpy = None
+
+
+# Chromosomes
+#
+# Every interval carries a chrom_id, a small int the chromosome dictionary
+# gives its chromosome, so comparing chromosomes compares ints. Ids are
+# handed out in the order names are first seen; the order chromosomes sort
+# in is kept separately, as ranks[chrom_id]. New names are ranked when
+# ranks is next read, all at once, and the list is updated in place. Ids
+# never change, so an id stays valid while ranks grow, but a rank is only
+# comparable with ranks read at the same time, and a list of ranks held on
+# to must be read through ranks again after new names may have arrived.
+
+# Names that mean the same chromosome as "chr" + name
+_BARE_CHROMS = set(str(n) for n in range(1, 100)) | set(['X', 'Y'])
+_MITO_NAMES = ('M', 'MT', 'chrMT')
+
+# Where the sex chromosomes and mitochondria go in natural order, after the
+# numbered chromosomes
+_NATURAL_TAILS = {'X': 0, 'Y': 1, 'M': 2}
+
+_DIGITS = re.compile(r'(\d+)')
+
+
+def natural_chrom_key(name):
+    """Returns a key sorting chromosome names the way biologists expect:
+    chr1, chr2, ..., chr10, ..., chrX, chrY, chrM, then anything else
+    (unplaced contigs, other assemblies) with the numbers in them compared
+    as numbers
+
+    """
+
+    base = name[3:] if name.startswith('chr') else name
+    if base.isdigit():
+        return (0, int(base), ())
+    if base in _NATURAL_TAILS:
+        return (1, _NATURAL_TAILS[base], ())
+    return (2, 0, tuple(int(part) if part.isdigit() else part
+                        for part in _DIGITS.split(name)))
+
+
+class ChromosomeDictionary(object):
+    """
+    Interns chromosome names as ints and orders them
+
+    Names are first made canonical: aliases (a dict of name: canonical name)
+    are applied, then bare names get the UCSC "chr" prefix (1 -> chr1) and
+    the mitochondrion is called chrM. Chromosomes named in karyotype (a list)
+    sort in that order, ahead of the rest, which sort by natural_chrom_key,
+    or as plain strings if natural is False.
+
+    """
+
+    def __init__(self, karyotype=(), aliases=None, natural=True):
+
+        self.aliases = dict(aliases or {})
+        self.natural = natural
+
+        self.names = []  # chrom_id -> canonical name
+        self._ranks = []  # chrom_id -> position in sorted order
+        self._ids = {}  # any name seen, canonical or not -> chrom_id
+        self._order_keys = {}  # canonical name -> order_key
+        # (order_key, chrom_id) of the ranked names, sorted, and the names
+        # given ids since
+        self._order = []
+        self._unranked = []
+        # Held while a name is given an id or new names are ranked, so
+        # threads can make intervals at once
+        self._lock = threading.Lock()
+
+        self._karyotype = {}
+        for position, name in enumerate(karyotype):
+            self._karyotype[self.canonical(name)] = position
+
+    def canonical(self, name):
+        """Returns the canonical form of the chromosome name"""
+
+        chrom_id = self._ids.get(name)
+        if chrom_id is not None:
+            return self.names[chrom_id]
+
+        name = self.aliases.get(name, name)
+        if name in _MITO_NAMES:
+            return 'chrM'
+        if name in _BARE_CHROMS:
+            return 'chr' + name
+        return name
+
+    def order_key(self, name):
+        """Returns a key for name that sorts in this dictionary's order and,
+        unlike a rank, never changes
+
+        """
+
+        name = self.canonical(name)
+        key = self._order_keys.get(name)
+        if key is None:
+            position = self._karyotype.get(name, len(self._karyotype))
+            if self.natural:
+                key = (position, natural_chrom_key(name))
+            else:
+                key = (position, name)
+            self._order_keys[name] = key
+        return key
+
+    def chrom_id(self, name):
+        """Returns the id of the chromosome name, giving it one if it is new"""
+
+        chrom_id = self._ids.get(name)
+        if chrom_id is not None:
+            return chrom_id
+
+        canonical = self.canonical(name)
+        with self._lock:
+            chrom_id = self._ids.get(canonical)
+            if chrom_id is None:
+                chrom_id = len(self.names)
+                self.names.append(canonical)
+                # Ranked properly when ranks is next read
+                self._ranks.append(chrom_id)
+                self._unranked.append(chrom_id)
+                self._ids[canonical] = chrom_id
+            self._ids[name] = chrom_id
+        return chrom_id
+
+    @property
+    def ranks(self):
+        """chrom_id -> position in sorted order, as a list that is updated
+        in place
+
+        """
+
+        if self._unranked:
+            with self._lock:
+                self._rank_new_names()
+        return self._ranks
+
+    def _rank_new_names(self):
+
+        order = self._order
+        first = len(order)
+        for chrom_id in self._unranked:
+            item = (self.order_key(self.names[chrom_id]), chrom_id)
+            position = bisect_left(order, item)
+            order.insert(position, item)
+            first = min(first, position)
+        self._unranked = []
+
+        # Only the names from the first one inserted on move
+        ranks = self._ranks
+        for rank in xrange(first, len(order)):
+            ranks[order[rank][1]] = rank
+
+    def rank(self, name):
+        """Returns the position of name in sorted order right now"""
+
+        return self.ranks[self.chrom_id(name)]
+
+    def __len__(self):
+        return len(self.names)
+
+
+# The dictionary every Interval is made with
+chromosomes = ChromosomeDictionary()
+
+
+def set_chromosomes(dictionary):
+    """
+    Makes dictionary (a ChromosomeDictionary) the one intervals are made
+    with, e.g. to sort in a karyotype's order. Intervals already made keep
+    ids from the old one, so call this before loading anything.
+
+    """
+
+    global chromosomes
+    chromosomes = dictionary
+
 
 # Class structure:
 #
@@ -15,28 +230,45 @@ from collections import defaultdict
 #                   ----------
 #           ((chrom, left, right, name))
 #                       |
-#                  -----------
-#                  |          |
-#              --------   ---------
-#              |Region|   |Feature|
-#              --------   ---------
+#                  ---------------------------
+#                  |          |              |
+#              --------   ---------   ---------------
+#              |Region|   |Feature|   |RegionCluster|
+#              --------   ---------   ---------------
 #                             |
-#                       --------------
-#                       |            |
-#                     ------
-#                     |Gene|
-#                     ------
+#                       ---------------------------
+#                       |            |            |
+#                     ------      ------   --------------
+#                     |Gene|      |Exon|   |TrackFeature|
+#                     ------      ------   --------------
+#                       |                         |
+#                   ----------                    |
+#                   |LazyGene|                    |
+#                   ----------                    |
+#                                        ---------------------
+#                                        |                   |
+#                                   -----------   -------------------
+#                                   |CpGIsland|   |RegulatoryElement|
+#                                   -----------   -------------------
 
 
 class Interval(object):
 
     def __init__(self, chrom, left, right, name):
 
-        self.chrom = chrom
+        chrom_id = chromosomes.chrom_id(chrom)
+        self.chrom = chromosomes.names[chrom_id]
+        self.chrom_id = chrom_id
         self.left = left
         self.right = right
         self.name = name
 
+    def __setstate__(self, state):
+
+        # Ids are only good in the process that gave them out
+        self.__dict__.update(state)
+        self.chrom_id = chromosomes.chrom_id(self.chrom)
+
     def __str__(self):
         return "{} {} @ {} ({},{})".format(type(self).__name__, self.name,
                                             self.chrom, self.left, self.right)
@@ -47,7 +279,8 @@ class Interval(object):
 
 class Region(Interval):
 
-    def __init__(self, Chromosome, StartPosition, EndPosition, RegionName):
+    def __init__(self, Chromosome, StartPosition, EndPosition, RegionName,
+                 extras=None):
 
         # superclass fields
         super(Region, self).__init__(Chromosome, int(StartPosition),
@@ -59,6 +292,9 @@ class Region(Interval):
         self.EndPosition = EndPosition
         self.RegionName = RegionName
 
+        # any other columns asked for (e.g. {'Score': '1.5'}), or None
+        self.extras = extras
+
 
 class Feature(Interval):
 
@@ -94,287 +330,4933 @@ class Gene(Feature):
             self.positive_strand = True
         else:
             self.positive_strand = False
-        self.exons = zip([int(s) for s in exonStarts.rstrip(',').split(',')],
-                         [int(e) for e in exonEnds.rstrip(',').split(',')])
+        self.exons = zip(map(int, exonStarts.rstrip(',').split(',')),
+                         map(int, exonEnds.rstrip(',').split(',')))
 
 
-def sort_intervals(intervals_list):
-    """Sort first by chrom (a str), then by left (an int), then by right
-    (an int)
+# Where a LazyGene's fields are in its line, shared by all the genes from one
+# file, and whether decoded fields are kept
+_LazyGeneLayout = namedtuple('_LazyGeneLayout', 'positions cache')
+
+
+class _LazyField(object):
+    """A LazyGene field, decoded from the line when it is read. If the
+    layout says to cache, the value is stored on the gene, where it hides
+    this for later reads.
 
     """
 
-    intervals_list.sort(key=attrgetter('chrom', 'left', 'right'))
+    def __init__(self, decode):
 
-def create_gene_list(gene_fp):
+        self.decode = decode
+        self.name = decode.__name__
+        self.__doc__ = decode.__doc__
+
+    def __get__(self, gene, owner):
+
+        if gene is None:
+            return self
+        value = self.decode(gene)
+        if gene._layout.cache:
+            gene.__dict__[self.name] = value
+        return value
+
+
+class LazyGene(Gene):
     """
-    Creates and returns a sorted list of Genes from the file with the given
-    filename.
+    A Gene that keeps its line from the gene file and only decodes the
+    fields a run uses. chrom, left, right and name are set up front; the
+    rest (strand, exons, refseq, ...) are decoded when first read.
 
     """
 
-    newfile = False
-    # Try to read from gene_file. If we can't, assume it's something we can
-    # use to open a file.
-    if not hasattr(gene_fp, 'read'):
-        newfile = True
-        gene_fp = file(gene_fp, 'r')
+    def __init__(self, chrom, left, right, name, line, layout):
 
-    header = gene_fp.readline()
-    if not header.startswith('#'):
-        print 'ERROR: No header on gene file. Wrong file type?'
-        print 'First line beginning with "#" expected'
-        exit(1)
+        # Not Gene.__init__, which decodes every field
+        Feature.__init__(self, chrom, left, right, name)
 
-    header = header.lstrip('#')  # Remove any leading #
-    header = header.strip()  # Remove surrounding white space
-    # Create a list of the header entries
-    header_entries = header.split('\t')
-    # Get the string after the last "." ("hg19.refGene.strand" -> "strand")
-    # We don't care about version info
-    header_entries = [h.split('.')[-1] for h in header_entries]
-    ###print header_entries
+        self._line = line
+        self._layout = layout
 
-    # This list will hold all the Gene objects
-    genes = []
+    def _field(self, column):
 
-    # This loop starts at the next line of the file after the header
-    for index, line in enumerate(gene_fp):
+        return self._line.split('\t')[self._layout.positions[column]]
 
-        ###print index
+    @_LazyField
+    def strand(self):
+        return self._field('strand')
 
-        line = line.strip() # Remove surrounding white space
-        # Create a list of the line entries
-        line_entries = line.split('\t')
+    @_LazyField
+    def positive_strand(self):
+        return self.strand == '+'
 
-        # Get the item in the list of line entries that matches certain fields
-        # Note that this technique allows the columns in the file to be in
-        # any order as long as they have the expected names
-        chrom = line_entries[header_entries.index('chrom')]
-        strand = line_entries[header_entries.index('strand')]
-        txStart = line_entries[header_entries.index('txStart')]
-        txEnd = line_entries[header_entries.index('txEnd')]
-        exonCount = line_entries[header_entries.index('exonCount')]
-        exonStarts = line_entries[header_entries.index('exonStarts')]
-        exonEnds = line_entries[header_entries.index('exonEnds')]
-        geneSymbol = line_entries[header_entries.index('geneSymbol')]
-        refSeq = line_entries[header_entries.index('refseq')]
-
-        # Make a Gene object
-        gene = Gene(chrom, strand, txStart, txEnd,
-                    exonCount, exonStarts, exonEnds,
-                    geneSymbol, refSeq)
-
-        # Add it to the end of the list
-        genes.append(gene)
-
-    # If we opened a new file, clean it up.
-    if newfile:
-        gene_fp.close()
-
-    sort_intervals(genes)
+    @_LazyField
+    def txStart(self):
+        return self._field('txStart')
 
-    return genes
+    @_LazyField
+    def txEnd(self):
+        return self._field('txEnd')
 
+    @_LazyField
+    def exonCount(self):
+        return self._field('exonCount')
 
-def create_region_list(region_fp):
-    """
-    Creates and returns a sorted list of Regions from the file with the given
-    filename
+    @_LazyField
+    def exonStarts(self):
+        return self._field('exonStarts')
 
-    """
-    newfile = False
-    # Try to read from gene_file. If we can't, assume it's something we can
-    # use to open a file.
-    if not hasattr(region_fp, 'read'):
-        newfile = True
-        region_fp = open(region_fp, 'r')
+    @_LazyField
+    def exonEnds(self):
+        return self._field('exonEnds')
 
-    # Advance until line starting with "#" is read
-    header = region_fp.readline()
-    while not header.startswith('#'):
-        header = region_fp.readline()
-        # If we're at the end of the file, something is wrong
-        if header == '':
-            print 'ERROR: No header on region file. Wrong file type?'
-            print 'Line beginning with "#" expected before data'
-            exit(1)
+    @_LazyField
+    def geneSymbol(self):
+        return self.name
 
-    header = header.lstrip('#')  # Remove any leading #
-    header = header.strip()  # Remove surrounding white space
-    # Create a list of the header entries
-    header_entries = header.split('\t')
+    @_LazyField
+    def refseq(self):
+        return self._field('refseq').rstrip(',')
 
-    #This list will hold all the Region objects
-    regions = []
+    @_LazyField
+    def exons(self):
+        return zip(map(int, self.exonStarts.rstrip(',').split(',')),
+                   map(int, self.exonEnds.rstrip(',').split(',')))
 
-    for index, line in enumerate(region_fp):
 
-        line = line.strip()
-        line_entries = line.split('\t')
+class Exon(Feature):
 
-        Chromosome = line_entries[header_entries.index('Chromosome')]
-        StartPosition = line_entries[header_entries.index('StartPosition')]
-        EndPosition = line_entries[header_entries.index('EndPosition')]
-        RegionName = line_entries[header_entries.index('RegionName')]
+    def __init__(self, gene, number, left, right):
 
-        region = Region(Chromosome, StartPosition, EndPosition, RegionName)
+        # superclass fields
+        super(Exon, self).__init__(gene.chrom, left, right,
+                                   '{} exon {}'.format(gene.name, number))
 
-        regions.append(region)
+        # the Gene this is an exon of, and its number in the direction of
+        # transcription (exon 1 is at txEnd on the - strand)
+        self.gene = gene
+        self.number = number
 
-    if newfile:
-        region_fp.close()
 
-    sort_intervals(regions)
+class TrackFeature(Feature):
 
-    return regions
+    def __init__(self, chrom, left, right, name, score=None, strand=None):
 
-def print_comp(feature, region):
+        # superclass fields
+        super(TrackFeature, self).__init__(chrom, left, right, name)
+
+        # optional BED fields (None if the track doesn't have them)
+        self.score = score
+        self.strand = strand
 
+        # calculated fields
+        self.positive_strand = strand != '-'
+
+
+class CpGIsland(TrackFeature):
     pass
-    #print 'Feat: ', feature.chrom, '(', feature.left, ',', feature.right, ')'
-    #print 'Reg:  ', region.chrom, '(', region.left, ',', region.right, ')'
 
 
-def overlaps(feature, region):
-    """Returns True if the feature overlaps the region"""
+class RegulatoryElement(TrackFeature):
+    pass
 
-    ###print 'In overlaps...'
-    print_comp(feature, region)
 
-    return (region.chrom == feature.chrom and
-            min(region.right, feature.right)
-            - max(region.left, feature.left) > 0)
+# Tables store whole collections of Regions or Genes as columns (arrays of
+# ints and lists of shared strings) instead of one object per interval.
+# Indexing a table returns a view, which has the same fields as the Region
+# or Gene it stands in for but holds nothing except (table, row).
 
 
-def before(feature, region):
-    """Returns True if the feature is completely before the region
+class _IntervalView(object):
 
-    If the end of the feature is before the beginning of the region,
-    returns True"""
+    __slots__ = ('_table', '_row')
 
-    ###print 'In before...'
-    ###print_comp(feature, region)
+    def __init__(self, table, row):
 
-    if feature.chrom < region.chrom:
-        return True
-    elif feature.chrom > region.chrom:
-        return False
-    else: # They are on the same chromosome
-        return feature.right < region.left
+        self._table = table
+        self._row = row
 
+    @property
+    def chrom(self):
+        table = self._table
+        return table.chrom_names[table.chroms[self._row]]
 
-def after(feature, region):
-    """Returns True if the feature is completely after the region
+    @property
+    def chrom_id(self):
+        return chromosomes.chrom_id(self.chrom)
 
-    If the beginning of the feature is after the end of the region,
-    returns True"""
+    @property
+    def left(self):
+        return self._table.lefts[self._row]
 
-    ###print 'In after...'
-    ###print_comp(feature, region)
+    @property
+    def right(self):
+        return self._table.rights[self._row]
 
-    if feature.chrom > region.chrom:
-        return True
-    elif feature.chrom < region.chrom:
-        return False
-    else: # They are on the same chromosome
-        return feature.left > region.right
+    @property
+    def name(self):
+        return self._table.names[self._row]
 
+    def __eq__(self, other):
+        return (type(other) is type(self) and other._table is self._table
+                and other._row == self._row)
 
-def get_overlap(region, feature):
-    """ Returns the number of bases that the Region and the Feature overlap """
+    def __ne__(self, other):
+        return not self == other
 
-    if region.chrom != feature.chrom:
-        return 0
+    def __hash__(self):
+        return hash((id(self._table), self._row))
 
-    return max(0, min(region.right, feature.right)
-                     - max(region.left, feature.left) + 1)
+    def __str__(self):
+        return "{} {} @ {} ({},{})".format(type(self).__name__, self.name,
+                                            self.chrom, self.left, self.right)
 
+    def __repr__(self):
+        return self.__str__()
 
-def get_amount_before(feature, region):
-    """ Returns the number of bases the the Feature is before the region """
 
-    return -1
+class RegionView(_IntervalView):
 
+    __slots__ = ()
 
-def get_amount_after(feature, region):
-    """ Returns the number of bases the the Feature is after the region """
+    # fields directly from file
+    Chromosome = _IntervalView.chrom
+    RegionName = _IntervalView.name
 
-    return -1
+    @property
+    def StartPosition(self):
+        return str(self.left)
 
+    @property
+    def EndPosition(self):
+        return str(self.right)
 
-def print_overlap_info(feature, region):
-    """
-    Prints an intelligable message about how the Feature and the Region overlap
+    @property
+    def extras(self):
+        table = self._table
+        if not table.extras:
+            return None
+        return dict((name, column[self._row])
+                    for name, column in table.extras.iteritems())
+
+
+class GeneView(_IntervalView):
+
+    __slots__ = ()
+
+    # fields directly from file
+    geneSymbol = _IntervalView.name
+
+    @property
+    def strand(self):
+        return '+' if self._table.strands[self._row] else '-'
+
+    @property
+    def positive_strand(self):
+        return bool(self._table.strands[self._row])
+
+    @property
+    def txStart(self):
+        return str(self.left)
+
+    @property
+    def txEnd(self):
+        return str(self.right)
+
+    @property
+    def refseq(self):
+        return self._table.refseqs[self._row]
+
+    @property
+    def exonCount(self):
+        offsets = self._table.exon_offsets
+        return str(offsets[self._row + 1] - offsets[self._row])
+
+    @property
+    def exonStarts(self):
+        return ''.join(str(s) + ',' for s, e in self.exons)
+
+    @property
+    def exonEnds(self):
+        return ''.join(str(e) + ',' for s, e in self.exons)
+
+    @property
+    def exons(self):
+        table = self._table
+        first = table.exon_offsets[self._row]
+        last = table.exon_offsets[self._row + 1]
+        return zip(table.exon_starts[first:last], table.exon_ends[first:last])
+
+
+class IntervalTable(object):
+    """Stores a collection of intervals as columns
+
+    chroms holds a small code per row, which chrom_names turns back into the
+    chromosome name. lefts and rights are array('l') columns, and repeated
+    strings (names, refseqs) are shared between rows.
 
     """
 
-    print "{} overlaps {} by {} base pairs".format(region.name,
-                                                   feature.name,
-                                                   get_overlap(region,
-                                                               feature))
+    view_class = _IntervalView
 
-def find_features(region_list, gene_list=None):
-    """Returns a list of the features found"""
+    # The per-row columns, which sort() has to put in the new order
+    columns = ('chroms', 'lefts', 'rights', 'names')
 
-    found = {region : [] for region in region_list}
+    def __init__(self):
 
-    if gene_list is None:
+        self.chrom_names = []
+        self._chrom_codes = {}
+        self._strings = {}
 
-        #print "No gene list given"
-        return
+        self.chroms = array('I')
+        self.lefts = array('l')
+        self.rights = array('l')
+        self.names = []
 
-    gene_index = 0
+    def _intern(self, string):
+        """Returns the copy of string the table already holds, if any"""
 
-    # For each region
-    for region_index in xrange(len(region_list)):
+        return self._strings.setdefault(string, string)
 
-        cur_region = region_list[region_index]
-        print 'cur_region:', cur_region.name
-        cur_gene = gene_list[gene_index]
-        print 'cur_gene:', cur_gene.name
+    def _chrom_code(self, chrom):
+        """Returns the code for chrom, giving it the next one if it is new"""
 
-        # Advance features until feature overlaps or is after current region
-        while ((gene_index < len(gene_list)) and
-               before(cur_gene, cur_region)):
-            print 'skipping:', cur_gene.name
-            gene_index += 1
-            if gene_index >= len(gene_list):
-                break
-            else:
-                cur_gene = gene_list[gene_index]
+        code = self._chrom_codes.get(chrom)
+        if code is None:
+            # Aliases of one chromosome share its code
+            canonical = chromosomes.canonical(chrom)
+            code = self._chrom_codes.get(canonical)
+            if code is None:
+                code = self._chrom_codes[canonical] = len(self.chrom_names)
+                self.chrom_names.append(canonical)
+            self._chrom_codes[chrom] = code
+        return code
+
+    def _append_interval(self, chrom, left, right, name):
+
+        self.chroms.append(self._chrom_code(chrom))
+        self.lefts.append(left)
+        self.rights.append(right)
+        self.names.append(self._intern(name))
+
+    def __len__(self):
+        return len(self.lefts)
+
+    def __getitem__(self, row):
+
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError('table row out of range')
+        return self.view_class(self, row)
+
+    def __iter__(self):
+
+        view_class = self.view_class
+        for row in xrange(len(self)):
+            yield view_class(self, row)
+
+    def chrom_ranges(self):
+        """Yields (chrom, first row, last row + 1) for each run of rows on the
+        same chromosome. In a sorted table there is one run per chromosome.
+
+        """
+
+        chroms = self.chroms
+        first = 0
+        while first < len(chroms):
+            code = chroms[first]
+            last = first + 1
+            while last < len(chroms) and chroms[last] == code:
+                last += 1
+            yield self.chrom_names[code], first, last
+            first = last
+
+    def sort(self):
+        """Sort the rows first by chrom, then by left, then by right, like
+        sort_intervals, and return how as sort_intervals does
+
+        """
 
-        # Advance features and add them to that regions' entry in the dict
-        while overlaps(cur_gene, cur_region):
+        # Same order as interval_key
+        # Give every name an id before reading ranks, which new ids change
+        ids = [chromosomes.chrom_id(name) for name in self.chrom_names]
+        ranks = [chromosomes.ranks[i] for i in ids]
+        how, order = _sort_order(zip([ranks[code] for code in self.chroms],
+                                     self.lefts, self.rights))
+        if order is not None:
+            self._reorder(order)
+        return how
 
-            print 'adding:', cur_gene.name
-            print_overlap_info(cur_region, cur_gene)
-            found[cur_region].append(cur_gene)
+    def _reorder(self, order):
 
-            if cur_gene.right > cur_region.right:  # Don't move ahead when gene
-                break                              # may overlap next region
+        for column_name in self.columns:
+            column = getattr(self, column_name)
+            if isinstance(column, array):
+                column = array(column.typecode, (column[i] for i in order))
             else:
-                gene_index += 1
-                if gene_index >= len(gene_list):
-                    gene_index -= 1
-                    break
-                else:
-                    cur_gene = gene_list[gene_index]
+                column = [column[i] for i in order]
+            setattr(self, column_name, column)
 
 
-    return found
+class _TableRows(object):
+    """Rows first up to (not including) last of a table, as a read-only
+    sequence of views made only when they are asked for
+
+    """
+
+    def __init__(self, table, first, last):
+
+        self._table = table
+        self._first = first
+        self._last = last
+
+    def __len__(self):
+        return self._last - self._first
+
+    def __getitem__(self, i):
+
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('table row out of range')
+        return self._table.view_class(self._table, self._first + i)
+
+    def __iter__(self):
+
+        table = self._table
+        view_class = table.view_class
+        for row in xrange(self._first, self._last):
+            yield view_class(table, row)
+
+
+class RegionTable(IntervalTable):
+    """An IntervalTable of Regions. Rows come back as RegionViews."""
+
+    view_class = RegionView
+
+    def __init__(self, extra_columns=()):
+
+        super(RegionTable, self).__init__()
+
+        # One list per extra region file column kept (see Region.extras)
+        self.extras = dict((name, []) for name in extra_columns)
+
+    def append(self, Chromosome, StartPosition, EndPosition, RegionName,
+               extras=None):
+        """Adds a row, taking the same arguments as Region()"""
+
+        self._append_interval(Chromosome, int(StartPosition),
+                              int(EndPosition), RegionName)
+        for name, column in self.extras.iteritems():
+            column.append(self._intern(extras[name]) if extras else None)
+
+    @classmethod
+    def from_regions(cls, region_list, extra_columns=()):
+        """Returns a table holding the given Regions, in the same order"""
+
+        table = cls(extra_columns)
+        for region in region_list:
+            table.append(region.chrom, region.left, region.right,
+                         region.name, region.extras)
+        return table
+
+    def _reorder(self, order):
+
+        super(RegionTable, self)._reorder(order)
+
+        for name, column in self.extras.items():
+            self.extras[name] = [column[i] for i in order]
+
+
+class GeneTable(IntervalTable):
+    """An IntervalTable of Genes. Rows come back as GeneViews.
+
+    The exons of all genes share two array('l') columns; the exons of row i
+    are at exon_offsets[i] up to (but not including) exon_offsets[i + 1].
+
+    """
+
+    view_class = GeneView
+
+    columns = IntervalTable.columns + ('strands', 'refseqs')
+
+    def __init__(self):
+
+        super(GeneTable, self).__init__()
+
+        self.strands = array('b')
+        self.refseqs = []
+        self.exon_offsets = array('L', [0])
+        self.exon_starts = array('l')
+        self.exon_ends = array('l')
+
+    def append(self, chrom, strand, txStart, txEnd,
+               exonCount, exonStarts, exonEnds,
+               geneSymbol, refseq):
+        """Adds a row, taking the same arguments as Gene()"""
+
+        self._append_interval(chrom, int(txStart), int(txEnd),
+                              geneSymbol.rstrip(','))
+        self.strands.append(strand == '+')
+        self.refseqs.append(self._intern(refseq.rstrip(',')))
+
+        self.exon_starts.extend(int(s)
+                                for s in exonStarts.rstrip(',').split(','))
+        self.exon_ends.extend(int(e) for e in exonEnds.rstrip(',').split(','))
+        self.exon_offsets.append(len(self.exon_starts))
+
+    @classmethod
+    def from_genes(cls, gene_list):
+        """Returns a table holding the given Genes, in the same order"""
+
+        table = cls()
+        for gene in gene_list:
+            table.append(gene.chrom, gene.strand, gene.txStart, gene.txEnd,
+                         gene.exonCount, gene.exonStarts, gene.exonEnds,
+                         gene.geneSymbol, gene.refseq)
+        return table
+
+    def _reorder(self, order):
+
+        super(GeneTable, self)._reorder(order)
+
+        offsets = self.exon_offsets
+        starts = array('l')
+        ends = array('l')
+        new_offsets = array('L', [0])
+        for i in order:
+            starts.extend(self.exon_starts[offsets[i]:offsets[i + 1]])
+            ends.extend(self.exon_ends[offsets[i]:offsets[i + 1]])
+            new_offsets.append(len(starts))
+        self.exon_starts = starts
+        self.exon_ends = ends
+        self.exon_offsets = new_offsets
+
+
+def interval_key(interval):
+    """Returns the key of the order every sorted list, table and stream of
+    intervals is in: by chromosome (in chromosomes order), then left, then
+    right
+
+    """
+
+    return (chromosomes.ranks[interval.chrom_id], interval.left,
+            interval.right)
+
+
+# How sort_intervals and the table sorts put things in order: they were
+# in order already, they were a few sorted runs (e.g. per-chromosome files
+# one after another) that were merged, or they needed a full sort
+SORT_PRESORTED = 'presorted'
+SORT_MERGED = 'merged'
+SORT_FULL = 'full'
+
+# Input in more sorted runs than this gets a full sort
+MAX_MERGE_RUNS = 64
+
+# A merge is given up for a full sort once it has taken this many pieces
+# per key, as finely interleaved runs are merged faster by list.sort
+_MERGE_PIECES_PER_KEY = 1 / 16.0
+
+
+def _merge_runs(keys, starts):
+    """
+    Returns the positions of keys in sorted order, where keys is made of
+    sorted runs beginning at the given starts, or None if the runs are too
+    finely interleaved to be worth merging. A k-way merge on a heap of the
+    runs, which takes as much of the leading run as comes before every
+    other run's head at once, so runs that hardly overlap cost a few
+    bisects each. Equal keys keep their input order.
+
+    """
+
+    ends = starts[1:] + [len(keys)]
+    heap = [(keys[start], run, start, end)
+            for run, (start, end) in enumerate(izip(starts, ends))]
+    heapify(heap)
+
+    order = []
+    pieces_left = int(len(keys) * _MERGE_PIECES_PER_KEY) + len(starts)
+    while len(heap) > 1:
+        pieces_left -= 1
+        if not pieces_left:
+            return None
+        key, run, start, end = heap[0]
+        # The next smallest head is one of the root's children
+        head = heap[1] if len(heap) == 2 else min(heap[1], heap[2])
+        if run < head[1]:
+            stop = bisect_right(keys, head[0], start, end)
+        else:
+            stop = bisect_left(keys, head[0], start, end)
+        order.extend(xrange(start, stop))
+        if stop == end:
+            heappop(heap)
+        else:
+            heapreplace(heap, (keys[stop], run, stop, end))
+
+    if heap:
+        key, run, start, end = heap[0]
+        order.extend(xrange(start, end))
+    return order
+
+
+def _sort_order(keys):
+    """
+    Returns (how, order) for putting keys in order: SORT_PRESORTED and None
+    if they already are, else SORT_MERGED or SORT_FULL and the positions of
+    the keys in sorted order
+
+    """
+
+    # Where each sorted run after the first begins, found in one pass
+    starts = list(compress(count(1), imap(gt, keys, islice(keys, 1, None))))
+    if not starts:
+        return SORT_PRESORTED, None
+    if len(starts) < MAX_MERGE_RUNS:
+        order = _merge_runs(keys, [0] + starts)
+        if order is not None:
+            return SORT_MERGED, order
+    return SORT_FULL, sorted(xrange(len(keys)), key=keys.__getitem__)
+
+
+def sort_intervals(intervals_list):
+    """Sort first by chrom (in chromosomes order: chr2 before chr10), then
+    by left (an int), then by right (an int)
+
+    Lists that are in order already are left alone, and lists made of a few
+    sorted runs are merged. Returns SORT_PRESORTED, SORT_MERGED or
+    SORT_FULL to say which happened.
+
+    """
+
+    ranks = chromosomes.ranks
+    how, order = _sort_order([(ranks[i.chrom_id], i.left, i.right)
+                              for i in intervals_list])
+    if order is not None:
+        intervals_list[:] = map(intervals_list.__getitem__, order)
+    return how
+
+
+class ParseStats(object):
+    """Counts the rows a parser produced and the time it took
+
+    The time runs from the first read to the last row, so for a lazy parser
+    it includes the time the caller spent between rows. The create_*
+    functions also set sort to how the rows were put in order
+    (SORT_PRESORTED, SORT_MERGED or SORT_FULL), unless told they were
+    presorted.
+
+    """
+
+    def __init__(self):
+
+        self.rows = 0
+        self.seconds = 0.0
+        self.sort = None
+
+    @property
+    def rows_per_sec(self):
+
+        if self.seconds <= 0:
+            return 0.0
+        return self.rows / self.seconds
+
+    def __str__(self):
+        return "{} rows in {:.3f} s ({:.0f} rows/sec)".format(
+            self.rows, self.seconds, self.rows_per_sec)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class Sink(object):
+    """Receives what an Instrumentation measures
+
+    Subclasses override the methods they care about. phase() is called each
+    time a phase ends and report() when the Instrumentation's report() is.
+
+    """
+
+    def phase(self, name, seconds):
+        pass
+
+    def report(self, counters, timers):
+        pass
+
+
+class PrintSink(Sink):
+    """Prints phase times and reports to a file (standard error if None)"""
+
+    def __init__(self, fp=None):
+
+        self.fp = fp
+
+    def _print(self, line):
+
+        fp = self.fp if self.fp is not None else sys.stderr
+        fp.write(line + '\n')
+
+    def phase(self, name, seconds):
+
+        self._print('{}: {:.3f} s'.format(name, seconds))
+
+    def report(self, counters, timers):
+
+        for name in sorted(timers):
+            self._print('{} total: {:.3f} s'.format(name, timers[name]))
+        for name in sorted(counters):
+            self._print('{}: {}'.format(name, counters[name]))
+
+
+class _PhaseList(Sink):
+    """Keeps the (name, seconds) of each phase, to be sent elsewhere"""
+
+    def __init__(self):
+
+        self.phases = []
+
+    def phase(self, name, seconds):
+
+        self.phases.append((name, seconds))
+
+
+class LoggingSink(Sink):
+    """Sends phase times and reports to a logging.Logger"""
+
+    def __init__(self, logger=None, level=logging.INFO):
+
+        if logger is None:
+            logger = logging.getLogger('feature_finder')
+        self.logger = logger
+        self.level = level
+
+    def phase(self, name, seconds):
+
+        self.logger.log(self.level, '%s: %.3f s', name, seconds)
+
+    def report(self, counters, timers):
+
+        self.logger.log(self.level, 'timers: %s counters: %s',
+                        ', '.join('{}={:.3f}s'.format(name, timers[name])
+                                  for name in sorted(timers)),
+                        ', '.join('{}={}'.format(name, counters[name])
+                                  for name in sorted(counters)))
+
+
+class Instrumentation(object):
+    """Counts events and times the phases of a run
+
+    The functions that take an instrumentation argument count things like
+    "comparisons", "skips" and "hits" and time phases like "parse", "sort",
+    "join" and "output". Counts are only kept here until report() hands
+    them to the sinks; phase times go to the sinks as each phase ends.
+
+    """
+
+    def __init__(self, sinks=()):
+
+        self.counters = defaultdict(int)
+        self.timers = defaultdict(float)
+        self.sinks = list(sinks)
+
+    def count(self, name, n=1):
+
+        self.counters[name] += n
+
+    @contextmanager
+    def phase(self, name):
+        """Times the code in a with block as the phase with the given name"""
+
+        started = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - started
+            self.timers[name] += seconds
+            for sink in self.sinks:
+                sink.phase(name, seconds)
+
+    def merge(self, counters, phases):
+        """Adds counts and (name, seconds) phase times measured elsewhere,
+        e.g. in a worker process, as though they had been measured here
+
+        """
+
+        for name, n in counters.iteritems():
+            self.counters[name] += n
+        for name, seconds in phases:
+            self.timers[name] += seconds
+            for sink in self.sinks:
+                sink.phase(name, seconds)
+
+    def report(self):
+        """Hands the counters and total phase times to every sink"""
+
+        for sink in self.sinks:
+            sink.report(dict(self.counters), dict(self.timers))
+
+
+class _NoInstrumentation(Instrumentation):
+    """Stands in when no Instrumentation is given, measuring nothing"""
+
+    def count(self, name, n=1):
+        pass
+
+    @contextmanager
+    def phase(self, name):
+        yield
+
+    def merge(self, counters, phases):
+        pass
+
+    def report(self):
+        pass
+
+
+NO_INSTRUMENTATION = _NoInstrumentation()
+
+
+def _column_positions(header_entries, wanted, file_type):
+    """Returns the positions of the wanted columns in the header entries"""
+
+    positions = []
+    for column in wanted:
+        if column not in header_entries:
+            print 'ERROR: No "{}" column in {} file header'.format(column,
+                                                                   file_type)
+            exit(1)
+        positions.append(header_entries.index(column))
+
+    return positions
+
+
+def _column_getter(header_entries, wanted, file_type):
+    """
+    Returns a function that picks the wanted columns (in that order) out of
+    a list of line entries, looking up their positions only once.
+
+    """
+
+    return itemgetter(*_column_positions(header_entries, wanted, file_type))
+
+
+def _parse_lines(lines, get_fields, stats):
+    """
+    Yields the tuple of fields get_fields picks out of each non-blank line,
+    filling in stats as it goes.
+
+    """
+
+    rows = 0
+    started = time.time()
+    try:
+        for line in lines:
+
+            line = line.strip() # Remove surrounding white space
+            if not line:
+                continue
+
+            yield get_fields(line.split('\t'))
+            rows += 1
+
+    finally:
+        if stats is not None:
+            stats.rows += rows
+            stats.seconds += time.time() - started
+
+
+# Compressed input
+#
+# Gene, region and track files may be gzipped. Plain gzip is one deflate
+# stream, so it can only be inflated in order. BGZF (bgzip's format, used
+# by tabix and samtools) is a series of gzip members of at most 64 kB each,
+# so blocks are inflated in batches by a pool of threads; zlib releases the
+# GIL while it works.
+
+_GZIP_MAGIC = '\x1f\x8b'
+_READ_SIZE = 1 << 20
+
+# BGZF blocks handed to each thread per batch
+_BGZF_BATCH = 16
+
+
+def _is_bgzf(header):
+    """Returns True if header, the first 18 bytes of a file, starts a BGZF
+    block: a gzip member with a "BC" extra subfield
+
+    """
+
+    return (len(header) == 18 and header.startswith(_GZIP_MAGIC)
+            and ord(header[3]) & 4 and header[12:14] == 'BC')
+
+
+def _gzip_chunks(raw):
+    """Yields the decompressed data of the gzip file raw, in order. Handles
+    files of several members (BGZF, or files cat'ed together).
+
+    """
+
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        for data in iter(lambda: raw.read(_READ_SIZE), ''):
+            while data:
+                chunk = decompressor.decompress(data)
+                if chunk:
+                    yield chunk
+                # Anything left over belongs to the next member
+                data = decompressor.unused_data
+                if data:
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        # The last member must have got to the end of its trailer. A byte
+        # fed to a finished decompressor is left over; one fed to a
+        # decompressor that still wants data is taken in.
+        probe = decompressor.copy()
+        probe.decompress('\0')
+        finished = probe.unused_data == '\0'
+    except zlib.error as error:
+        raise IOError('Corrupt gzip data: {}'.format(error))
+    if not finished:
+        raise IOError('Truncated gzip file: ended part way through a '
+                      'member')
+
+
+def _read_exactly(raw, size):
+    """Reads size bytes from raw, raising IOError if the file ends first"""
+
+    data = raw.read(size)
+    if len(data) < size:
+        raise IOError('Truncated BGZF file: ended part way through a block')
+    return data
+
+
+def _bgzf_blocks(raw):
+    """Yields (deflated data, crc, size) for each BGZF block of raw. Raises
+    IOError if the file is cut short, including before the empty block
+    that marks its end.
+
+    """
+
+    size = None  # Of the last block inflated; the end of file block's is 0
+    while True:
+        header = raw.read(12)
+        if not header:
+            if size != 0:
+                raise IOError('Truncated BGZF file: no end of file block')
+            return
+        if not header.startswith(_GZIP_MAGIC[:len(header)]):
+            raise IOError('Not a BGZF block at byte {}'.format(
+                raw.tell() - len(header)))
+        if len(header) < 12:
+            raise IOError('Truncated BGZF file: ended part way through a '
+                          'block')
+        extra_len, = struct.unpack('<H', header[10:12])
+        extra = _read_exactly(raw, extra_len)
+
+        # Find the BC subfield, which holds the block size less one
+        block_size = None
+        i = 0
+        while i + 4 <= len(extra):
+            sub_len, = struct.unpack('<H', extra[i + 2:i + 4])
+            if extra[i:i + 2] == 'BC' and sub_len == 2 and i + 6 <= len(extra):
+                block_size, = struct.unpack('<H', extra[i + 4:i + 6])
+            i += 4 + sub_len
+        if block_size is None or block_size < extra_len + 19:
+            raise IOError('BGZF block without a valid block size')
+
+        data = _read_exactly(raw, block_size - extra_len - 19)
+        crc, size = struct.unpack('<Ii', _read_exactly(raw, 8))
+        yield data, crc, size
+
+
+def _inflate_block(block):
+
+    data, crc, size = block
+    try:
+        inflated = zlib.decompress(data, -zlib.MAX_WBITS)
+    except zlib.error as error:
+        raise IOError('Corrupt BGZF block: {}'.format(error))
+    if len(inflated) != size or zlib.crc32(inflated) & 0xffffffff != crc:
+        raise IOError('BGZF block fails its CRC check')
+    return inflated
+
+
+def _bgzf_chunks(raw, threads):
+    """Yields the decompressed data of the BGZF file raw, in order, with
+    threads inflating one batch of blocks while the last is being read
+
+    """
+
+    pool = ThreadPool(threads)
+    try:
+        blocks = _bgzf_blocks(raw)
+        batch_size = threads * _BGZF_BATCH
+        pending = pool.map_async(_inflate_block,
+                                 list(islice(blocks, batch_size)))
+        while pending is not None:
+            batch = list(islice(blocks, batch_size))
+            following = None
+            if batch:
+                following = pool.map_async(_inflate_block, batch)
+            yield ''.join(pending.get())
+            pending = following
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class _DecompressedFile(object):
+    """A read-only text file over an iterator of decompressed chunks,
+    supporting what the parsers use: readline() and iteration
+
+    """
+
+    def __init__(self, raw, chunks):
+
+        self._raw = raw
+        self._chunks = chunks
+        self._lines = []
+        self._pos = 0
+        self._partial = ''
+
+    def _fill(self):
+        """Splits more chunks into lines. Returns False at the end."""
+
+        while self._pos >= len(self._lines):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                if not self._partial:
+                    return False
+                self._lines, self._partial = [self._partial], ''
+            else:
+                parts = (self._partial + chunk).split('\n')
+                self._partial = parts.pop()
+                self._lines = [part + '\n' for part in parts]
+            self._pos = 0
+        return True
+
+    def readline(self):
+
+        if not self._fill():
+            return ''
+        self._pos += 1
+        return self._lines[self._pos - 1]
+
+    def read(self):
+
+        data = ''.join(self._lines[self._pos:]) + self._partial
+        data += ''.join(self._chunks)
+        self._lines, self._pos, self._partial = [], 0, ''
+        return data
+
+    def __iter__(self):
+
+        # _pos moves with each line, so a loop that stops early (as the
+        # header readers do) leaves the rest for the next one
+        while self._fill():
+            lines = self._lines
+            while self._pos < len(lines):
+                self._pos += 1
+                yield lines[self._pos - 1]
+
+    def close(self):
+
+        self._chunks.close()
+        if self._raw is not None:
+            self._raw.close()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc_info):
+
+        self.close()
+
+
+def open_input(filename, threads=None):
+    """
+    Opens the gene, region or track file filename for reading, inflating
+    it on the fly if it is gzipped. BGZF files are inflated by threads
+    threads (one per CPU if None).
+
+    """
+
+    raw = open(filename, 'rb')
+    chunks = _inflated_chunks(raw, threads)
+    if chunks is None:
+        raw.close()
+        return open(filename, 'r')
+    return _DecompressedFile(raw, chunks)
+
+
+def _inflated_chunks(raw, threads=None):
+    """Returns an iterator of the decompressed data of raw, an open binary
+    file, or None if it isn't gzipped. threads works as in open_input.
+
+    """
+
+    header = raw.read(18)
+    raw.seek(0)
+
+    if not header.startswith(_GZIP_MAGIC):
+        return None
+
+    if threads is None:
+        threads = multiprocessing.cpu_count()
+    if not _is_bgzf(header):
+        return _gzip_chunks(raw)
+    if threads > 1:
+        return _bgzf_chunks(raw, threads)
+    # Block by block even on one thread, so BGZF files are checked the same
+    # way however many threads there are
+    return (_inflate_block(block) for block in _bgzf_blocks(raw))
+
+
+# The columns Gene() and Region() take, in the order they take them
+GENE_COLUMNS = ('chrom', 'strand', 'txStart', 'txEnd',
+                'exonCount', 'exonStarts', 'exonEnds',
+                'geneSymbol', 'refseq')
+REGION_COLUMNS = ('Chromosome', 'StartPosition', 'EndPosition', 'RegionName')
+
+
+def _gene_header(gene_fp):
+    """Reads the header line of a gene file, returning the column names"""
+
+    header = gene_fp.readline()
+    if not header.startswith('#'):
+        print 'ERROR: No header on gene file. Wrong file type?'
+        print 'First line beginning with "#" expected'
+        exit(1)
+
+    header = header.lstrip('#')  # Remove any leading #
+    header = header.strip()  # Remove surrounding white space
+    # Create a list of the header entries
+    header_entries = header.split('\t')
+    # Get the string after the last "." ("hg19.refGene.strand" -> "strand")
+    # We don't care about version info
+    return [h.split('.')[-1] for h in header_entries]
+
+
+def _gene_fields(gene_fp, stats=None):
+    """
+    Yields a tuple of the fields Gene() takes for each line of the gene file
+    with the given filename (or open file).
+
+    """
+
+    newfile = False
+    # Try to read from gene_file. If we can't, assume it's something we can
+    # use to open a file.
+    if not hasattr(gene_fp, 'read'):
+        newfile = True
+        gene_fp = open_input(gene_fp)
+
+    try:
+        header_entries = _gene_header(gene_fp)
+
+        # Note that this technique allows the columns in the file to be in
+        # any order as long as they have the expected names
+        get_fields = _column_getter(header_entries, GENE_COLUMNS, 'gene')
+
+        # This loop starts at the next line of the file after the header
+        for fields in _parse_lines(gene_fp, get_fields, stats):
+            yield fields
+
+    finally:
+        # If we opened a new file, clean it up.
+        if newfile:
+            gene_fp.close()
+
+
+def _region_header(region_fp):
+    """Reads a region file up to its header line, returning the column
+    names
+
+    """
+
+    # Advance until line starting with "#" is read
+    header = region_fp.readline()
+    while not header.startswith('#'):
+        header = region_fp.readline()
+        # If we're at the end of the file, something is wrong
+        if header == '':
+            print 'ERROR: No header on region file. Wrong file type?'
+            print 'Line beginning with "#" expected before data'
+            exit(1)
+
+    header = header.lstrip('#')  # Remove any leading #
+    header = header.strip()  # Remove surrounding white space
+    # Create a list of the header entries
+    return header.split('\t')
+
+
+def _region_fields(region_fp, stats=None, extras=()):
+    """
+    Yields a tuple of the fields Region() takes for each line of the region
+    file with the given filename (or open file), followed by the columns
+    named in extras.
+
+    """
+
+    newfile = False
+    # Try to read from gene_file. If we can't, assume it's something we can
+    # use to open a file.
+    if not hasattr(region_fp, 'read'):
+        newfile = True
+        region_fp = open_input(region_fp)
+
+    try:
+        header_entries = _region_header(region_fp)
+
+        get_fields = _column_getter(header_entries,
+                                    REGION_COLUMNS + tuple(extras), 'region')
+
+        for fields in _parse_lines(region_fp, get_fields, stats):
+            yield fields
+
+    finally:
+        if newfile:
+            region_fp.close()
+
+
+def _lazy_genes(gene_fp, stats=None, cache_fields=True):
+    """
+    Yields a LazyGene for each line of the gene file with the given filename
+    (or open file), splitting each line only to get its coordinates and name
+
+    """
+
+    newfile = False
+    if not hasattr(gene_fp, 'read'):
+        newfile = True
+        gene_fp = open_input(gene_fp)
+
+    rows = 0
+    started = time.time()
+    try:
+        positions = _column_positions(_gene_header(gene_fp), GENE_COLUMNS,
+                                      'gene')
+        layout = _LazyGeneLayout(dict(zip(GENE_COLUMNS, positions)),
+                                 cache_fields)
+        get_key = itemgetter(*(positions[GENE_COLUMNS.index(column)]
+                               for column in ('chrom', 'txStart', 'txEnd',
+                                              'geneSymbol')))
+
+        for line in gene_fp:
+
+            line = line.strip()
+            if not line:
+                continue
+
+            chrom, left, right, name = get_key(line.split('\t'))
+            yield LazyGene(chrom, int(left), int(right), name.rstrip(','),
+                           line, layout)
+            rows += 1
+
+    finally:
+        if stats is not None:
+            stats.rows += rows
+            stats.seconds += time.time() - started
+        if newfile:
+            gene_fp.close()
+
+
+def iter_genes(gene_fp, stats=None, lazy=False, cache_fields=True):
+    """
+    Yields a Gene for each line of the file with the given filename, in file
+    order, without reading ahead. If a ParseStats is given it is filled in.
+
+    With lazy True the genes are LazyGenes, which decode their fields other
+    than chrom, left, right and name only when they are read, keeping the
+    decoded values unless cache_fields is False.
+
+    """
+
+    if lazy:
+        for gene in _lazy_genes(gene_fp, stats, cache_fields):
+            yield gene
+        return
+
+    for fields in _gene_fields(gene_fp, stats):
+        yield Gene(*fields)
+
+
+def iter_regions(region_fp, stats=None, extras=()):
+    """
+    Yields a Region for each line of the file with the given filename, in
+    file order, without reading ahead. If a ParseStats is given it is filled
+    in. The columns named in extras (e.g. ['Score']) are kept in each
+    Region's extras dict.
+
+    """
+
+    if not extras:
+        for fields in _region_fields(region_fp, stats):
+            yield Region(*fields)
+        return
+
+    for fields in _region_fields(region_fp, stats, extras):
+        yield Region(*fields[:4], extras=dict(izip(extras, fields[4:])))
+
+
+def _inputs(fp):
+    """Returns the files a create_* function was given: a list or tuple of
+    filenames (or open files) as it is, anything else as one file
+
+    """
+
+    if isinstance(fp, (list, tuple)):
+        return fp
+    return [fp]
+
+
+def _sorted_loaded(sort, stats, instrumentation):
+    """Runs sort (which returns how it sorted) in the "sort" phase and
+    reports how, in stats and as a "sort <how>" count
+
+    """
+
+    with instrumentation.phase('sort'):
+        how = sort()
+    instrumentation.count('sort ' + how)
+    if stats is not None:
+        stats.sort = how
+
+
+def create_gene_list(gene_fp, presorted=False, stats=None,
+                     instrumentation=None, lazy=False, cache_fields=True):
+    """
+    Creates and returns a sorted list of Genes from the file with the given
+    filename, or from a list of files (e.g. one per chromosome).
+
+    Input that is already in order is checked and not sorted again, and
+    files that are each in order are merged. Pass presorted=True to skip
+    even the check for input that is known to be sorted. If a ParseStats is
+    given it is filled in, and an Instrumentation times the "parse" and
+    "sort" phases and counts "rows" and how the sort went. lazy and
+    cache_fields work as in iter_genes.
+
+    """
+
+    if instrumentation is None:
+        instrumentation = NO_INSTRUMENTATION
+
+    with instrumentation.phase('parse'):
+        # This list will hold all the Gene objects
+        genes = list(chain.from_iterable(
+            iter_genes(fp, stats, lazy, cache_fields)
+            for fp in _inputs(gene_fp)))
+    instrumentation.count('rows', len(genes))
+
+    if not presorted:
+        _sorted_loaded(lambda: sort_intervals(genes), stats, instrumentation)
+
+    return genes
+
+
+def create_region_list(region_fp, presorted=False, stats=None,
+                       instrumentation=None, extras=()):
+    """
+    Creates and returns a sorted list of Regions from the file with the given
+    filename, or from a list of files
+
+    presorted, stats and instrumentation work as in create_gene_list, and
+    extras as in iter_regions.
+
+    """
+
+    if instrumentation is None:
+        instrumentation = NO_INSTRUMENTATION
+
+    with instrumentation.phase('parse'):
+        #This list will hold all the Region objects
+        regions = list(chain.from_iterable(
+            iter_regions(fp, stats, extras) for fp in _inputs(region_fp)))
+    instrumentation.count('rows', len(regions))
+
+    if not presorted:
+        _sorted_loaded(lambda: sort_intervals(regions), stats,
+                       instrumentation)
+
+    return regions
+
+
+def create_gene_table(gene_fp, presorted=False, stats=None,
+                      instrumentation=None):
+    """
+    Creates and returns a sorted GeneTable from the file with the given
+    filename, or from a list of files. Takes far less memory than
+    create_gene_list.
+
+    presorted, stats and instrumentation work as in create_gene_list.
+
+    """
+
+    if instrumentation is None:
+        instrumentation = NO_INSTRUMENTATION
+
+    with instrumentation.phase('parse'):
+        genes = GeneTable()
+        append = genes.append
+        for fp in _inputs(gene_fp):
+            for fields in _gene_fields(fp, stats):
+                append(*fields)
+    instrumentation.count('rows', len(genes))
+
+    if not presorted:
+        _sorted_loaded(genes.sort, stats, instrumentation)
+
+    return genes
+
+
+def create_region_table(region_fp, presorted=False, stats=None,
+                        instrumentation=None, extras=()):
+    """
+    Creates and returns a sorted RegionTable from the file with the given
+    filename, or from a list of files. Takes far less memory than
+    create_region_list.
+
+    presorted, stats, instrumentation and extras work as in
+    create_region_list.
+
+    """
+
+    if instrumentation is None:
+        instrumentation = NO_INSTRUMENTATION
+
+    with instrumentation.phase('parse'):
+        regions = RegionTable(extras)
+        append = regions.append
+        for fp in _inputs(region_fp):
+            if not extras:
+                for fields in _region_fields(fp, stats):
+                    append(*fields)
+            else:
+                for fields in _region_fields(fp, stats, extras):
+                    append(*fields[:4],
+                           extras=dict(izip(extras, fields[4:])))
+    instrumentation.count('rows', len(regions))
+
+    if not presorted:
+        _sorted_loaded(regions.sort, stats, instrumentation)
+
+    return regions
+
+
+# Concurrent loading
+#
+# load_inputs reads the gene and region files at the same time. Each file
+# gets a reader thread that reads (and inflates) it and puts the text on a
+# bounded queue in chunks, and each input gets a parser thread that builds
+# its list or table from the queued text. A full queue holds its reader
+# back, so no more than queue_chunks chunks per file wait in memory.
+# Reading, inflating (zlib releases the GIL) and waiting on the disk
+# overlap with parsing, so loading takes about as long as the slower input
+# rather than both. The parsers themselves hold the GIL and take turns, so
+# the gain is greatest for gzipped input. Both intern chromosome names in
+# the shared chromosomes dictionary, which locks while it gives out ids.
+
+# Chunks (of _READ_SIZE, or a gzip block's worth) each queue can hold
+DEFAULT_QUEUE_CHUNKS = 8
+
+# How often (in seconds) a reader with a full queue checks whether its
+# parser has given up
+_PUT_WAIT = 0.1
+
+
+def _put(queue, item, stop):
+    """Puts item on queue, waiting for room unless stop is set. Returns
+    False if it was.
+
+    """
+
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=_PUT_WAIT)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+
+def _read_file(filename, queue, stop, threads):
+    """Runs in a reader thread: puts the text of the file filename on queue
+    in chunks, then None. An error is put on the queue as its exc_info, for
+    the parser to raise.
+
+    """
+
+    try:
+        raw = open(filename, 'rb')
+        try:
+            chunks = _inflated_chunks(raw, threads)
+            if chunks is None:
+                chunks = iter(lambda: raw.read(_READ_SIZE), '')
+            for chunk in chunks:
+                if not _put(queue, chunk, stop):
+                    return
+        finally:
+            raw.close()
+    except Exception:
+        _put(queue, sys.exc_info(), stop)
+        return
+
+    _put(queue, None, stop)
+
+
+def _queued_chunks(queue, stop):
+    """Yields the chunks a reader thread puts on queue. Closing this tells
+    the reader to stop.
+
+    """
+
+    try:
+        while True:
+            chunk = queue.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, tuple):
+                raise chunk[0], chunk[1], chunk[2]
+            yield chunk
+    finally:
+        stop.set()
+
+
+def _read_ahead(fp, queue_chunks, threads):
+    """Returns an open file over the text of the file named fp, read by a
+    reader thread. Files that are open already are returned as they are.
+
+    """
+
+    if hasattr(fp, 'read'):
+        return fp
+
+    queue = Queue.Queue(queue_chunks)
+    stop = threading.Event()
+    reader = threading.Thread(target=_read_file,
+                              args=(fp, queue, stop, threads))
+    # A parser that fails leaves its reader waiting on a full queue until
+    # it sees stop
+    reader.daemon = True
+    reader.start()
+    return _DecompressedFile(None, _queued_chunks(queue, stop))
+
+
+def _parse_input(create, fp, options, queue_chunks, threads, results, key):
+    """Runs in a parser thread: stores create(files read ahead, **options),
+    or the exc_info of what it raised, in results[key]
+
+    """
+
+    files = []
+    try:
+        for name in _inputs(fp):
+            files.append(_read_ahead(name, queue_chunks, threads))
+        results[key] = create(files, **options), None
+    except BaseException:
+        # Including the SystemExit of a malformed file, which a thread
+        # would otherwise swallow
+        results[key] = None, sys.exc_info()
+    finally:
+        for opened, name in izip(files, _inputs(fp)):
+            if opened is not name:
+                opened.close()
+
+
+def load_inputs(gene_fp, region_fp, tables=False, extras=(),
+                gene_stats=None, region_stats=None,
+                queue_chunks=DEFAULT_QUEUE_CHUNKS, threads=None,
+                instrumentation=None):
+    """
+    Loads the gene and region files (filenames, open files, or lists of
+    either) at the same time and returns (genes, regions), sorted. They are
+    GeneTable and RegionTable if tables is True, else lists as from
+    create_gene_list and create_region_list.
+
+    extras works as in create_region_list, and ParseStats given as
+    gene_stats and region_stats are filled in. queue_chunks bounds the text
+    read ahead of the parser for each file, and threads works as in
+    open_input. An Instrumentation, if given, times the "load" phase.
+    Errors in either input are raised here.
+
+    """
+
+    if instrumentation is None:
+        instrumentation = NO_INSTRUMENTATION
+
+    if tables:
+        create_genes, create_regions = create_gene_table, create_region_table
+    else:
+        create_genes, create_regions = create_gene_list, create_region_list
+
+    results = {}
+    parsers = [
+        threading.Thread(target=_parse_input,
+                         args=(create_genes, gene_fp, {'stats': gene_stats},
+                               queue_chunks, threads, results, 'genes')),
+        threading.Thread(target=_parse_input,
+                         args=(create_regions, region_fp,
+                               {'stats': region_stats, 'extras': extras},
+                               queue_chunks, threads, results, 'regions'))]
+
+    with instrumentation.phase('load'):
+        for parser in parsers:
+            parser.start()
+        for parser in parsers:
+            parser.join()
+
+    loaded = []
+    for key in ('genes', 'regions'):
+        value, exc_info = results[key]
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        loaded.append(value)
+    return tuple(loaded)
+
+
+# Where TrackFeature() fields are in a BED file. Columns can also be given
+# by header name, e.g. {'left': 'chromStart'} for a UCSC table dump.
+BED_COLUMNS = {'chrom': 0, 'left': 1, 'right': 2, 'name': 3, 'score': 4,
+               'strand': 5}
+
+# Lines in track files that aren't data
+_TRACK_SKIP = ('#', 'track', 'browser')
+
+
+def _track_getter(header_entries, columns):
+    """
+    Returns a function that picks the TrackFeature() arguments out of a list
+    of line entries, with None for optional columns a line doesn't have.
+
+    """
+
+    positions = {}
+    for field, column in columns.iteritems():
+        if not isinstance(column, int):
+            if column not in header_entries:
+                print 'ERROR: No "{}" column in track file header'.format(
+                    column)
+                exit(1)
+            column = header_entries.index(column)
+        positions[field] = column
+
+    for field in ['chrom', 'left', 'right']:
+        if field not in positions:
+            print 'ERROR: No column given for "{}" in track file'.format(field)
+            exit(1)
+
+    chrom = positions['chrom']
+    left = positions['left']
+    right = positions['right']
+    name = positions.get('name')
+    score = positions.get('score')
+    strand = positions.get('strand')
+
+    def get_fields(entries):
+
+        # Features without a name are named after where they are
+        if name is not None and name < len(entries):
+            feature_name = entries[name]
+        else:
+            feature_name = '{}:{}-{}'.format(entries[chrom], entries[left],
+                                             entries[right])
+        # BED uses "." for a missing score or strand
+        feature_score = None
+        if score is not None and score < len(entries):
+            if entries[score] != '.':
+                feature_score = float(entries[score])
+        feature_strand = None
+        if strand is not None and strand < len(entries):
+            if entries[strand] != '.':
+                feature_strand = entries[strand]
+
+        return (entries[chrom], int(entries[left]), int(entries[right]),
+                feature_name, feature_score, feature_strand)
+
+    return get_fields
+
+
+def iter_track(track_fp, feature_class=TrackFeature, columns=None,
+               stats=None):
+    """
+    Yields a feature_class (a TrackFeature subclass) for each line of the
+    BED-like file with the given filename, in file order.
+
+    columns maps TrackFeature fields to column positions (from 0) or to
+    names from the last "#" header line, and defaults to BED_COLUMNS. Track,
+    browser and "#" lines are skipped. If a ParseStats is given it is
+    filled in.
+
+    """
+
+    if columns is None:
+        columns = BED_COLUMNS
+
+    newfile = False
+    if not hasattr(track_fp, 'read'):
+        newfile = True
+        track_fp = open_input(track_fp)
+
+    try:
+        # The header, if any, is the last "#" line before the data
+        header_entries = []
+        first_line = None
+        for line in track_fp:
+            if line.startswith('#'):
+                header_entries = line.lstrip('#').strip().split('\t')
+            elif line.strip() and not line.startswith(_TRACK_SKIP):
+                first_line = line
+                break
+
+        if first_line is None:
+            return
+
+        get_fields = _track_getter(header_entries, columns)
+        lines = (line for line in chain([first_line], track_fp)
+                 if not line.startswith(_TRACK_SKIP))
+
+        for fields in _parse_lines(lines, get_fields, stats):
+            yield feature_class(*fields)
+
+    finally:
+        if newfile:
+            track_fp.close()
+
+
+def create_track_list(track_fp, feature_class=TrackFeature, columns=None,
+                      presorted=False, stats=None):
+    """
+    Creates and returns a sorted list of feature_class features from the
+    BED-like file with the given filename. See iter_track for the columns
+    and create_gene_list for presorted and stats.
+
+    """
+
+    features = list(iter_track(track_fp, feature_class, columns, stats))
+
+    if not presorted:
+        sort_intervals(features)
+
+    return features
+
+
+# Parsed gene files are cached here unless load_cached_genes is told
+# otherwise
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'),
+                                 '.featurefinder_cache')
+
+# Bumped whenever the layout of the cache files changes
+_CACHE_VERSION = 2
+
+
+def _file_fingerprint(filename):
+    """Returns (absolute path, size, mtime, MD5 of the contents)
+
+    MD5 is only used to notice changed files, and it is several times
+    faster than SHA-1 on big annotations.
+
+    """
+
+    info = os.stat(filename)
+    digest = hashlib.md5()
+    with open(filename, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), ''):
+            digest.update(block)
+
+    return (os.path.abspath(filename), info.st_size, info.st_mtime,
+            digest.hexdigest())
+
+
+def _cache_filename(filename, cache_dir):
+
+    name = hashlib.sha1(os.path.abspath(filename)).hexdigest() + '.ffcache'
+    return os.path.join(cache_dir, name)
+
+
+def _write_gene_cache(cache_filename, fingerprint, genes, index):
+    """Saves a sorted GeneTable and the maxends of its FeatureIndex
+
+    The file is a marshal dump of a dict: the array columns as raw bytes,
+    and the names and refseqs as codes into one list of distinct strings.
+    It is written to a temporary file first, so readers never see half of
+    one.
+
+    """
+
+    codes = {}
+    strings = []
+    for string in chain(genes.names, genes.refseqs):
+        if string not in codes:
+            codes[string] = len(strings)
+            strings.append(string)
+
+    data = {
+        'version': _CACHE_VERSION,
+        'fingerprint': fingerprint,
+        'chrom_names': genes.chrom_names,
+        'strings': strings,
+        'names': array('I', (codes[n] for n in genes.names)).tostring(),
+        'refseqs': array('I', (codes[r] for r in genes.refseqs)).tostring(),
+        'maxends': dict((chrom, array('l', tree.maxends).tostring())
+                        for chrom, tree in index._trees.iteritems()),
+    }
+    for column in ['chroms', 'lefts', 'rights', 'strands',
+                   'exon_offsets', 'exon_starts', 'exon_ends']:
+        data[column] = getattr(genes, column).tostring()
+
+    cache_dir = os.path.dirname(cache_filename)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    fd, tmp_filename = tempfile.mkstemp(dir=cache_dir)
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            marshal.dump(data, tmp)
+        os.rename(tmp_filename, cache_filename)
+    except:
+        os.remove(tmp_filename)
+        raise
+
+
+def _read_gene_cache(cache_filename, fingerprint):
+    """Returns (GeneTable, FeatureIndex) from a cache file, or None if there
+    is no usable cache for a file with the given fingerprint
+
+    """
+
+    try:
+        with open(cache_filename, 'rb') as fp:
+            data = marshal.load(fp)
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+
+    if (not isinstance(data, dict)
+            or data.get('version') != _CACHE_VERSION
+            or data.get('fingerprint') != fingerprint):
+        return None
+
+    genes = GeneTable()
+    for column in ['chroms', 'lefts', 'rights', 'strands',
+                   'exon_offsets', 'exon_starts', 'exon_ends']:
+        values = array(getattr(genes, column).typecode)
+        values.fromstring(data[column])
+        setattr(genes, column, values)
+
+    genes.chrom_names = data['chrom_names']
+    genes._chrom_codes = dict((chrom, code) for code, chrom
+                              in enumerate(genes.chrom_names))
+    strings = data['strings']
+    genes._strings = dict(izip(strings, strings))
+    for column in ['names', 'refseqs']:
+        codes = array('I')
+        codes.fromstring(data[column])
+        setattr(genes, column, map(strings.__getitem__, codes))
+
+    maxends = {}
+    for chrom, values in data['maxends'].iteritems():
+        maxends[chrom] = array('l')
+        maxends[chrom].fromstring(values)
+
+    return genes, FeatureIndex.from_table(genes, maxends)
+
+
+def load_cached_genes(gene_file, cache_dir=None, stats=None):
+    """
+    Returns (GeneTable, FeatureIndex) for the gene file with the given
+    filename, reading them from the cache when the file hasn't changed.
+
+    A cache entry is used only if the file's path, size, mtime and MD5
+    all match the ones it was made from; otherwise the file is parsed with
+    create_gene_table (filling in stats, if given) and the cache rewritten.
+    cache_dir defaults to DEFAULT_CACHE_DIR. Failing to write the cache is
+    not an error.
+
+    """
+
+    if cache_dir is None:
+        cache_dir = DEFAULT_CACHE_DIR
+
+    fingerprint = _file_fingerprint(gene_file)
+    cache_filename = _cache_filename(gene_file, cache_dir)
+
+    cached = _read_gene_cache(cache_filename, fingerprint)
+    if cached is not None:
+        return cached
+
+    genes = create_gene_table(gene_file, stats=stats)
+    index = FeatureIndex.from_table(genes)
+
+    try:
+        _write_gene_cache(cache_filename, fingerprint, genes, index)
+    except (IOError, OSError):
+        pass
+
+    return genes, index
+
+
+def print_comp(feature, region):
+
+    pass
+    #print 'Feat: ', feature.chrom, '(', feature.left, ',', feature.right, ')'
+    #print 'Reg:  ', region.chrom, '(', region.left, ',', region.right, ')'
+
+
+def overlaps(feature, region):
+    """Returns True if the feature overlaps the region"""
+
+    ###print 'In overlaps...'
+    ###print_comp(feature, region)
+
+    return (region.chrom_id == feature.chrom_id and
+            min(region.right, feature.right)
+            - max(region.left, feature.left) > 0)
+
+
+def before(feature, region):
+    """Returns True if the feature is completely before the region
+
+    If the end of the feature is before the beginning of the region,
+    returns True"""
+
+    ###print 'In before...'
+    ###print_comp(feature, region)
+
+    feature_rank = chromosomes.ranks[feature.chrom_id]
+    region_rank = chromosomes.ranks[region.chrom_id]
+    if feature_rank < region_rank:
+        return True
+    elif feature_rank > region_rank:
+        return False
+    else: # They are on the same chromosome
+        return feature.right < region.left
+
+
+def after(feature, region):
+    """Returns True if the feature is completely after the region
+
+    If the beginning of the feature is after the end of the region,
+    returns True"""
+
+    ###print 'In after...'
+    ###print_comp(feature, region)
+
+    feature_rank = chromosomes.ranks[feature.chrom_id]
+    region_rank = chromosomes.ranks[region.chrom_id]
+    if feature_rank > region_rank:
+        return True
+    elif feature_rank < region_rank:
+        return False
+    else: # They are on the same chromosome
+        return feature.left > region.right
+
+
+def get_overlap(region, feature):
+    """ Returns the number of bases that the Region and the Feature overlap """
+
+    if region.chrom_id != feature.chrom_id:
+        return 0
+
+    return max(0, min(region.right, feature.right)
+                     - max(region.left, feature.left) + 1)
+
+
+def get_amount_before(feature, region):
+    """ Returns the number of bases the the Feature is before the region
+
+    Returns -1 if the Feature is not before the Region (it overlaps the
+    Region, comes after it, or is on another chromosome).
+
+    """
+
+    if feature.chrom_id != region.chrom_id or feature.right > region.left:
+        return -1
+
+    return region.left - feature.right
+
+
+def get_amount_after(feature, region):
+    """ Returns the number of bases the the Feature is after the region
+
+    Returns -1 if the Feature is not after the Region (it overlaps the
+    Region, comes before it, or is on another chromosome).
+
+    """
+
+    if feature.chrom_id != region.chrom_id or feature.left < region.right:
+        return -1
+
+    return feature.left - region.right
+
+
+def get_distance(feature, region):
+    """ Returns the number of bases between the Feature and the Region
+
+    Returns 0 if they overlap and -1 if they are on different chromosomes.
+
+    """
+
+    if feature.chrom_id != region.chrom_id:
+        return -1
+
+    return max(0, feature.left - region.right, region.left - feature.right)
+
+
+def is_upstream(feature, region):
+    """Returns True if the Region is upstream of the Feature
+
+    Upstream follows the Feature's strand: before txStart on the + strand,
+    after txEnd on the - strand. Features without a strand count as +.
+
+    """
+
+    if feature.chrom_id != region.chrom_id:
+        return False
+
+    if getattr(feature, 'positive_strand', True):
+        return region.right <= feature.left
+    else:
+        return region.left >= feature.right
+
+
+def is_downstream(feature, region):
+    """Returns True if the Region is downstream of the Feature
+
+    Downstream follows the Feature's strand, see is_upstream.
+
+    """
+
+    if feature.chrom_id != region.chrom_id:
+        return False
+
+    if getattr(feature, 'positive_strand', True):
+        return region.left >= feature.right
+    else:
+        return region.right <= feature.left
+
+
+def print_overlap_info(feature, region):
+    """
+    Prints an intelligable message about how the Feature and the Region overlap
+
+    """
+
+    print "{} overlaps {} by {} base pairs".format(region.name,
+                                                   feature.name,
+                                                   get_overlap(region,
+                                                               feature))
+
+
+class _ChromTree(object):
+    """An implicit augmented interval tree over the features of one chromosome
+
+    The features are kept in a list sorted by (left, right), and that list is
+    the tree: the node at index i sits at level k, where k is the number of
+    trailing 1 bits in i, and maxends[i] holds the largest right end in the
+    subtree below it. (This is the layout used by Heng Li's cgranges.)
+
+    """
+
+    def __init__(self, starts, ends, features=None, maxends=None):
+
+        self.starts = starts
+        self.ends = ends
+        self.features = features
+        self._has_empty = None  # Any zero-length features? See positions()
+        if maxends is None:
+            self.maxends = list(ends)
+            self.max_level = self._index()
+        else:
+            # Saved from an earlier _index() of the same starts and ends
+            self.maxends = maxends
+            self.max_level = len(starts).bit_length() - 1
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _index(self):
+        """Fills in maxends bottom up and returns the level of the root"""
+
+        n = len(self.starts)
+        if n == 0:
+            return -1
+
+        ends = self.ends
+        maxends = self.maxends
+
+        # Leaves (level 0) are the even indices, their maxend is their end
+        last_i = 0
+        last = 0
+        for i in xrange(0, n, 2):
+            last_i = i
+            last = ends[i]
+
+        k = 1
+        while (1 << k) <= n:
+            x = 1 << (k - 1)
+            for i in xrange((x << 1) - 1, n, x << 2):
+                e = ends[i]
+                el = maxends[i - x]
+                # The right child may be past the end of the list
+                er = maxends[i + x] if i + x < n else last
+                if el > e:
+                    e = el
+                if er > e:
+                    e = er
+                maxends[i] = e
+            # Move last_i up to its parent
+            if (last_i >> k) & 1:
+                last_i -= x
+            else:
+                last_i += x
+            if last_i < n and maxends[last_i] > last:
+                last = maxends[last_i]
+            k += 1
+
+        return k - 1
+
+    def positions(self, left, right, instrumentation=None, enclosing=False):
+        """Returns the sorted list indices of the features overlapping
+        (left, right), as overlaps() defines it: zero-length intervals
+        overlap nothing
+
+        With enclosing True, a feature only has to start before right and
+        end after left, so a zero-length interval inside a feature (or a
+        zero-length feature inside the interval) counts too. That is the
+        rule for distance 0 in FeatureIndex.nearest().
+
+        If an Instrumentation is given, the features compared and the ones
+        compared but not overlapping are counted as "comparisons" and
+        "skips".
+
+        """
+
+        found = []
+        n = len(self.starts)
+        if n == 0 or (left >= right and not enclosing):
+            return found
+
+        starts = self.starts
+        ends = self.ends
+        maxends = self.maxends
+
+        compared = 0
+
+        # Each entry is (node, level, left child already visited)
+        stack = [((1 << self.max_level) - 1, self.max_level, False)]
+        while stack:
+            x, k, visited = stack.pop()
+            if k <= 3:
+                # Small subtree: cheaper to scan it than to descend
+                i = i0 = x >> k << k
+                i1 = min(i + (1 << (k + 1)) - 1, n)
+                while i < i1 and starts[i] < right:
+                    if left < ends[i]:
+                        found.append(i)
+                    i += 1
+                compared += i - i0
+            elif not visited:
+                stack.append((x, k, True))
+                y = x - (1 << (k - 1))
+                # The left child may be past the end of the list
+                if y >= n or maxends[y] > left:
+                    stack.append((y, k - 1, False))
+            elif x < n and starts[x] < right:
+                if left < ends[x]:
+                    found.append(x)
+                compared += 1
+                stack.append((x + (1 << (k - 1)), k - 1, False))
+
+        if not enclosing and found and self._any_empty():
+            found = [i for i in found if starts[i] < ends[i]]
+
+        if instrumentation is not None:
+            instrumentation.count('comparisons', compared)
+            instrumentation.count('skips', compared - len(found))
+
+        return found
+
+    def _any_empty(self):
+        """Returns True if any feature has zero length, working it out on
+        first use
+
+        """
+
+        if self._has_empty is None:
+            self._has_empty = any(imap(ge, self.starts, self.ends))
+        return self._has_empty
+
+
+class _SortedLayout(object):
+    """The features of one chromosome (and possibly one strand) sorted both
+    by left end and by right end, so bisect can find the closest feature on
+    either side of a position
+
+    """
+
+    def __init__(self, features):
+
+        self.by_start = sorted(features, key=attrgetter('left', 'right'))
+        self.starts = [f.left for f in self.by_start]
+        self.by_end = sorted(features, key=attrgetter('right', 'left'))
+        self.ends = [f.right for f in self.by_end]
+
+    def walk_after(self, right, tiebreak):
+        """Yields (distance, tiebreak, feature) for the features starting at
+        or after right, closest first
+
+        """
+
+        by_start = self.by_start
+        for i in xrange(bisect_left(self.starts, right), len(by_start)):
+            feature = by_start[i]
+            yield feature.left - right, next(tiebreak), feature
+
+    def walk_before(self, left, tiebreak):
+        """Yields (distance, tiebreak, feature) for the features ending at or
+        before left, closest first
+
+        """
+
+        by_end = self.by_end
+        for i in xrange(bisect_right(self.ends, left) - 1, -1, -1):
+            feature = by_end[i]
+            yield left - feature.right, next(tiebreak), feature
+
+
+class FeatureIndex(object):
+    """Answers "which features overlap (chrom, left, right)?" without walking
+    the whole feature list
+
+    One _ChromTree is built per chromosome, so a query costs O(log n + k)
+    for n features on the chromosome and k features returned. Features are
+    returned in the same order sort_intervals would put them in.
+
+    The nearest feature queries bisect into per-chromosome (and per-strand)
+    lists sorted by left and by right end, which are built the first time a
+    chromosome is asked about.
+
+    """
+
+    def __init__(self, feature_list=()):
+
+        by_chrom = defaultdict(list)
+        for feature in feature_list:
+            by_chrom[feature.chrom].append(feature)
+
+        self._trees = {}
+        for chrom, features in by_chrom.iteritems():
+            features.sort(key=attrgetter('left', 'right'))
+            self._trees[chrom] = _ChromTree([f.left for f in features],
+                                            [f.right for f in features],
+                                            features)
+
+        # Built on demand by _layout for the nearest feature queries
+        self._layouts = {}
+
+    @classmethod
+    def from_table(cls, table, maxends=None):
+        """Returns an index over the rows of a sorted IntervalTable
+
+        The coordinates come straight from the table's columns and views are
+        only made for the rows a query returns. maxends can hold the saved
+        maxends of each chromosome's tree (see load_cached_genes).
+
+        """
+
+        index = cls()
+        for chrom, first, last in table.chrom_ranges():
+            tree_maxends = None
+            if maxends is not None:
+                tree_maxends = maxends[chrom]
+            index._trees[chrom] = _ChromTree(table.lefts[first:last],
+                                             table.rights[first:last],
+                                             _TableRows(table, first, last),
+                                             tree_maxends)
+        return index
+
+    def __len__(self):
+        return sum(len(tree) for tree in self._trees.itervalues())
+
+    def chroms(self):
+        """Returns the list of chromosomes that have features, in chromosomes
+        order
+
+        """
+
+        return sorted(self._trees, key=chromosomes.order_key)
+
+    def features(self, chrom):
+        """Returns the sorted list of features on chrom"""
+
+        tree = self._trees.get(chromosomes.canonical(chrom))
+        if tree is None:
+            return []
+        return tree.features
+
+    def overlapping(self, chrom, left, right, instrumentation=None):
+        """Returns the sorted list of features overlapping (chrom, left, right)
+
+        Overlap means the same as in overlaps(): at least one base in common,
+        so features that only touch the ends of the interval are left out,
+        and zero-length intervals and features overlap nothing. An
+        Instrumentation, if given, counts the work done.
+
+        """
+
+        tree = self._trees.get(chrom)
+        if tree is None:
+            # chrom may be an alias (1 for chr1)
+            tree = self._trees.get(chromosomes.canonical(chrom))
+            if tree is None:
+                return []
+        features = tree.features
+        return [features[i]
+                for i in tree.positions(left, right, instrumentation)]
+
+    def _enclosing(self, chrom, left, right):
+        """Returns the sorted list of features that start before right and
+        end after left: the ones nearest() puts at distance 0, which include
+        any a zero-length interval lies inside
+
+        """
+
+        tree = self._trees.get(chromosomes.canonical(chrom))
+        if tree is None:
+            return []
+        features = tree.features
+        return [features[i]
+                for i in tree.positions(left, right, enclosing=True)]
+
+    def _layout(self, chrom, strand=None):
+        """Returns the _SortedLayout for chrom, restricted to one strand if
+        strand is True (+) or False (-), building it on first use
+
+        """
+
+        chrom = chromosomes.canonical(chrom)
+        if chrom not in self._trees:
+            return None
+
+        key = (chrom, strand)
+        layout = self._layouts.get(key)
+        if layout is None:
+            features = self._trees[chrom].features
+            if strand is not None:
+                features = [f for f in features
+                            if getattr(f, 'positive_strand', True) == strand]
+            layout = self._layouts[key] = _SortedLayout(features)
+        return layout
+
+    def _walks(self, chrom, left, right, direction):
+        """Returns the walks whose merge lists the features on chrom that do
+        not overlap (left, right) and lie in the given direction, closest
+        first
+
+        """
+
+        # Each pair is (strand, walk after the interval?)
+        if direction is None:
+            sides = [(None, True), (None, False)]
+        elif direction == 'upstream':
+            # The interval is before + strand features and after - ones
+            sides = [(True, True), (False, False)]
+        elif direction == 'downstream':
+            sides = [(True, False), (False, True)]
+        else:
+            raise ValueError('direction must be None, "upstream" or '
+                             '"downstream", not {!r}'.format(direction))
+
+        tiebreak = count()
+        walks = []
+        for strand, after in sides:
+            layout = self._layout(chrom, strand)
+            if layout is None:
+                continue
+            if after:
+                walks.append(layout.walk_after(right, tiebreak))
+            else:
+                walks.append(layout.walk_before(left, tiebreak))
+        return walks
+
+    def nearest(self, chrom, left, right, k=1, direction=None):
+        """Returns up to k (distance, feature) pairs for the features closest
+        to (chrom, left, right), closest first
+
+        With direction None, overlapping features come first at distance 0,
+        along with any a zero-length interval lies inside. With direction
+        "upstream" or "downstream" only features the interval is upstream or
+        downstream of are returned (see is_upstream), so the
+        Gene.positive_strand orientation is respected.
+
+        """
+
+        found = []
+        if direction is None:
+            found = [(0, f) for f in self._enclosing(chrom, left, right)]
+            if len(found) >= k:
+                return found[:k]
+
+        walks = self._walks(chrom, left, right, direction)
+        for distance, _, feature in islice(merge(*walks), k - len(found)):
+            found.append((distance, feature))
+
+        return found
+
+    def nearest_before(self, chrom, left, right):
+        """Returns the feature ending closest before (chrom, left, right) or
+        None
+
+        """
+
+        layout = self._layout(chrom)
+        if layout is None:
+            return None
+        for distance, _, feature in layout.walk_before(left, count()):
+            return feature
+        return None
+
+    def nearest_after(self, chrom, left, right):
+        """Returns the feature starting closest after (chrom, left, right) or
+        None
+
+        """
+
+        layout = self._layout(chrom)
+        if layout is None:
+            return None
+        for distance, _, feature in layout.walk_after(right, count()):
+            return feature
+        return None
+
+    def nearest_upstream(self, chrom, left, right):
+        """Returns the closest feature that (chrom, left, right) is upstream
+        of, or None
+
+        """
+
+        found = self.nearest(chrom, left, right, direction='upstream')
+        if not found:
+            return None
+        return found[0][1]
+
+    def nearest_downstream(self, chrom, left, right):
+        """Returns the closest feature that (chrom, left, right) is
+        downstream of, or None
+
+        """
+
+        found = self.nearest(chrom, left, right, direction='downstream')
+        if not found:
+            return None
+        return found[0][1]
+
+    def within(self, chrom, left, right, distance, direction=None):
+        """Returns the sorted list of features no more than distance bases
+        from (chrom, left, right)
+
+        direction works as in nearest(): "upstream" or "downstream" keeps
+        only the features the interval is upstream or downstream of.
+
+        """
+
+        # Widen by one extra base so features exactly distance away count
+        found = self.overlapping(chrom, left - distance - 1,
+                                 right + distance + 1)
+
+        if direction is not None:
+            region = Interval(chrom, left, right, '')
+            if direction == 'upstream':
+                found = [f for f in found if is_upstream(f, region)]
+            elif direction == 'downstream':
+                found = [f for f in found if is_downstream(f, region)]
+            else:
+                raise ValueError('direction must be None, "upstream" or '
+                                 '"downstream", not {!r}'.format(direction))
+
+        return found
+
+
+# An index file written by write_feature_index is laid out as
+#
+#   header   magic, chromosome count and where the later sections start
+#   records  one fixed-width record per feature, grouped by chromosome and
+#            sorted by (left, right) within it, so each chromosome's run of
+#            records is a _ChromTree with its maxends filled in
+#   by_end   one (right, record) pair per feature, per chromosome sorted by
+#            (right, left), for the nearest feature queries
+#   chroms   one entry per chromosome: name and its run of records
+#   strings  length-prefixed names, refseqs and chromosome names
+#
+# All numbers are little-endian.
+_MAPPED_MAGIC = 'FFINDEX\x01'
+# magic, chromosome count, offsets of the by_end, chroms and strings sections
+_MAPPED_HEADER = struct.Struct('<8sIQQQ')
+# left, right, maxend, name, refseq, positive strand
+_MAPPED_RECORD = struct.Struct('<qqqIIB3x')
+# right, record number within the chromosome
+_MAPPED_BY_END = struct.Struct('<qQ')
+# name, first record, record count
+_MAPPED_CHROM = struct.Struct('<IQQ')
+# length of a string in the string table
+_MAPPED_LENGTH = struct.Struct('<H')
+_MAPPED_INT = struct.Struct('<q')
+
+
+def write_feature_index(feature_list, filename):
+    """
+    Writes the features (e.g. from create_gene_list) to an index file that
+    MappedFeatureIndex can open. Features without a strand are stored as +
+    and features without a refseq get an empty one.
+
+    """
+
+    index = feature_list
+    if not isinstance(index, FeatureIndex):
+        index = FeatureIndex(feature_list)
+    chroms = index.chroms()
+
+    # Build the string table first, so the section offsets are known
+    strings = []
+    string_offsets = {}
+    strings_size = [0]
+
+    def string_offset(string):
+        offset = string_offsets.get(string)
+        if offset is None:
+            offset = string_offsets[string] = strings_size[0]
+            strings.append(_MAPPED_LENGTH.pack(len(string)) + string)
+            strings_size[0] += _MAPPED_LENGTH.size + len(string)
+        return offset
+
+    for chrom in chroms:
+        string_offset(chrom)
+
+    total = len(index)
+    by_end_at = _MAPPED_HEADER.size + total * _MAPPED_RECORD.size
+    chroms_at = by_end_at + total * _MAPPED_BY_END.size
+    strings_at = chroms_at + len(chroms) * _MAPPED_CHROM.size
+
+    with open(filename, 'wb') as fp:
+
+        fp.write(_MAPPED_HEADER.pack(_MAPPED_MAGIC, len(chroms), by_end_at,
+                                     chroms_at, strings_at))
+
+        for chrom in chroms:
+            tree = index._trees[chrom]
+            for i, feature in enumerate(tree.features):
+                fp.write(_MAPPED_RECORD.pack(
+                    feature.left, feature.right, tree.maxends[i],
+                    string_offset(feature.name),
+                    string_offset(getattr(feature, 'refseq', '')),
+                    getattr(feature, 'positive_strand', True)))
+
+        for chrom in chroms:
+            tree = index._trees[chrom]
+            order = sorted(xrange(len(tree)),
+                           key=lambda i: (tree.ends[i], tree.starts[i]))
+            for i in order:
+                fp.write(_MAPPED_BY_END.pack(tree.ends[i], i))
+
+        first = 0
+        for chrom in chroms:
+            length = len(index._trees[chrom])
+            fp.write(_MAPPED_CHROM.pack(string_offset(chrom), first, length))
+            first += length
+
+        fp.write(''.join(strings))
+
+
+class _MappedColumn(object):
+    """One integer field of a run of fixed-width records in a mapped file,
+    as a read-only sequence (so bisect and _ChromTree can use it)
+
+    """
+
+    def __init__(self, buf, offset, stride, length):
+
+        self._buf = buf
+        self._offset = offset
+        self._stride = stride
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, i):
+
+        if i < 0:
+            i += self._length
+        if not 0 <= i < self._length:
+            raise IndexError('mapped column index out of range')
+        return _MAPPED_INT.unpack_from(self._buf,
+                                       self._offset + i * self._stride)[0]
+
+
+class MappedFeature(object):
+    """A feature read from a MappedFeatureIndex
+
+    It has the Feature fields plus positive_strand, strand and refseq, and
+    stays usable after the index is closed.
+
+    """
+
+    __slots__ = ('chrom', 'left', 'right', 'name', 'refseq',
+                 'positive_strand', '_key')
+
+    @property
+    def strand(self):
+        return '+' if self.positive_strand else '-'
+
+    @property
+    def chrom_id(self):
+        return chromosomes.chrom_id(self.chrom)
+
+    def __eq__(self, other):
+        return type(other) is type(self) and other._key == self._key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __str__(self):
+        return "{} {} @ {} ({},{})".format(type(self).__name__, self.name,
+                                            self.chrom, self.left, self.right)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class _MappedRows(object):
+    """The records of one chromosome as a read-only sequence of
+    MappedFeatures
+
+    """
+
+    def __init__(self, index, chrom, first, length):
+
+        self._index = index
+        self._chrom = chrom
+        self._first = first
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, i):
+
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(self._length))]
+        if i < 0:
+            i += self._length
+        if not 0 <= i < self._length:
+            raise IndexError('mapped row index out of range')
+
+        index = self._index
+        record = self._first + i
+        left, right, maxend, name, refseq, strand = \
+            _MAPPED_RECORD.unpack_from(index._buf, _MAPPED_HEADER.size
+                                       + record * _MAPPED_RECORD.size)
+
+        feature = MappedFeature()
+        feature.chrom = self._chrom
+        feature.left = left
+        feature.right = right
+        feature.name = index._string(name)
+        feature.refseq = index._string(refseq)
+        feature.positive_strand = bool(strand)
+        feature._key = (index.filename, record)
+        return feature
+
+    def __iter__(self):
+
+        for i in xrange(self._length):
+            yield self[i]
+
+
+class _MappedLayout(object):
+    """Does the job of _SortedLayout for a chromosome of a mapped index,
+    reading the by_end section instead of sorting the features, and
+    skipping features on the other strand when strand is True or False
+
+    """
+
+    def __init__(self, tree, by_end_ends, by_end_records, strand):
+
+        self.tree = tree
+        self.ends = by_end_ends
+        self.records = by_end_records
+        self.strand = strand
+
+    def walk_after(self, right, tiebreak):
+
+        features = self.tree.features
+        strand = self.strand
+        for i in xrange(bisect_left(self.tree.starts, right), len(features)):
+            feature = features[i]
+            if strand is None or feature.positive_strand == strand:
+                yield feature.left - right, next(tiebreak), feature
+
+    def walk_before(self, left, tiebreak):
+
+        features = self.tree.features
+        records = self.records
+        strand = self.strand
+        for i in xrange(bisect_right(self.ends, left) - 1, -1, -1):
+            feature = features[records[i]]
+            if strand is None or feature.positive_strand == strand:
+                yield left - feature.right, next(tiebreak), feature
+
+
+class MappedFeatureIndex(FeatureIndex):
+    """A FeatureIndex read through mmap from a file written by
+    write_feature_index
+
+    Opening it reads only the header and the chromosome list. A query reads
+    just the records it passes on the way down the tree, and processes
+    opening the same file share the pages through the OS cache.
+
+    """
+
+    def __init__(self, filename):
+
+        super(MappedFeatureIndex, self).__init__()
+
+        self.filename = os.path.abspath(filename)
+        with open(filename, 'rb') as fp:
+            self._buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, chrom_count, by_end_at, chroms_at, self._strings_at = \
+            _MAPPED_HEADER.unpack_from(self._buf, 0)
+        if magic != _MAPPED_MAGIC:
+            self.close()
+            raise ValueError('{} is not a feature index file'.format(filename))
+
+        self._by_end = {}
+        for i in xrange(chrom_count):
+            name, first, length = _MAPPED_CHROM.unpack_from(
+                self._buf, chroms_at + i * _MAPPED_CHROM.size)
+            chrom = self._string(name)
+
+            records_at = _MAPPED_HEADER.size + first * _MAPPED_RECORD.size
+            stride = _MAPPED_RECORD.size
+            self._trees[chrom] = _ChromTree(
+                _MappedColumn(self._buf, records_at, stride, length),
+                _MappedColumn(self._buf, records_at + 8, stride, length),
+                _MappedRows(self, chrom, first, length),
+                _MappedColumn(self._buf, records_at + 16, stride, length))
+
+            by_end_at_chrom = by_end_at + first * _MAPPED_BY_END.size
+            stride = _MAPPED_BY_END.size
+            self._by_end[chrom] = (
+                _MappedColumn(self._buf, by_end_at_chrom, stride, length),
+                _MappedColumn(self._buf, by_end_at_chrom + 8, stride, length))
+
+    def _string(self, offset):
+
+        offset += self._strings_at
+        length, = _MAPPED_LENGTH.unpack_from(self._buf, offset)
+        offset += _MAPPED_LENGTH.size
+        return self._buf[offset:offset + length]
+
+    def _layout(self, chrom, strand=None):
+
+        chrom = chromosomes.canonical(chrom)
+        if chrom not in self._trees:
+            return None
+
+        key = (chrom, strand)
+        layout = self._layouts.get(key)
+        if layout is None:
+            ends, records = self._by_end[chrom]
+            layout = self._layouts[key] = _MappedLayout(self._trees[chrom],
+                                                        ends, records, strand)
+        return layout
+
+    def close(self):
+        """Unmaps the file. Features already returned stay usable."""
+
+        self._buf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Mutable index
+#
+# MutableFeatureIndex keeps each chromosome's features in a treap: a binary
+# search tree on (left, right, tiebreak) that is also a heap on random
+# priorities, which keeps it balanced on average. Each node also holds the
+# largest right end below it (maxend), so overlap queries skip subtrees the
+# same way _ChromTree does. Nodes are never changed once made: an update
+# copies just the path from the root to the nodes it touches, O(log n), and
+# then publishes the new roots in one assignment. A query reads the roots
+# once, so it sees either all of an update or none of it, and old versions
+# stay usable for as long as something holds them (see snapshot()).
+
+
+class _TreapNode(object):
+
+    __slots__ = ('key', 'feature', 'priority', 'low', 'high', 'maxend')
+
+    def __init__(self, key, feature, priority, low, high):
+
+        self.key = key
+        self.feature = feature
+        self.priority = priority
+        self.low = low
+        self.high = high
+        self.maxend = _maxend(key[1], low, high)
+
+
+def _maxend(right, low, high):
+
+    if low is not None and low.maxend > right:
+        right = low.maxend
+    if high is not None and high.maxend > right:
+        right = high.maxend
+    return right
+
+
+def _treap_copy(node, low, high):
+    """Returns a copy of node with new children"""
+
+    return _TreapNode(node.key, node.feature, node.priority, low, high)
+
+
+def _treap_split(node, key):
+    """Returns (the nodes with keys < key, the rest) as two new treaps"""
+
+    if node is None:
+        return None, None
+    if node.key < key:
+        low, high = _treap_split(node.high, key)
+        return _treap_copy(node, node.low, low), high
+    low, high = _treap_split(node.low, key)
+    return low, _treap_copy(node, high, node.high)
+
+
+def _treap_join(low, high):
+    """Joins two treaps where every key in low is less than those in high"""
+
+    if low is None:
+        return high
+    if high is None:
+        return low
+    if low.priority > high.priority:
+        return _treap_copy(low, low.low, _treap_join(low.high, high))
+    return _treap_copy(high, _treap_join(low, high.low), high.high)
+
+
+def _treap_union(a, b):
+    """Joins two treaps with no keys in common, O(m log(n / m + 1)) for the
+    smaller size m
+
+    """
+
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if a.priority < b.priority:
+        a, b = b, a
+    low, high = _treap_split(b, a.key)
+    return _treap_copy(a, _treap_union(a.low, low), _treap_union(a.high, high))
+
+
+def _treap_remove(node, feature):
+    """Returns the treap without feature. Raises KeyError if it isn't in it."""
+
+    if node is None:
+        raise KeyError(feature)
+
+    coords = (feature.left, feature.right)
+    node_coords = node.key[:2]
+    if coords < node_coords:
+        return _treap_copy(node, _treap_remove(node.low, feature), node.high)
+    if coords > node_coords:
+        return _treap_copy(node, node.low, _treap_remove(node.high, feature))
+    if node.feature == feature:
+        return _treap_join(node.low, node.high)
+
+    # Other features with the same coordinates can be on either side
+    try:
+        return _treap_copy(node, _treap_remove(node.low, feature), node.high)
+    except KeyError:
+        return _treap_copy(node, node.low, _treap_remove(node.high, feature))
+
+
+def _treap_build(items, rand):
+    """Returns a treap of the (key, feature) pairs in items, which must be
+    sorted by key, in O(n)
+
+    """
+
+    # Build the Cartesian tree on the priorities down the right spine...
+    spine = []
+    for key, feature in items:
+        node = _TreapNode(key, feature, rand(), None, None)
+        low = None
+        while spine and spine[-1].priority < node.priority:
+            low = spine.pop()
+        node.low = low
+        if spine:
+            spine[-1].high = node
+        spine.append(node)
+
+    # ...then fill in the maxends, children first
+    def set_maxends(node):
+        if node is not None:
+            set_maxends(node.low)
+            set_maxends(node.high)
+            node.maxend = _maxend(node.key[1], node.low, node.high)
+
+    root = spine[0] if spine else None
+    set_maxends(root)
+    return root
+
+
+def _treap_overlapping(node, left, right, found, enclosing=False):
+    """Appends the features in the treap overlapping (left, right) to found,
+    in order, and returns the number of nodes looked at. Overlap and
+    enclosing work as in _ChromTree.positions().
+
+    """
+
+    if left >= right and not enclosing:
+        return 0
+
+    looked_at = 0
+    while node is not None and node.maxend > left:
+        looked_at += 1 + _treap_overlapping(node.low, left, right, found,
+                                            enclosing)
+        key = node.key
+        if key[0] >= right:
+            break
+        if key[1] > left and (enclosing or key[1] > key[0]):
+            found.append(node.feature)
+        node = node.high
+    return looked_at
+
+
+def _treap_features(node):
+    """Yields the features in the treap in order"""
+
+    stack = []
+    while stack or node is not None:
+        if node is not None:
+            stack.append(node)
+            node = node.low
+        else:
+            node = stack.pop()
+            yield node.feature
+            node = node.high
+
+
+class MutableFeatureIndex(FeatureIndex):
+    """
+    A FeatureIndex that features can be added to and removed from without
+    rebuilding it
+
+    insert() and delete() take O(log n); update() applies a batch, merging
+    added features in as a sorted block. Every query sees the index as it was
+    before or after a whole update. Updates from several threads take turns.
+
+    """
+
+    def __init__(self, feature_list=()):
+
+        # Not FeatureIndex.__init__: there are no _ChromTrees to build, and
+        # _trees is a property here
+
+        self._lock = threading.Lock()
+        self._tiebreak = count()
+        self._random = random.Random().random
+
+        # The published version: ({chrom: treap root}, number of features),
+        # only ever replaced, never changed
+        self._state = ({}, 0)
+
+        # Built on demand from the current version, see _trees and _layout
+        self._tree_cache = {}
+        self._layouts = {}
+
+        self.update(add=feature_list)
+
+    def snapshot(self):
+        """Returns a copy of the index as it is now, in O(1). Updates to
+        either one don't show in the other.
+
+        """
+
+        copy = type(self)()
+        copy._tiebreak = self._tiebreak
+        copy._state = self._state
+        return copy
+
+    def insert(self, feature):
+        """Adds feature to the index"""
+
+        self.update(add=[feature])
+
+    def delete(self, feature):
+        """Removes feature from the index. Raises ValueError if it isn't
+        there.
+
+        """
+
+        self.update(remove=[feature])
+
+    def update(self, add=(), remove=()):
+        """
+        Removes the features in remove, then adds those in add, publishing
+        the result all at once. If any feature to remove isn't in the index,
+        raises ValueError and changes nothing.
+
+        """
+
+        with self._lock:
+            roots, size = self._state
+            roots = dict(roots)
+
+            for feature in remove:
+                chrom = feature.chrom
+                try:
+                    root = _treap_remove(roots.get(chrom), feature)
+                except KeyError:
+                    raise ValueError('{} is not in the index'.format(feature))
+                if root is None:
+                    del roots[chrom]
+                else:
+                    roots[chrom] = root
+                size -= 1
+
+            by_chrom = defaultdict(list)
+            for feature in add:
+                key = (feature.left, feature.right, next(self._tiebreak))
+                by_chrom[feature.chrom].append((key, feature))
+            for chrom, items in by_chrom.iteritems():
+                items.sort(key=itemgetter(0))
+                delta = _treap_build(items, self._random)
+                roots[chrom] = _treap_union(roots.get(chrom), delta)
+                size += len(items)
+
+            self._state = (roots, size)
+
+    def __len__(self):
+        return self._state[1]
+
+    def chroms(self):
+
+        return sorted(self._state[0], key=chromosomes.order_key)
+
+    def features(self, chrom):
+
+        root = self._state[0].get(chromosomes.canonical(chrom))
+        return list(_treap_features(root))
+
+    def overlapping(self, chrom, left, right, instrumentation=None):
+
+        roots = self._state[0]
+        root = roots.get(chrom)
+        if root is None:
+            root = roots.get(chromosomes.canonical(chrom))
+        found = []
+        looked_at = _treap_overlapping(root, left, right, found)
+        if instrumentation is not None:
+            instrumentation.count('comparisons', looked_at)
+        return found
+
+    def _enclosing(self, chrom, left, right):
+
+        root = self._state[0].get(chromosomes.canonical(chrom))
+        found = []
+        _treap_overlapping(root, left, right, found, enclosing=True)
+        return found
+
+    def _cached(self, cache, key, root, build):
+        """Returns build(), or what it returned last time for key if the
+        chromosome's root is still the same
+
+        """
+
+        cached = cache.get(key)
+        if cached is None or cached[0] is not root:
+            cached = cache[key] = (root, build())
+        return cached[1]
+
+    def _layout(self, chrom, strand=None):
+
+        chrom = chromosomes.canonical(chrom)
+        root = self._state[0].get(chrom)
+        if root is None:
+            return None
+
+        def build():
+            features = list(_treap_features(root))
+            if strand is not None:
+                features = [f for f in features
+                            if getattr(f, 'positive_strand', True) == strand]
+            return _SortedLayout(features)
+
+        return self._cached(self._layouts, (chrom, strand), root, build)
+
+    def _pinned(self):
+        """Returns a view of the current version, sharing this index's
+        caches, that later updates don't reach
+
+        """
+
+        state = self._state
+        pinned = object.__new__(type(self))
+        pinned.__dict__.update(self.__dict__)
+        pinned._state = state
+        return pinned
+
+    def nearest(self, chrom, left, right, k=1, direction=None):
+
+        # The overlapping features and the walks either side of them must
+        # all come from one version
+        return super(MutableFeatureIndex, self._pinned()).nearest(
+            chrom, left, right, k, direction)
+
+    def within(self, chrom, left, right, distance, direction=None):
+
+        return super(MutableFeatureIndex, self._pinned()).within(
+            chrom, left, right, distance, direction)
+
+    @property
+    def _trees(self):
+        """A _ChromTree per chromosome of the current version, for the code
+        that works on those directly (find_features_parallel,
+        write_feature_index). Only changed chromosomes are rebuilt.
+
+        """
+
+        trees = {}
+        for chrom, root in self._state[0].iteritems():
+
+            def build():
+                features = list(_treap_features(root))
+                return _ChromTree([f.left for f in features],
+                                  [f.right for f in features], features)
+
+            trees[chrom] = self._cached(self._tree_cache, chrom, root, build)
+        return trees
+
+
+class RegionCluster(Interval):
+    """
+    Regions on one chromosome merged into the interval that covers them all,
+    so they can be searched for once. regions holds the originals, sorted.
+    The name is that of the first region.
+
+    """
+
+    def __init__(self, region):
+
+        Interval.__init__(self, region.chrom, region.left, region.right,
+                          region.name)
+        self.regions = [region]
+
+    def add(self, region):
+
+        self.regions.append(region)
+        if region.right > self.right:
+            self.right = region.right
+
+
+def coalesce_regions(region_list, gap=0):
+    """
+    Returns a sorted list of RegionClusters covering region_list, merging
+    regions on the same chromosome that overlap or are at most gap bases
+    apart. Regions with the same coordinates always share a cluster.
+
+    """
+
+    ranks = chromosomes.ranks
+    clusters = []
+    cluster = None
+    for region in sorted(region_list,
+                         key=lambda i: (ranks[i.chrom_id], i.left, i.right)):
+        if (cluster is not None and region.chrom_id == cluster.chrom_id
+                and region.left <= cluster.right + gap):
+            cluster.add(region)
+        else:
+            cluster = RegionCluster(region)
+            clusters.append(cluster)
+
+    return clusters
+
+
+def _fan_out(cluster, features, found):
+    """Gives each region in cluster the features (sorted, and overlapping
+    the cluster) that it overlaps itself
+
+    """
+
+    if len(cluster.regions) == 1:
+        found[cluster.regions[0]] = features
+        return
+
+    # A sweep over both sorted lists. active holds the features that start
+    # before the furthest region end so far and end after the current
+    # region's left, so a tiled cluster costs about its hits, not
+    # regions x features.
+    active = []
+    remaining = iter(features)
+    feature = next(remaining, None)
+    for region in cluster.regions:
+        while feature is not None and feature.left < region.right:
+            active.append(feature)
+            feature = next(remaining, None)
+        active = [f for f in active if f.right > region.left]
+        if region.right > region.left:
+            found[region] = [f for f in active if f.left < region.right]
+        else:
+            # Zero-length regions overlap nothing, as in overlaps()
+            found[region] = []
+
+
+def find_features(region_list, gene_list=None, instrumentation=None,
+                  coalesce=None):
+    """Returns a dict mapping each Region to the list of features it overlaps
+
+    gene_list can be a list of Features or a FeatureIndex built from one.
+    Passing an index saves rebuilding it when the same genes are searched
+    with several region lists. An Instrumentation, if given, times the
+    "index" and "join" phases and counts regions, hits, comparisons and
+    skips.
+
+    With coalesce set to a gap (0 or more bases), regions that overlap or
+    are that close are searched for together, once per RegionCluster, and
+    the features are then shared out among them. This pays off for dense
+    sets such as tiling array probes; the result is the same. The clusters
+    made are counted as "clusters".
+
+    """
+
+    found = {region : [] for region in region_list}
+
+    if gene_list is None:
+
+        #print "No gene list given"
+        return
+
+    if instrumentation is None:
+        instrumentation = NO_INSTRUMENTATION
+
+    if isinstance(gene_list, FeatureIndex):
+        index = gene_list
+    else:
+        with instrumentation.phase('index'):
+            index = FeatureIndex(gene_list)
+
+    with instrumentation.phase('join'):
+
+        if coalesce is not None:
+            clusters = coalesce_regions(region_list, coalesce)
+            for cluster in clusters:
+                _fan_out(cluster,
+                         index.overlapping(cluster.chrom, cluster.left,
+                                           cluster.right, instrumentation),
+                         found)
+            instrumentation.count('clusters', len(clusters))
+            instrumentation.count('hits', sum(imap(len, found.itervalues())))
+            instrumentation.count('regions', len(region_list))
+            return found
+
+        # For each region
+        for cur_region in region_list:
+
+            # Every overlapping feature goes in that regions' entry in the dict
+            features = index.overlapping(cur_region.chrom, cur_region.left,
+                                         cur_region.right, instrumentation)
+            found[cur_region] = features
+            instrumentation.count('hits', len(features))
+
+        instrumentation.count('regions', len(region_list))
+
+    return found
+
+
+# Set in the parent before a pool is forked for find_features_parallel:
+# ({chrom: _ChromTree}, {chrom: list of regions}), so the workers share the
+# index and the regions instead of being sent copies
+_PARALLEL_JOB = None
+
+
+def _join_chunk(task):
+    """Runs in a worker process: finds the features overlapping the regions
+    start to stop of a chromosome. Returns (offsets, positions), arrays
+    where the positions in the chromosome's tree of the features region
+    start + k overlaps are positions[offsets[k]:offsets[k + 1]].
+
+    The tree and regions are those in _PARALLEL_JOB, unless the task
+    carries its own (starts, ends, (left, right) pairs).
+
+    """
+
+    chrom, start, stop, shipped = task
+    if shipped is None:
+        trees, regions = _PARALLEL_JOB
+        tree = trees[chrom]
+        coords = ((r.left, r.right)
+                  for r in islice(regions[chrom], start, stop))
+    else:
+        starts, ends, coords = shipped
+        tree = _ChromTree(starts, ends)
+
+    positions = array('l')
+    offsets = array('l', [0])
+    find = tree.positions
+    for left, right in coords:
+        positions.extend(find(left, right))
+        offsets.append(len(positions))
+    return offsets, positions
+
+
+@contextmanager
+def _gc_paused():
+    """Turns off the cyclic garbage collector in a with block. Making a
+    great many lists otherwise sets it off over and over, to find nothing.
+
+    """
+
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def find_features_parallel(region_list, gene_list=None, workers=None,
+                           pool=None, chunk_size=None, instrumentation=None):
+    """Returns the same dict as find_features, doing the work in a pool of
+    worker processes
+
+    The regions are split by chromosome (and big chromosomes into chunks of
+    chunk_size regions). The index and the regions are shared with the
+    workers by forking, so a task is just a chromosome and a range of its
+    regions, and a worker sends back two arrays of positions. workers
+    defaults to the number of CPUs.
+
+    An existing multiprocessing Pool can be passed in to save starting a new
+    one; it is left running. Its workers were forked before this call, so
+    each of their tasks carries the coordinates of its chromosome's features
+    and regions instead. An Instrumentation, if given, times the "index"
+    and "join" phases and counts regions and hits.
+
+    """
+
+    global _PARALLEL_JOB
+
+    if gene_list is None:
+        return
+
+    if instrumentation is None:
+        instrumentation = NO_INSTRUMENTATION
+
+    if isinstance(gene_list, FeatureIndex):
+        index = gene_list
+    else:
+        with instrumentation.phase('index'):
+            index = FeatureIndex(gene_list)
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if chunk_size is None:
+        chunk_size = max(1, len(region_list) // (workers * 4))
+
+    with instrumentation.phase('join'), _gc_paused():
+
+        by_chrom = defaultdict(list)
+        for region in region_list:
+            by_chrom[region.chrom].append(region)
+
+        # The result is built here, so it doesn't have to be made empty
+        # first and then filled
+        found = {}
+        all_trees = index._trees
+        trees = {}
+        for chrom, regions in by_chrom.iteritems():
+            tree = all_trees.get(chrom)
+            if tree is None:
+                found.update(izip(regions, ([] for r in regions)))
+            else:
+                trees[chrom] = tree
+
+        # Splitting big chromosomes keeps the workers evenly loaded
+        chunks = [(chrom, i, min(i + chunk_size, len(by_chrom[chrom])))
+                  for chrom in trees
+                  for i in xrange(0, len(by_chrom[chrom]), chunk_size)]
+
+        if pool is not None:
+            tasks = [(chrom, 0, stop - start,
+                      (array('l', trees[chrom].starts),
+                       array('l', trees[chrom].ends),
+                       [(r.left, r.right)
+                        for r in by_chrom[chrom][start:stop]]))
+                     for chrom, start, stop in chunks]
+            results = pool.imap(_join_chunk, tasks)
+        else:
+            tasks = [(chrom, start, stop, None)
+                     for chrom, start, stop in chunks]
+            _PARALLEL_JOB = (trees, by_chrom)
+            try:
+                if workers <= 1 or len(tasks) <= 1:
+                    results = map(_join_chunk, tasks)
+                else:
+                    new_pool = multiprocessing.Pool(workers)
+                    try:
+                        results = new_pool.map(_join_chunk, tasks)
+                    finally:
+                        new_pool.close()
+                        new_pool.join()
+            finally:
+                _PARALLEL_JOB = None
+
+        # Put the features in place of their positions, keeping the order
+        hits = 0
+        for (chrom, start, stop), (offsets, positions) in izip(chunks,
+                                                               results):
+            features = map(trees[chrom].features.__getitem__, positions)
+            found.update(izip(
+                islice(by_chrom[chrom], start, stop),
+                [features[offsets[k]:offsets[k + 1]]
+                 for k in xrange(stop - start)]))
+            hits += len(positions)
+
+        instrumentation.count('regions', len(region_list))
+        instrumentation.count('hits', hits)
+
+    return found
+
+
+# How a Region overlaps one Gene: the bases it shares with the Gene's exons
+# and introns, and the Exons it hits (in the order sort_intervals gives)
+ExonOverlap = namedtuple('ExonOverlap', 'gene exonic intronic exons')
+
+
+def create_exon_list(gene_list):
+    """
+    Creates and returns a sorted list of the Exons of all the given Genes.
+
+    """
+
+    exons = []
+    for gene in gene_list:
+        gene_exons = gene.exons
+        for i, (left, right) in enumerate(gene_exons):
+            if gene.positive_strand:
+                number = i + 1
+            else:
+                number = len(gene_exons) - i
+            exons.append(Exon(gene, number, left, right))
+
+    sort_intervals(exons)
+
+    return exons
+
+
+class ExonIndex(FeatureIndex):
+    """A FeatureIndex over the exons of a set of Genes, which also knows the
+    whole Genes, so it can split an overlap into exonic and intronic bases
+
+    """
+
+    def __init__(self, gene_list):
+
+        if isinstance(gene_list, FeatureIndex):
+            self.genes = gene_list
+            gene_list = [gene for chrom in gene_list.chroms()
+                         for gene in gene_list.features(chrom)]
+        else:
+            self.genes = FeatureIndex(gene_list)
+
+        super(ExonIndex, self).__init__(create_exon_list(gene_list))
+
+    def exon_overlaps(self, chrom, left, right, instrumentation=None):
+        """Returns an ExonOverlap for each Gene overlapping (chrom, left,
+        right), in sorted Gene order
+
+        Bases are counted as in overlaps(), with the right end not included
+        (as in UCSC files). An Instrumentation, if given, counts the work of
+        the Gene lookup only, so each region is counted once.
+
+        """
+
+        genes = self.genes.overlapping(chrom, left, right, instrumentation)
+        if not genes:
+            return []
+
+        exons_hit = defaultdict(list)
+        for exon in self.overlapping(chrom, left, right):
+            exons_hit[exon.gene].append(exon)
+
+        found = []
+        for gene in genes:
+            exons = exons_hit.get(gene, [])
+            exonic = sum(min(right, exon.right) - max(left, exon.left)
+                         for exon in exons)
+            spanned = min(right, gene.right) - max(left, gene.left)
+            found.append(ExonOverlap(gene, exonic, spanned - exonic, exons))
+
+        return found
+
+
+def find_exon_overlaps(region_list, gene_list=None, instrumentation=None):
+    """Returns a dict mapping each Region to a list of ExonOverlaps, one for
+    each Gene it overlaps
+
+    gene_list can be a list of Genes or an ExonIndex built from one. An
+    Instrumentation, if given, times the "index" and "join" phases and
+    counts regions, hits (Genes overlapped), and the comparisons and skips
+    of the Gene lookups.
+
+    """
+
+    found = {region : [] for region in region_list}
+
+    if gene_list is None:
+        return
+
+    if instrumentation is None:
+        instrumentation = NO_INSTRUMENTATION
+
+    if isinstance(gene_list, ExonIndex):
+        index = gene_list
+    else:
+        with instrumentation.phase('index'):
+            index = ExonIndex(gene_list)
+
+    with instrumentation.phase('join'):
+
+        for cur_region in region_list:
+            overlaps = index.exon_overlaps(cur_region.chrom, cur_region.left,
+                                           cur_region.right, instrumentation)
+            found[cur_region] = overlaps
+            instrumentation.count('hits', len(overlaps))
+
+        instrumentation.count('regions', len(region_list))
+
+    return found
+
+
+def transcription_start(gene):
+    """Returns the position of the Gene's TSS: txStart on the + strand,
+    txEnd on the - strand (features without a strand count as +)
+
+    """
+
+    if getattr(gene, 'positive_strand', True):
+        return gene.left
+    return gene.right
+
+
+def flank_bounds(gene, upstream, downstream=0):
+    """Returns (left, right) of the window from upstream bases upstream of
+    the Gene's TSS to downstream bases downstream of it, following the
+    Gene's strand. The window never starts before 0.
+
+    """
+
+    tss = transcription_start(gene)
+    if getattr(gene, 'positive_strand', True):
+        return max(0, tss - upstream), tss + downstream
+    return max(0, tss - downstream), tss + upstream
+
+
+class Flank(object):
+    """A window around a Gene's TSS, as returned by FlankIndex queries
+
+    It has the Feature fields, taking all but left and right from its gene,
+    so the found windows can be used like the Genes themselves.
+
+    """
+
+    __slots__ = ('gene', 'left', 'right')
+
+    def __init__(self, gene, left, right):
+
+        self.gene = gene
+        self.left = left
+        self.right = right
+
+    @property
+    def chrom(self):
+        return self.gene.chrom
+
+    @property
+    def chrom_id(self):
+        return self.gene.chrom_id
+
+    @property
+    def name(self):
+        return self.gene.name
+
+    @property
+    def positive_strand(self):
+        return getattr(self.gene, 'positive_strand', True)
+
+    @property
+    def strand(self):
+        return getattr(self.gene, 'strand', None)
+
+    @property
+    def refseq(self):
+        return getattr(self.gene, 'refseq', None)
+
+    @property
+    def tss(self):
+        return transcription_start(self.gene)
+
+    def __eq__(self, other):
+        return (type(other) is type(self) and other.gene == self.gene and
+                other.left == self.left and other.right == self.right)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.gene, self.left, self.right))
+
+    def __str__(self):
+        return "{} {} @ {} ({},{})".format(type(self).__name__, self.name,
+                                            self.chrom, self.left, self.right)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class _FlankRows(object):
+    """The windows of one chromosome's genes, as a read-only sequence of
+    Flanks made only when they are asked for
+
+    """
+
+    def __init__(self, genes, lefts, rights):
+
+        self._genes = genes
+        self._lefts = lefts
+        self._rights = rights
+
+    def __len__(self):
+        return len(self._genes)
+
+    def __getitem__(self, i):
+
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(len(self)))]
+        return Flank(self._genes[i], self._lefts[i], self._rights[i])
+
+    def __iter__(self):
+
+        for gene, left, right in izip(self._genes, self._lefts, self._rights):
+            yield Flank(gene, left, right)
+
+
+class FlankIndex(object):
+    """
+    Indexes the windows around the TSSs of the Genes in gene_list (a list
+    of Genes or a FeatureIndex of them), e.g. promoters
+
+    window(upstream, downstream) returns a FeatureIndex of the Flanks for
+    that window size, built the first time each size is asked for and kept.
+    Each strand's genes are kept sorted by TSS, so a window's flanks come
+    out sorted by merging the two strands, with no sort per size.
+
+    """
+
+    def __init__(self, gene_list):
+
+        if isinstance(gene_list, FeatureIndex):
+            by_chrom = dict((chrom, gene_list.features(chrom))
+                            for chrom in gene_list.chroms())
+        else:
+            by_chrom = defaultdict(list)
+            for gene in gene_list:
+                by_chrom[gene.chrom].append(gene)
+
+        # chrom -> ((TSSs, genes) on +, (TSSs, genes) on -), sorted by TSS
+        self._strands = {}
+        for chrom, genes in by_chrom.iteritems():
+            strands = []
+            for positive in (True, False):
+                pairs = sorted(((transcription_start(g), i) for i, g
+                                in enumerate(genes)
+                                if getattr(g, 'positive_strand', True)
+                                == positive))
+                strands.append((array('l', (tss for tss, i in pairs)),
+                                [genes[i] for tss, i in pairs]))
+            self._strands[chrom] = strands
+
+        self._windows = {}
+
+    def window(self, upstream, downstream=0):
+        """Returns a FeatureIndex of the Flanks from upstream bases upstream
+        to downstream bases downstream of each TSS (see flank_bounds)
+
+        """
+
+        key = (upstream, downstream)
+        index = self._windows.get(key)
+        if index is None:
+            index = self._windows[key] = self._build(upstream, downstream)
+        return index
+
+    def _build(self, upstream, downstream):
+
+        index = FeatureIndex()
+        for chrom, (plus, minus) in self._strands.iteritems():
+
+            # Left and right both grow with the TSS on each strand, so each
+            # strand's windows are already in (left, right) order. Ties go
+            # + strand first, then by TSS order, never comparing genes.
+            plus_windows = ((max(0, tss - upstream), tss + downstream, 0, i,
+                             gene)
+                            for i, (tss, gene) in enumerate(izip(*plus)))
+            minus_windows = ((max(0, tss - downstream), tss + upstream, 1, i,
+                              gene)
+                             for i, (tss, gene) in enumerate(izip(*minus)))
+
+            lefts, rights, genes = array('l'), array('l'), []
+            for left, right, _, _, gene in merge(plus_windows,
+                                                 minus_windows):
+                lefts.append(left)
+                rights.append(right)
+                genes.append(gene)
+
+            index._trees[chrom] = _ChromTree(lefts, rights,
+                                             _FlankRows(genes, lefts, rights))
+        return index
+
+    def overlapping(self, chrom, left, right, upstream, downstream=0,
+                    instrumentation=None):
+        """Returns the sorted list of Flanks of the given window size
+        overlapping (chrom, left, right)
+
+        """
+
+        return self.window(upstream, downstream).overlapping(
+            chrom, left, right, instrumentation)
+
+
+def find_promoters(region_list, gene_list, upstream, downstream=0,
+                   instrumentation=None):
+    """
+    Returns a dict mapping each Region to the list of Flanks of the Genes
+    whose promoters (upstream bases before to downstream bases after the
+    TSS) it overlaps. gene_list may be a FlankIndex, to reuse its windows.
+
+    """
+
+    if not isinstance(gene_list, FlankIndex):
+        gene_list = FlankIndex(gene_list)
+
+    return find_features(region_list, gene_list.window(upstream, downstream),
+                         instrumentation)
+
+
+# Feature density
+#
+# How many features fall in a window, and how many of its bases they cover,
+# answered from per-chromosome sorted starts and ends with prefix sums
+# instead of a search per window. For a position x, with the features'
+# starts and ends sorted,
+#
+#   bases before x = sum over features of their length left of x
+#                  = (starts < x) * x - sum(starts < x)
+#                    - ((ends < x) * x - sum(ends < x))
+#
+# so a window (left, right) holds bases(right) - bases(left) feature bases,
+# and overlaps (starts < right) - (ends <= left) features: two bisects per
+# end. Bins are done with one pass over the sorted lists instead.
+
+# What a density query returns: the features overlapping the window, the
+# bases of those features inside it (a base covered twice counts twice),
+# and the bases covered by at least one feature
+Density = namedtuple('Density', 'count bases covered')
+
+
+def _prefix_sums(values):
+    """Returns [0, values[0], values[0] + values[1], ...]"""
+
+    sums = [0]
+    total = 0
+    for value in values:
+        total += value
+        sums.append(total)
+    return sums
+
+
+def _below(values, bounds, include_equal=False):
+    """Returns, for each bound (ascending), how many of the sorted values are
+    below it (or equal to it too, if include_equal), in one pass
+
+    """
+
+    compare = le if include_equal else lt
+    counts = []
+    i = 0
+    n = len(values)
+    for bound in bounds:
+        while i < n and compare(values[i], bound):
+            i += 1
+        counts.append(i)
+    return counts
+
+
+class _ChromDensity(object):
+    """The sorted starts and ends of the features on one chromosome, and of
+    the disjoint blocks they cover, with their prefix sums
+
+    """
+
+    def __init__(self, features):
+
+        # Empty features overlap nothing, as in overlaps()
+        features = [f for f in features if f.right > f.left]
+        self.starts = sorted(f.left for f in features)
+        self.ends = sorted(f.right for f in features)
+        self.start_sums = _prefix_sums(self.starts)
+        self.end_sums = _prefix_sums(self.ends)
+
+        # The union of the features, as sorted disjoint blocks
+        blocks = []
+        for left, right in sorted((f.left, f.right) for f in features):
+            if blocks and left <= blocks[-1][1]:
+                if right > blocks[-1][1]:
+                    blocks[-1][1] = right
+            else:
+                blocks.append([left, right])
+        self.block_starts = [left for left, right in blocks]
+        self.block_ends = [right for left, right in blocks]
+        self.block_start_sums = _prefix_sums(self.block_starts)
+        self.block_end_sums = _prefix_sums(self.block_ends)
+
+        self.length = self.ends[-1] if self.ends else 0
+
+    @staticmethod
+    def _bases_before(x, starts_below, start_sums, ends_below, end_sums):
+
+        return (starts_below * x - start_sums[starts_below]
+                - (ends_below * x - end_sums[ends_below]))
+
+    def bases_before(self, x):
+        """Returns (feature bases, covered bases) left of x"""
+
+        bases = self._bases_before(x, bisect_left(self.starts, x),
+                                   self.start_sums,
+                                   bisect_left(self.ends, x), self.end_sums)
+        covered = self._bases_before(x, bisect_left(self.block_starts, x),
+                                     self.block_start_sums,
+                                     bisect_left(self.block_ends, x),
+                                     self.block_end_sums)
+        return bases, covered
+
+    def query(self, left, right):
+
+        if right <= left:
+            return Density(0, 0, 0)
+        count = (bisect_left(self.starts, right)
+                 - bisect_right(self.ends, left))
+        bases_left, covered_left = self.bases_before(left)
+        bases_right, covered_right = self.bases_before(right)
+        return Density(count, bases_right - bases_left,
+                       covered_right - covered_left)
+
+    def bins(self, bounds):
+        """Returns a Density for each window between consecutive bounds
+        (ascending), with one pass over the sorted lists
+
+        """
+
+        starts_below = _below(self.starts, bounds)
+        ends_below = _below(self.ends, bounds)
+        ends_at = _below(self.ends, bounds, include_equal=True)
+        blocks_below = _below(self.block_starts, bounds)
+        block_ends_below = _below(self.block_ends, bounds)
+
+        before = self._bases_before
+        bases = [before(x, s, self.start_sums, e, self.end_sums)
+                 for x, s, e in izip(bounds, starts_below, ends_below)]
+        covered = [before(x, s, self.block_start_sums, e,
+                          self.block_end_sums)
+                   for x, s, e in izip(bounds, blocks_below,
+                                       block_ends_below)]
+
+        return [Density(starts_below[k + 1] - ends_at[k],
+                        bases[k + 1] - bases[k],
+                        covered[k + 1] - covered[k])
+                for k in xrange(len(bounds) - 1)]
+
+
+class FeatureDensity(object):
+    """
+    Counts the features of gene_list (a list of any features, e.g. Genes or
+    Exons, or a FeatureIndex of them) in windows, for normalising region
+    hits
+
+    Each query takes a few bisects (O(log n)) whatever the window size, and
+    bins() does a whole chromosome in one pass, so nothing is searched for
+    window by window. Overlap means the same as in overlaps().
+
+    """
+
+    def __init__(self, gene_list):
+
+        if isinstance(gene_list, FeatureIndex):
+            by_chrom = dict((chrom, gene_list.features(chrom))
+                            for chrom in gene_list.chroms())
+        else:
+            by_chrom = defaultdict(list)
+            for gene in gene_list:
+                by_chrom[gene.chrom].append(gene)
+
+        self._chroms = dict((chrom, _ChromDensity(features))
+                            for chrom, features in by_chrom.iteritems())
+
+    def chroms(self):
+        """Returns the chromosomes that have features, in chromosomes
+        order
+
+        """
+
+        return sorted(self._chroms, key=chromosomes.order_key)
+
+    def query(self, chrom, left, right):
+        """Returns the Density of the window (chrom, left, right)"""
+
+        density = self._chroms.get(chromosomes.canonical(chrom))
+        if density is None:
+            return Density(0, 0, 0)
+        return density.query(left, right)
+
+    def count(self, chrom, left, right):
+        """Returns how many features overlap (chrom, left, right)"""
+
+        return self.query(chrom, left, right).count
+
+    def regions(self, region_list):
+        """Returns a dict mapping each Region to its Density"""
+
+        return dict((region, self.query(region.chrom, region.left,
+                                        region.right))
+                    for region in region_list)
+
+    def bins(self, bin_size, lengths=None):
+        """
+        Yields (chrom, left, right, Density) for every bin_size window of
+        every chromosome with features, in order. lengths maps chromosomes
+        to their lengths (e.g. from a .chrom.sizes file); a chromosome not in
+        it is taken to end at its last feature. The last bin of a
+        chromosome is cut short at its end.
+
+        """
+
+        if bin_size <= 0:
+            raise ValueError('bin_size must be positive')
+        lengths = dict((chromosomes.canonical(chrom), length)
+                       for chrom, length in (lengths or {}).iteritems())
+
+        for chrom in self.chroms():
+            density = self._chroms[chrom]
+            length = lengths.get(chrom, density.length)
+            bounds = range(0, length, bin_size) + [length]
+            for left, right, window in izip(bounds, bounds[1:],
+                                            density.bins(bounds)):
+                yield chrom, left, right, window
+
+
+def annotate_tracks(region_list, tracks, instrumentation=None):
+    """Returns a dict mapping each Region to a dict of track name -> list of
+    the features from that track it overlaps
+
+    tracks maps a name to a list of features or a FeatureIndex, e.g.
+    {'genes': gene_list, 'cpg': cpg_list, 'enhancers': enhancer_index}.
+    Every track is indexed first, then the regions are gone through once,
+    each one looked up in all the tracks. An Instrumentation, if given,
+    times the "index" and "join" phases and counts regions and hits.
+
+    """
+
+    if instrumentation is None:
+        instrumentation = NO_INSTRUMENTATION
+
+    indexes = []
+    with instrumentation.phase('index'):
+        for name, features in sorted(tracks.iteritems()):
+            if not isinstance(features, FeatureIndex):
+                features = FeatureIndex(features)
+            indexes.append((name, features))
+
+    found = {}
+    with instrumentation.phase('join'):
+
+        for cur_region in region_list:
+
+            chrom = cur_region.chrom
+            left = cur_region.left
+            right = cur_region.right
+
+            region_found = found[cur_region] = {}
+            for name, index in indexes:
+                features = index.overlapping(chrom, left, right,
+                                             instrumentation)
+                region_found[name] = features
+                instrumentation.count('hits', len(features))
+
+        instrumentation.count('regions', len(region_list))
+
+    return found
+
+
+# Batch pair computations
+#
+# These work on aligned columns: element i of region_lefts, region_rights,
+# feature_lefts and feature_rights describes the i-th (region, feature)
+# pair, e.g. as made by pair_coordinates from find_features' result. The
+# pairs are taken to be on the same chromosome. With NumPy the columns may
+# be NumPy arrays, array.arrays or lists and the results are NumPy arrays;
+# without it the results are array.arrays, computed by chaining C builtins
+# through imap so no Python code runs per pair.
+
+# containment() flags
+FEATURE_IN_REGION = 1
+REGION_IN_FEATURE = 2
+
+
+def _numpy_column(column):
+
+    if isinstance(column, array):
+        if not column:
+            return numpy.zeros(0, dtype=column.typecode)
+        # Shares the array's memory rather than copying it
+        return numpy.frombuffer(column, dtype=column.typecode)
+    return numpy.asarray(column)
+
+
+def pair_coordinates(found):
+    """
+    Returns (pairs, region_lefts, region_rights, feature_lefts,
+    feature_rights) for every (region, feature) pair in found, a dict from
+    find_features or an iterable of (region, list of features) like
+    sweep_features yields. The coordinates are array('l') columns in the
+    order of pairs.
+
+    """
+
+    if isinstance(found, dict):
+        found = found.iteritems()
+
+    pairs = []
+    region_lefts, region_rights = array('l'), array('l')
+    feature_lefts, feature_rights = array('l'), array('l')
+    for region, features in found:
+        for feature in features:
+            pairs.append((region, feature))
+            region_lefts.append(region.left)
+            region_rights.append(region.right)
+            feature_lefts.append(feature.left)
+            feature_rights.append(feature.right)
+
+    return pairs, region_lefts, region_rights, feature_lefts, feature_rights
+
+
+def overlap_lengths(region_lefts, region_rights, feature_lefts,
+                    feature_rights):
+    """Returns the number of bases each pair has in common (0 if none)
+
+    Counts the way overlaps() does, so a pair that only touches has 0;
+    get_overlap counts one more base for every pair.
+
+    """
+
+    if numpy is not None:
+        lengths = (numpy.minimum(_numpy_column(region_rights),
+                                 _numpy_column(feature_rights))
+                   - numpy.maximum(_numpy_column(region_lefts),
+                                   _numpy_column(feature_lefts)))
+        return numpy.maximum(lengths, 0)
+
+    lengths = imap(sub, imap(min, region_rights, feature_rights),
+                   imap(max, region_lefts, feature_lefts))
+    return array('l', imap(max, repeat(0), lengths))
+
+
+def signed_distances(region_lefts, region_rights, feature_lefts,
+                     feature_rights):
+    """
+    Returns the distance from each region to its feature: positive when the
+    feature is after the region, negative when it is before, 0 when they
+    overlap or touch. The sign is by position, not strand.
+
+    """
+
+    if numpy is not None:
+        after = (_numpy_column(feature_lefts)
+                 - _numpy_column(region_rights)).clip(min=0)
+        before = (_numpy_column(feature_rights)
+                  - _numpy_column(region_lefts)).clip(max=0)
+        return after + before
+
+    after = imap(max, repeat(0), imap(sub, feature_lefts, region_rights))
+    before = imap(min, repeat(0), imap(sub, feature_rights, region_lefts))
+    return array('l', imap(add, after, before))
+
+
+def containment(region_lefts, region_rights, feature_lefts, feature_rights):
+    """
+    Returns flags for each pair: FEATURE_IN_REGION if the feature lies
+    entirely within the region, REGION_IN_FEATURE if the region lies
+    entirely within the feature, both if they are the same and 0 otherwise
+
+    """
+
+    if numpy is not None:
+        region_lefts = _numpy_column(region_lefts)
+        region_rights = _numpy_column(region_rights)
+        feature_lefts = _numpy_column(feature_lefts)
+        feature_rights = _numpy_column(feature_rights)
+        feature_in = ((feature_lefts >= region_lefts)
+                      & (feature_rights <= region_rights))
+        region_in = ((region_lefts >= feature_lefts)
+                     & (region_rights <= feature_rights))
+        return (feature_in * FEATURE_IN_REGION
+                + region_in * REGION_IN_FEATURE).astype(numpy.int8)
+
+    feature_in = imap(and_, imap(ge, feature_lefts, region_lefts),
+                      imap(le, feature_rights, region_rights))
+    region_in = imap(and_, imap(ge, region_lefts, feature_lefts),
+                     imap(le, region_rights, feature_rights))
+    return array('b', imap(add, imap(mul, feature_in,
+                                     repeat(FEATURE_IN_REGION)),
+                           imap(mul, region_in, repeat(REGION_IN_FEATURE))))
+
+
+# Intervals held in memory per sorted run by external_sort
+DEFAULT_RUN_SIZE = 500000
+
+# Intervals pickled together when a run is written to disk
+_RUN_BLOCK_SIZE = 4096
+
+
+def _write_run(intervals, tmp_dir):
+    """Writes the (already sorted) intervals to a temporary file in blocks
+    and returns the file, rewound
+
+    """
+
+    run = tempfile.TemporaryFile(dir=tmp_dir)
+    for i in xrange(0, len(intervals), _RUN_BLOCK_SIZE):
+        pickle.dump(intervals[i:i + _RUN_BLOCK_SIZE], run,
+                    pickle.HIGHEST_PROTOCOL)
+    run.seek(0)
+    return run
+
+
+def _read_run(run, run_number):
+    """Yields (key, run number, position, interval) for each interval in a
+    run file, so runs can be merged without comparing the intervals
+    themselves
+
+    """
+
+    # Ranks can change while the runs are merged (the other input of a
+    # sweep may bring new chromosomes), so the keys use order_key instead
+    order_key = chromosomes.order_key
+    position = 0
+    while True:
+        try:
+            block = pickle.load(run)
+        except EOFError:
+            return
+        for interval in block:
+            key = (order_key(interval.chrom), interval.left, interval.right)
+            yield key, run_number, position, interval
+            position += 1
+
+
+def external_sort(intervals, run_size=DEFAULT_RUN_SIZE, tmp_dir=None):
+    """Yields the given intervals (any iterable) in sort_intervals order,
+    holding no more than run_size of them in memory at once
+
+    Each run_size chunk is sorted and written to a temporary file in tmp_dir
+    (the system default if None), then the runs are merged. Input that fits
+    in one run is sorted in memory and never touches the disk. Equal
+    intervals keep their input order.
+
+    """
+
+    intervals = iter(intervals)
+    runs = []
+    try:
+        chunk = list(islice(intervals, run_size))
+        sort_intervals(chunk)
+        while len(chunk) == run_size:
+            runs.append(_write_run(chunk, tmp_dir))
+            chunk = list(islice(intervals, run_size))
+            sort_intervals(chunk)
+
+        if not runs:
+            for interval in chunk:
+                yield interval
+            return
+
+        if chunk:
+            runs.append(_write_run(chunk, tmp_dir))
+        del chunk
+
+        streams = [_read_run(run, i) for i, run in enumerate(runs)]
+        for key, run_number, position, interval in merge(*streams):
+            yield interval
+
+    finally:
+        # Temporary files are deleted when closed
+        for run in runs:
+            run.close()
+
+
+def sweep_features(region_iter, gene_iter):
+    """Yields (region, list of overlapping features) for each region, in
+    order, without reading either input into memory
+
+    Both inputs must already be in sort_intervals order (see external_sort).
+    Only the features that might still overlap a later region are held, so
+    memory depends on how many features overlap at once, not on the size of
+    the inputs. The features for each region come out in the same order
+    find_features gives.
+
+    """
+
+    gene_iter = iter(gene_iter)
+    pending = next(gene_iter, None)  # The next feature not yet active
+    active = []  # Features that started before some region's right end
+    chrom_id = None
+
+    for region in region_iter:
+
+        if region.chrom_id != chrom_id:
+            chrom_id = region.chrom_id
+            active = []
+            # Skip features on chromosomes no region is on. ranks is read
+            # each time, as new chromosomes turn up in either input.
+            while (pending is not None and
+                   chromosomes.ranks[pending.chrom_id]
+                   < chromosomes.ranks[chrom_id]):
+                pending = next(gene_iter, None)
+
+        # Pick up the features starting before the end of the region.
+        # Zero-length ones overlap nothing (as in overlaps()), so they are
+        # passed over.
+        while (pending is not None and pending.chrom_id == chrom_id and
+               pending.left < region.right):
+            if pending.right > pending.left:
+                active.append(pending)
+            pending = next(gene_iter, None)
+
+        # Regions are sorted by left, so features ending before this one
+        # starts can't overlap any of the ones that follow
+        left = region.left
+        active = [f for f in active if f.right > left]
+
+        right = region.right
+        if right > left:
+            yield region, [f for f in active if f.left < right]
+        else:
+            yield region, []
+
+
+def stream_find_features(region_fp, gene_fp, run_size=DEFAULT_RUN_SIZE,
+                         tmp_dir=None):
+    """Yields (region, list of overlapping features) for each Region in the
+    region file, in sorted order, for files too big to load into memory
+
+    Both files are sorted with external_sort and joined with sweep_features,
+    so no more than run_size intervals from each are held in memory.
+
+    """
+
+    regions = external_sort(iter_regions(region_fp), run_size, tmp_dir)
+    genes = external_sort(iter_genes(gene_fp), run_size, tmp_dir)
+
+    return sweep_features(regions, genes)
+
+
+# Result writer
+#
+# Writes join results as one row per (region, feature) pair, as tab or
+# comma separated text that opens in Excel. Rows are gathered in memory and
+# written in large chunks, files are split before they pass Excel's row
+# limit, and output can be gzipped. Nothing but the current chunk is held,
+# so results can be written as a sweep produces them.
+
+# Rows in an Excel sheet, counting the header
+EXCEL_MAX_ROWS = 1048576
+
+
+def _overlap_bases(region, feature):
+
+    return max(0, min(region.right, feature.right)
+                  - max(region.left, feature.left))
+
+
+# The columns ResultWriter can write, as (header, value of (region, feature))
+RESULT_COLUMNS = {
+    'Chromosome': lambda region, feature: region.chrom,
+    'StartPosition': lambda region, feature: region.left,
+    'EndPosition': lambda region, feature: region.right,
+    'RegionName': lambda region, feature: region.name,
+    'geneSymbol': lambda region, feature: feature.name,
+    'refseq': lambda region, feature: getattr(feature, 'refseq', ''),
+    'strand': lambda region, feature: getattr(feature, 'strand', '') or '',
+    'featureStart': lambda region, feature: feature.left,
+    'featureEnd': lambda region, feature: feature.right,
+    'overlap': _overlap_bases,
+    'distance': lambda region, feature: get_distance(feature, region),
+}
+
+# The RESULT_COLUMNS that describe the feature, left empty for a region
+# nothing was found for
+_FEATURE_RESULT_COLUMNS = frozenset(['geneSymbol', 'refseq', 'strand',
+                                     'featureStart', 'featureEnd', 'overlap',
+                                     'distance'])
+
+DEFAULT_RESULT_COLUMNS = ('Chromosome', 'StartPosition', 'EndPosition',
+                          'RegionName', 'geneSymbol', 'refseq', 'strand',
+                          'overlap')
+
+
+def extra_result_columns(columns):
+    """Returns the columns that aren't RESULT_COLUMNS, which ResultWriter
+    takes from the regions' extras (so they must be loaded with them)
+
+    """
+
+    return tuple(c for c in columns if c not in RESULT_COLUMNS)
+
+
+class ResultWriter(object):
+    """
+    Writes results to filename, as TSV or (with dialect "csv") CSV, with the
+    given columns: names from RESULT_COLUMNS, or region file columns kept
+    in Region.extras (e.g. "Score"). An Instrumentation, if given, times
+    write_all() and close() as the "output" phase and counts "output rows".
+
+    Once a file has max_rows rows (the header included) the rest go to
+    filename with _2, _3, ... before its extension; None means no limit.
+    Output is gzipped if compress is True or filename ends in .gz. Each file
+    is written under a temporary name and renamed when it is complete. Used
+    in a with block that raises, it removes every file it wrote, so a
+    failed run leaves no output that looks complete.
+
+    """
+
+    def __init__(self, filename, columns=DEFAULT_RESULT_COLUMNS,
+                 dialect='tsv', max_rows=EXCEL_MAX_ROWS, compress=False,
+                 buffer_rows=10000, instrumentation=None):
+
+        if dialect not in ('tsv', 'csv'):
+            raise ValueError('dialect must be "tsv" or "csv", not {!r}'.format(
+                dialect))
+        if max_rows is not None and max_rows < 2:
+            # Each file needs room for its header and at least one row
+            raise ValueError('max_rows must be at least 2 or None, not '
+                             '{!r}'.format(max_rows))
+
+        self.filename = filename
+        self.columns = tuple(columns)
+        self.max_rows = max_rows
+        self.compress = compress or filename.endswith('.gz')
+        self.buffer_rows = buffer_rows
+        self.filenames = []  # The files finished so far
+        self.rows = 0  # Data rows written, over all files
+        if instrumentation is None:
+            instrumentation = NO_INSTRUMENTATION
+        self.instrumentation = instrumentation
+
+        # (position, getter) for the region's columns and the feature's
+        self._region_getters = []
+        self._feature_getters = []
+        for i, column in enumerate(self.columns):
+            getter = RESULT_COLUMNS.get(column)
+            if getter is None:
+                getter = self._extra_getter(column)
+            if column in _FEATURE_RESULT_COLUMNS:
+                self._feature_getters.append((i, getter))
+            else:
+                self._region_getters.append((i, getter))
+
+        # The csv module quotes fields that need it; its rows are gathered
+        # in _chunk and written out together
+        self._chunk = []
+        delimiter = ',' if dialect == 'csv' else '\t'
+        self._writer = csv.writer(_ChunkFile(self._chunk),
+                                  delimiter=delimiter, lineterminator='\n')
+
+        self._fp = None
+        self._file_rows = 0
+
+    @staticmethod
+    def _extra_getter(column):
+
+        def get_extra(region, feature):
+            extras = region.extras
+            if extras is None:
+                return ''
+            return extras.get(column, '')
+
+        return get_extra
+
+    def _part_filename(self, part):
+
+        if part == 1:
+            return self.filename
+        base, gz = self.filename, ''
+        if base.endswith('.gz'):
+            base, gz = base[:-3], '.gz'
+        base, extension = os.path.splitext(base)
+        return '{}_{}{}{}'.format(base, part, extension, gz)
+
+    def _open_next(self):
+
+        self._close_file()
+        filename = self._part_filename(len(self.filenames) + 1)
+        tmp_filename = filename + '.tmp'
+        if self.compress:
+            fp = gzip.open(tmp_filename, 'wb')
+        else:
+            fp = open(tmp_filename, 'wb')
+        self._fp = (fp, tmp_filename, filename)
+        self._writer.writerow(self.columns)
+        self._file_rows = 1
+
+    def _flush(self):
+
+        if self._chunk:
+            self._fp[0].write(''.join(self._chunk))
+            del self._chunk[:]
+
+    def _close_file(self):
+
+        if self._fp is not None:
+            self._flush()
+            fp, tmp_filename, filename = self._fp
+            fp.close()
+            os.rename(tmp_filename, filename)
+            self.filenames.append(filename)
+            self._fp = None
+
+    def _write_rows(self, rows):
+
+        while rows:
+            if (self._fp is None or self.max_rows is not None and
+                    self._file_rows >= self.max_rows):
+                self._open_next()
+
+            if self.max_rows is not None:
+                room = self.max_rows - self._file_rows
+                rows, rest = rows[:room], rows[room:]
+            else:
+                rest = None
+
+            self._writer.writerows(rows)
+            self._file_rows += len(rows)
+            self.rows += len(rows)
+            rows = rest
+
+        if len(self._chunk) >= self.buffer_rows:
+            self._flush()
+
+    def write(self, region, features, include_empty=True):
+        """Writes a row for each of the features found for region, or one
+        with the feature columns empty if there are none and include_empty
+        is True
+
+        """
+
+        # The region's columns are worked out once, the feature's per row
+        region_row = [''] * len(self.columns)
+        for i, getter in self._region_getters:
+            region_row[i] = getter(region, None)
+
+        if not features:
+            if include_empty:
+                self._write_rows([region_row])
+            return
+
+        feature_getters = self._feature_getters
+        rows = []
+        for feature in features:
+            row = region_row[:]
+            for i, getter in feature_getters:
+                row[i] = getter(region, feature)
+            rows.append(row)
+        self._write_rows(rows)
+
+    def write_all(self, results, region_list=None, include_empty=True):
+        """
+        Writes every region's results: results is a dict from find_features
+        (written in the order of region_list, or sorted if None) or an
+        iterable of (region, features) such as sweep_features yields
+
+        """
+
+        if isinstance(results, dict):
+            found = results
+            if region_list is None:
+                region_list = sorted(found, key=interval_key)
+            results = ((region, found[region]) for region in region_list)
+        rows = self.rows
+        with self.instrumentation.phase('output'):
+            for region, features in results:
+                self.write(region, features, include_empty)
+        self.instrumentation.count('output rows', self.rows - rows)
+
+    def close(self):
+        """Finishes the last file. A writer that wrote nothing still writes
+        a file with just the header.
+
+        """
+
+        with self.instrumentation.phase('output'):
+            if self._fp is None and not self.filenames:
+                self._open_next()
+            self._close_file()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        if exc_type is None:
+            self.close()
+            return
+
+        # Leave no partial output behind: neither the file being written nor
+        # the parts finished before it
+        if self._fp is not None:
+            fp, tmp_filename, filename = self._fp
+            fp.close()
+            os.remove(tmp_filename)
+            self._fp = None
+        for filename in self.filenames:
+            if os.path.exists(filename):
+                os.remove(filename)
+        self.filenames = []
+
+
+class _ChunkFile(object):
+    """Collects what is written to it in a list"""
+
+    def __init__(self, chunk):
+        self.write = chunk.append
+
+
+# Query server
+#
+# Keeps one FeatureIndex in memory and answers queries on a Unix socket. A
+# request is one line of JSON, either a single query or {"queries": [...]}
+# for a batch, and the answer is one line of JSON in the same shape:
+#
+#   {"op": "overlapping", "chrom": "chr1", "left": 100, "right": 200}
+#   {"op": "nearest", "chrom": "chr1", "left": 100, "right": 200, "k": 3,
+#    "direction": "upstream"}
+#   {"op": "within", "chrom": "chr1", "left": 100, "right": 200,
+#    "distance": 5000}
+#
+# Features come back as {"name", "chrom", "left", "right", "strand",
+# "refseq"} objects, nearest ones as {"distance", "feature"}. A query that
+# can't be answered gets {"error": message} in its place.
+
+def _feature_record(feature):
+
+    return {'name': feature.name, 'chrom': feature.chrom,
+            'left': feature.left, 'right': feature.right,
+            'strand': getattr(feature, 'strand', None),
+            'refseq': getattr(feature, 'refseq', None)}
+
+
+def answer_query(index, query):
+    """Answers one server query (a dict, see above) from index"""
+
+    op = query.get('op')
+    try:
+        chrom = query['chrom']
+        left = int(query['left'])
+        right = int(query['right'])
+        if op == 'overlapping':
+            return [_feature_record(f)
+                    for f in index.overlapping(chrom, left, right)]
+        elif op == 'nearest':
+            return [{'distance': distance, 'feature': _feature_record(f)}
+                    for distance, f in index.nearest(
+                        chrom, left, right, int(query.get('k', 1)),
+                        query.get('direction'))]
+        elif op == 'within':
+            return [_feature_record(f)
+                    for f in index.within(chrom, left, right,
+                                          int(query['distance']),
+                                          query.get('direction'))]
+        return {'error': 'unknown op {!r}'.format(op)}
+    except KeyError as e:
+        return {'error': 'missing {}'.format(e.args[0])}
+    except (TypeError, ValueError) as e:
+        return {'error': str(e)}
+
+
+class _QueryHandler(SocketServer.StreamRequestHandler):
+    """Answers request lines from one client until it disconnects"""
+
+    def handle(self):
+
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError:
+                answer = {'error': 'request is not JSON'}
+            else:
+                answer = self._answer(request)
+            self.wfile.write(json.dumps(answer) + '\n')
+            self.wfile.flush()
+
+    def _answer(self, request):
+
+        index = self.server.index
+        if not isinstance(request, dict):
+            return {'error': 'request must be a JSON object'}
+        if 'queries' in request:
+            return {'results': [answer_query(index, query)
+                                if isinstance(query, dict)
+                                else {'error': 'query must be an object'}
+                                for query in request['queries']]}
+        return answer_query(index, request)
+
+
+class QueryServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    Serves queries against a FeatureIndex on the Unix socket socket_path,
+    one thread per client. Index queries only read, so the clients share
+    the one index. A socket left at socket_path by an earlier server is
+    replaced, but anything else there raises IOError.
+
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, index):
+
+        try:
+            mode = os.lstat(socket_path).st_mode
+        except OSError:
+            pass
+        else:
+            if not stat.S_ISSOCK(mode):
+                raise IOError(errno.EEXIST, 'Exists and is not a socket',
+                              socket_path)
+            os.remove(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path,
+                                               _QueryHandler)
+        self.socket_path = socket_path
+        self.index = index
+
+    def server_close(self):
+
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+class QueryClient(object):
+    """A connection to a QueryServer"""
+
+    def __init__(self, socket_path):
+
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(socket_path)
+        self._fp = self._socket.makefile('rwb')
+
+    def _request(self, request):
+
+        self._fp.write(json.dumps(request) + '\n')
+        self._fp.flush()
+        return json.loads(self._fp.readline())
+
+    def query(self, op, chrom, left, right, **options):
+        """Sends one query, returning its answer"""
+
+        query = dict(options, op=op, chrom=chrom, left=left, right=right)
+        return self._request(query)
+
+    def batch(self, queries):
+        """Sends a list of query dicts at once, returning their answers in
+        the same order
+
+        """
+
+        return self._request({'queries': list(queries)})['results']
+
+    def close(self):
+
+        self._fp.close()
+        self._socket.close()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc_info):
+
+        self.close()
+
+
+# Set in the parent before the worker processes are forked, so every worker
+# shares the one loaded index instead of being sent a copy
+_BATCH_INDEX = None
+
+
+def _output_filename(region_filename, output_dir, dialect, compress):
+
+    name = '{}.features.{}'.format(os.path.basename(region_filename), dialect)
+    if compress:
+        name += '.gz'
+    return os.path.join(output_dir, name)
+
+
+def _annotate_file(task):
+    """
+    Finds the features for one region file and writes them out with a
+    ResultWriter. Runs in a worker process when region files are done
+    concurrently. Returns (region filename, output filenames, region count,
+    None, measured), or (region filename, None, None, error message,
+    measured) if it failed.
+
+    If instrument is set, the parse, sort, join and output phases are timed
+    and measured is the (counters, phases) to pass to the main process's
+    Instrumentation.merge(); otherwise it is None.
+
+    """
+
+    region_filename, output_filename, writer_options, coalesce, instrument = \
+        task
+
+    instrumentation = NO_INSTRUMENTATION
+    measured = None
+    if instrument:
+        recorded = _PhaseList()
+        instrumentation = Instrumentation([recorded])
+        measured = (instrumentation.counters, recorded.phases)
+
+    # A worker that exits (as the loaders do on a bad file) or raises
+    # something that can't be pickled never hands its task back, and the
+    # pool waits for it forever, so failures come back as messages
+    try:
+        extras = extra_result_columns(writer_options['columns'])
+        regions = create_region_table(region_filename,
+                                      instrumentation=instrumentation,
+                                      extras=extras)
+        found = find_features(regions, _BATCH_INDEX, instrumentation,
+                              coalesce=coalesce)
+
+        with ResultWriter(output_filename, instrumentation=instrumentation,
+                          **writer_options) as writer:
+            writer.write_all(found, regions)
+
+    except SystemExit:
+        # The loader has said what is wrong
+        return region_filename, None, None, 'could not be read', measured
+    except Exception as error:
+        return region_filename, None, None, '{}: {}'.format(
+            type(error).__name__, error), measured
+
+    return region_filename, writer.filenames, len(regions), None, measured
+
+
+def _check_region_file(region_filename, extras):
+    """Exits with an error if the region file can't be opened or lacks a
+    column the output needs
+
+    """
+
+    try:
+        region_fp = open_input(region_filename)
+    except IOError as error:
+        print 'ERROR: Cannot open region file {}: {}'.format(
+            region_filename, error.strerror)
+        exit(1)
+
+    try:
+        _column_positions(_region_header(region_fp),
+                          REGION_COLUMNS + tuple(extras), 'region')
+    except SystemExit:
+        print 'ERROR: in region file {}'.format(region_filename)
+        raise
+    finally:
+        region_fp.close()
+
+
+def _region_filenames(patterns, manifest):
+    """Returns the region files named by the glob patterns and the lines of
+    the manifest file, in order, without repeats
+
+    """
+
+    filenames = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            print 'ERROR: No region files match {}'.format(pattern)
+            exit(1)
+        filenames.extend(matches)
+
+    if manifest is not None:
+        with open(manifest) as manifest_fp:
+            for line in manifest_fp:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    filenames.append(line)
+
+    seen = set()
+    return [f for f in filenames if not (f in seen or seen.add(f))]
+
+
+def main(argv=None):
+    """Annotates many region files against one gene file, loading and
+    indexing the genes only once, or with --serve answers queries against
+    the genes until interrupted
+
+    """
+
+    global _BATCH_INDEX
+
+    parser = argparse.ArgumentParser(
+        description='Find the genes overlapping the regions in each region '
+                    'file. One FILE.features.tsv (or .csv) is written per '
+                    'region file.')
+    parser.add_argument('region_files', nargs='*', metavar='REGION_FILE',
+                        help='region files or glob patterns')
+    parser.add_argument('-g', '--genes', required=True,
+                        help='gene file (refGene with geneSymbol and refseq)')
+    parser.add_argument('-m', '--manifest',
+                        help='file listing more region files, one per line')
+    parser.add_argument('-o', '--output-dir', default='.',
+                        help='where to write the results (default: here)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='region files to do at once (default: 1)')
+    parser.add_argument('--cache-dir',
+                        help='cache the parsed gene file here between runs')
+    parser.add_argument('-c', '--columns',
+                        default=','.join(DEFAULT_RESULT_COLUMNS),
+                        help='comma separated output columns: any of {}, or '
+                             'other region file columns such as Score '
+                             '(default: %(default)s)'.format(
+                                 ', '.join(sorted(RESULT_COLUMNS))))
+    parser.add_argument('--csv', action='store_true',
+                        help='write comma separated output')
+    parser.add_argument('-z', '--gzip', action='store_true',
+                        help='gzip the output')
+    parser.add_argument('--no-split', action='store_true',
+                        help="don't split output at Excel's row limit")
+    parser.add_argument('--coalesce', type=int, metavar='GAP',
+                        help='search for regions at most GAP bases apart '
+                             'together (for dense probe sets)')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='report timings and progress on stderr')
+    parser.add_argument('--serve', metavar='SOCKET',
+                        help='answer queries on this Unix socket instead')
+    args = parser.parse_args(argv)
+
+    region_filenames = _region_filenames(args.region_files, args.manifest)
+    if not region_filenames and args.serve is None:
+        parser.error('no region files given')
+
+    # Bad region files are found now, not part way through the batch
+    extras = extra_result_columns(args.columns.split(','))
+    for filename in region_filenames:
+        _check_region_file(filename, extras)
+
+    instrumentation = NO_INSTRUMENTATION
+    if args.verbose:
+        instrumentation = Instrumentation([PrintSink()])
+
+    with instrumentation.phase('load genes'):
+        if args.cache_dir is not None:
+            genes, _BATCH_INDEX = load_cached_genes(args.genes,
+                                                    args.cache_dir)
+        else:
+            genes = create_gene_table(args.genes)
+            _BATCH_INDEX = FeatureIndex.from_table(genes)
+
+    if args.serve is not None:
+        server = QueryServer(args.serve, _BATCH_INDEX)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return 0
 
-"""
-GENE_FILENAME = 'gene_file'
-REGION_FILENAME = 'region_file'
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    writer_options = {
+        'columns': args.columns.split(','),
+        'dialect': 'csv' if args.csv else 'tsv',
+        'compress': args.gzip,
+        'max_rows': None if args.no_split else EXCEL_MAX_ROWS,
+    }
+    tasks = [(filename,
+              _output_filename(filename, args.output_dir,
+                               writer_options['dialect'], args.gzip),
+              writer_options, args.coalesce, args.verbose)
+             for filename in region_filenames]
 
+    pool = None
+    if args.jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(args.jobs, len(tasks)))
+        results = pool.imap_unordered(_annotate_file, tasks)
+    else:
+        results = imap(_annotate_file, tasks)
 
-genes = create_gene_list(GENE_FILENAME)
-regions = create_region_list(REGION_FILENAME)
+    failed = 0
+    try:
+        with instrumentation.phase('annotate'):
+            for (region_filename, output_filenames, region_count,
+                 error, measured) in results:
+                if measured is not None:
+                    instrumentation.merge(*measured)
+                if error is not None:
+                    print 'ERROR: Region file {} {}'.format(region_filename,
+                                                            error)
+                    failed += 1
+                    continue
+                instrumentation.count('region files')
+                if args.verbose:
+                    sys.stderr.write('{} -> {} ({} regions)\n'.format(
+                        region_filename, ', '.join(output_filenames),
+                        region_count))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
-genes = genes[:100]
-regions = regions[:100]
-"""
+    instrumentation.report()
 
+    return 1 if failed else 0
 
 
+if __name__ == '__main__':
+    sys.exit(main())
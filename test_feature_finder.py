@@ -1,7 +1,20 @@
+import gzip
+import multiprocessing
+import os
 import random
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import zlib
 import StringIO
 
+import benchmark_feature_finder
+import feature_finder
 from feature_finder import *
 
 # NOTE these tests run in the order of the class names
@@ -630,6 +643,2204 @@ chr1	-	4511	4773	2	4511,4625,	    4536,4773,	n/a_2	n/a
 chr1	-	5521	5998	2	5521,5889,	57068,5998,	ENSA,	NM_207168,"""
 
 
+    def test_find_features_long_gene_nested_gene(self):
+
+        #    5    10   15   20   25   30   35   40   45   50   55   60   65  70
+        #----|----|----|----|----|----|----|----|----|----|----|----|----|----|
+        # Genes:
+        #-0================================================================---
+        #----------1=====------------------------------------------------------
+        # Regions:
+        #------------0===----------------------------1=====--------------------
+        # Overlap:
+        #            ====                            ======
+
+        gene_file = \
+"""#chrom	strand	txStart	txEnd	exonCount	exonStarts	exonEnds	geneSymbol	refseq
+chr1	+	1	67	1	1,	67,	G1,	G1,
+chr1	+	10	16	1	10,	16,	G2,	G2,"""
+
+        region_file = \
+"""#Chromosome	StartPosition	EndPosition	RegionName
+chr1	12	16	R1
+chr1	44	50	R2"""
+
+        gene_list = create_gene_list(StringIO.StringIO(gene_file))
+        region_list = create_region_list(StringIO.StringIO(region_file))
+
+        true_found = {region_list[0]:[gene_list[0], gene_list[1]],
+                      region_list[1]:[gene_list[0]]}
+
+        code_found = find_features(region_list, gene_list=gene_list)
+
+        self.assertEquals(code_found, true_found)
+
+        # A prebuilt index gives the same answer
+        code_found = find_features(region_list,
+                                   gene_list=FeatureIndex(gene_list))
+
+        self.assertEquals(code_found, true_found)
+
+
+class TestFeatureIndex(unittest.TestCase):
+    """Make sure the index finds the same features as a linear scan"""
+
+    def setUp(self):
+
+        rand = random.Random(42)
+        self.features = []
+        for i in xrange(500):
+            chrom = rand.choice(['chr1', 'chr2', 'chrX'])
+            left = rand.randint(0, 10000)
+            right = left + rand.choice([1, 10, 100, 1000, 5000])
+            self.features.append(Feature(chrom, left, right, 'f%d' % i))
+        sort_intervals(self.features)
+        self.index = FeatureIndex(self.features)
+
+    def test_overlapping(self):
+
+        rand = random.Random(7)
+        for i in xrange(300):
+            chrom = rand.choice(['chr1', 'chr2', 'chrX', 'chrY'])
+            left = rand.randint(-100, 11000)
+            region = Region(chrom, left, left + rand.randint(1, 800), '')
+
+            true_found = [f for f in self.features if overlaps(f, region)]
+            code_found = self.index.overlapping(region.chrom, region.left,
+                                                region.right)
+
+            self.assertEquals(code_found, true_found)
+
+    def test_zero_length(self):
+
+        genes = [Gene('chr1', '+', left, right, 1, str(left), str(right),
+                      'G{}'.format(i), 'NM_{}'.format(i))
+                 for i, (left, right) in enumerate([(100, 200), (300, 300),
+                                                    (422, 520), (460, 470),
+                                                    (520, 600)])]
+        regions = [Region('chr1', left, right, 'R{}'.format(i))
+                   for i, (left, right) in enumerate([(468, 468), (300, 300),
+                                                      (250, 350), (200, 200),
+                                                      (150, 480), (520, 520),
+                                                      (0, 1000)])]
+        index = FeatureIndex(genes)
+        mutable = MutableFeatureIndex(genes)
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            index_filename = os.path.join(tmp_dir, 'genes.idx')
+            write_feature_index(genes, index_filename)
+            with MappedFeatureIndex(index_filename) as mapped:
+                mapped_found = dict(
+                    (region, [g.name for g in mapped.overlapping(
+                        'chr1', region.left, region.right)])
+                    for region in regions)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        # Every query path agrees with overlaps(): zero-length regions and
+        # genes overlap nothing
+        paths = [find_features(regions, index),
+                 find_features(regions, mutable),
+                 find_features(regions, index, coalesce=0),
+                 find_features_parallel(regions, index, workers=1),
+                 dict(sweep_features(sorted(regions, key=interval_key),
+                                     genes))]
+        density = FeatureDensity(genes)
+        for region in regions:
+            expected = [g for g in genes if overlaps(g, region)]
+            self.assertEquals(index.overlapping('chr1', region.left,
+                                                region.right), expected)
+            self.assertEquals(mutable.overlapping('chr1', region.left,
+                                                  region.right), expected)
+            for found in paths:
+                self.assertEquals(found[region], expected)
+            self.assertEquals(mapped_found[region],
+                              [g.name for g in expected])
+            self.assertEquals(density.count('chr1', region.left,
+                                            region.right), len(expected))
+        self.assertEquals([g.name for g in index.overlapping('chr1', 0, 1000)],
+                          ['G0', 'G2', 'G3', 'G4'])
+
+        # A point inside a gene is still no distance from it
+        for query_index in [index, mutable]:
+            self.assertEquals(query_index.nearest('chr1', 468, 468, k=2),
+                              [(0, genes[2]), (0, genes[3])])
+            self.assertEquals(query_index.within('chr1', 468, 468, 0),
+                              [genes[2], genes[3]])
+
+    def test_size_and_chroms(self):
+
+        self.assertEquals(len(self.index), len(self.features))
+        self.assertEquals(self.index.chroms(), ['chr1', 'chr2', 'chrX'])
+        self.assertEquals(self.index.features('chrY'), [])
+        self.assertEquals(self.index.overlapping('chrY', 0, 100), [])
+
+
+class TestNearest(unittest.TestCase):
+    """Make sure the distance functions and nearest feature queries work"""
+
+    def setUp(self):
+
+        rand = random.Random(3)
+        self.genes = []
+        for i in xrange(300):
+            chrom = rand.choice(['chr1', 'chr2'])
+            left = rand.randint(0, 20000)
+            right = left + rand.randint(1, 2000)
+            strand = rand.choice('+-')
+            self.genes.append(Gene(chrom, strand, left, right, 1, str(left),
+                                   str(right), 'G%d' % i, 'NM_%d' % i))
+        sort_intervals(self.genes)
+        self.index = FeatureIndex(self.genes)
+
+    def test_amount_before_and_after(self):
+
+        f_50_75 = Feature('chr3', 50, 75, '')
+        f_90_150 = Feature('chr3', 90, 150, '')
+        f_200_230 = Feature('chr3', 200, 230, '')
+        f_300_500 = Feature('chr3', 300, 500, '')
+        f_ch7_50_70 = Feature('chr7', 50, 70, '')
+
+        r_100_200 = Region('chr3', 100, 200, '')
+
+        self.assertEquals(25, get_amount_before(f_50_75, r_100_200))
+        self.assertEquals(-1, get_amount_before(f_90_150, r_100_200))
+        self.assertEquals(-1, get_amount_before(f_300_500, r_100_200))
+        self.assertEquals(-1, get_amount_before(f_ch7_50_70, r_100_200))
+
+        self.assertEquals(100, get_amount_after(f_300_500, r_100_200))
+        self.assertEquals(0, get_amount_after(f_200_230, r_100_200))
+        self.assertEquals(-1, get_amount_after(f_90_150, r_100_200))
+        self.assertEquals(-1, get_amount_after(f_50_75, r_100_200))
+        self.assertEquals(-1, get_amount_after(f_ch7_50_70, r_100_200))
+
+        self.assertEquals(25, get_distance(f_50_75, r_100_200))
+        self.assertEquals(0, get_distance(f_90_150, r_100_200))
+        self.assertEquals(100, get_distance(f_300_500, r_100_200))
+        self.assertEquals(-1, get_distance(f_ch7_50_70, r_100_200))
+
+    def test_upstream_follows_strand(self):
+
+        g_pos = Gene('chr1', '+', '100', '200', '1', '100,', '200,', 'P', 'P')
+        g_neg = Gene('chr1', '-', '100', '200', '1', '100,', '200,', 'N', 'N')
+
+        r_before = Region('chr1', 50, 90, '')
+        r_after = Region('chr1', 250, 300, '')
+
+        self.assertTrue(is_upstream(g_pos, r_before))
+        self.assertTrue(is_downstream(g_pos, r_after))
+        self.assertTrue(is_upstream(g_neg, r_after))
+        self.assertTrue(is_downstream(g_neg, r_before))
+        self.assertFalse(is_upstream(g_pos, r_after))
+        self.assertFalse(is_upstream(g_neg, r_before))
+
+        index = FeatureIndex([g_pos, g_neg])
+        self.assertEquals(index.nearest_upstream('chr1', 50, 90), g_pos)
+        self.assertEquals(index.nearest_downstream('chr1', 50, 90), g_neg)
+        self.assertEquals(index.nearest_upstream('chr1', 250, 300), g_neg)
+        self.assertEquals(index.nearest_downstream('chr1', 250, 300), g_pos)
+        self.assertEquals(index.nearest_upstream('chr1', 150, 160), None)
+        self.assertEquals(index.nearest_before('chr1', 250, 300).right, 200)
+        self.assertEquals(index.nearest_after('chr1', 250, 300), None)
+
+    def test_nearest(self):
+
+        rand = random.Random(11)
+        for i in xrange(100):
+            left = rand.randint(0, 22000)
+            region = Region(rand.choice(['chr1', 'chr2']), left,
+                            left + rand.randint(1, 300), '')
+
+            for direction, keep in [(None, lambda f: True),
+                                    ('upstream', is_upstream),
+                                    ('downstream', is_downstream)]:
+                candidates = [f for f in self.genes
+                              if f.chrom == region.chrom and
+                              (direction is None or keep(f, region))]
+                true_distances = sorted(get_distance(f, region)
+                                        for f in candidates)[:5]
+
+                code_found = self.index.nearest(region.chrom, region.left,
+                                                region.right, k=5,
+                                                direction=direction)
+
+                self.assertEquals([d for d, f in code_found], true_distances)
+                for distance, feature in code_found:
+                    self.assertEquals(distance, get_distance(feature, region))
+                    if direction is not None:
+                        self.assertTrue(keep(feature, region))
+
+    def test_within(self):
+
+        rand = random.Random(5)
+        for i in xrange(100):
+            left = rand.randint(0, 22000)
+            region = Region(rand.choice(['chr1', 'chr2']), left,
+                            left + rand.randint(1, 300), '')
+            distance = rand.choice([0, 10, 500, 3000])
+
+            true_found = [f for f in self.genes
+                          if f.chrom == region.chrom and
+                          get_distance(f, region) <= distance]
+            code_found = self.index.within(region.chrom, region.left,
+                                           region.right, distance)
+            self.assertEquals(code_found, true_found)
+
+            true_found = [f for f in true_found if is_upstream(f, region)]
+            code_found = self.index.within(region.chrom, region.left,
+                                           region.right, distance,
+                                           direction='upstream')
+            self.assertEquals(code_found, true_found)
+
+
+class TestTables(unittest.TestCase):
+    """Make sure the tables hold the same data as the lists of objects"""
+
+    gene_file = \
+"""#chrom	strand	txStart	txEnd	exonCount	exonStarts	exonEnds	geneSymbol	refseq
+chr2	-	40	90	2	40,70,	50,90,	G3,	NM_3,
+chr1	+	8	60	3	8,20,50,	12,30,60,	G1,	NM_1,
+chr1	+	5	9	1	5,	9,	G2,	n/a"""
+
+    region_file = \
+"""#Chromosome	StartPosition	EndPosition	RegionName	Score
+chr2	45	47	R3	1.0
+chr1	2	6	R1	2.0
+chr1	10	21	R2	3.0"""
+
+    def test_gene_table(self):
+
+        gene_list = create_gene_list(StringIO.StringIO(self.gene_file))
+        gene_table = create_gene_table(StringIO.StringIO(self.gene_file))
+
+        self.assertEquals(len(gene_table), len(gene_list))
+        for gene, view in zip(gene_list, gene_table):
+            for field in ['chrom', 'left', 'right', 'name', 'strand',
+                          'positive_strand', 'txStart', 'txEnd', 'exonCount',
+                          'exonStarts', 'exonEnds', 'geneSymbol', 'refseq',
+                          'exons']:
+                self.assertEquals(getattr(view, field), getattr(gene, field))
+
+        self.assertEquals(gene_table[-1], gene_table[2])
+        self.assertRaises(IndexError, lambda: gene_table[3])
+        self.assertRaises(AttributeError, setattr, gene_table[0], 'x', 1)
+
+    def test_region_table(self):
+
+        region_list = create_region_list(StringIO.StringIO(self.region_file))
+        region_table = create_region_table(StringIO.StringIO(self.region_file))
+
+        self.assertEquals(len(region_table), len(region_list))
+        for region, view in zip(region_list, region_table):
+            for field in ['chrom', 'left', 'right', 'name', 'Chromosome',
+                          'StartPosition', 'EndPosition', 'RegionName']:
+                self.assertEquals(getattr(view, field),
+                                  getattr(region, field))
+
+    def test_find_features_with_tables(self):
+
+        gene_table = create_gene_table(StringIO.StringIO(self.gene_file))
+        region_table = create_region_table(StringIO.StringIO(self.region_file))
+
+        true_found = {region_table[0]:[gene_table[0]],
+                      region_table[1]:[gene_table[1]],
+                      region_table[2]:[gene_table[2]]}
+
+        code_found = find_features(region_table, gene_list=gene_table)
+
+        self.assertEquals(code_found, true_found)
+
+        # Converting back and forth keeps every field
+        gene_list = create_gene_list(StringIO.StringIO(self.gene_file))
+        self.assertEquals([str(g) for g in GeneTable.from_genes(gene_list)],
+                          [str(g) for g in gene_table])
+
+
+class TestStreamingParser(unittest.TestCase):
+    """Make sure the lazy parsers read the same rows as the list loaders"""
+
+    def test_iter_genes(self):
+
+        # Columns in an unusual order, with version info and a blank line
+        gene_file = \
+"""#hg19.refGene.txStart	hg19.refGene.chrom	txEnd	strand	exonCount	exonStarts	exonEnds	geneSymbol	refseq
+40	chr2	90	-	2	40,70,	50,90,	G3,	NM_3,
+
+8	chr1	60	+	3	8,20,50,	12,30,60,	G1,	NM_1,"""
+
+        stats = ParseStats()
+        genes = iter_genes(StringIO.StringIO(gene_file), stats)
+
+        gene = next(genes)
+        self.assertEquals((gene.chrom, gene.left, gene.right, gene.name),
+                          ('chr2', 40, 90, 'G3'))
+        self.assertEquals(stats.rows, 0)
+
+        gene = next(genes)
+        self.assertEquals((gene.chrom, gene.left, gene.right, gene.name),
+                          ('chr1', 8, 60, 'G1'))
+        self.assertEquals(list(genes), [])
+        self.assertEquals(stats.rows, 2)
+        self.assertTrue(stats.rows_per_sec >= 0)
+
+    def test_presorted(self):
+
+        region_file = \
+"""#Chromosome	StartPosition	EndPosition	RegionName
+chr2	45	47	R3
+chr1	2	6	R1"""
+
+        regions = create_region_list(StringIO.StringIO(region_file))
+        self.assertEquals([r.name for r in regions], ['R1', 'R3'])
+
+        # presorted trusts the file order
+        regions = create_region_list(StringIO.StringIO(region_file),
+                                     presorted=True)
+        self.assertEquals([r.name for r in regions], ['R3', 'R1'])
+
+    def test_missing_column(self):
+
+        region_file = \
+"""#Chromosome	StartPosition	EndPosition
+chr1	2	6"""
+
+        self.assertRaises(SystemExit, create_region_list,
+                          StringIO.StringIO(region_file))
+
+
+class TestStreaming(unittest.TestCase):
+    """Make sure the out-of-core sort and join match the in-memory ones"""
+
+    def setUp(self):
+
+        rand = random.Random(13)
+        self.genes = []
+        for i in xrange(400):
+            left = rand.randint(0, 5000)
+            right = left + rand.choice([5, 50, 500, 3000])
+            self.genes.append(Feature(rand.choice(['chr1', 'chr2', 'chr3']),
+                                      left, right, 'G%d' % i))
+        self.regions = []
+        for i in xrange(300):
+            left = rand.randint(0, 6000)
+            right = left + rand.randint(1, 200)
+            self.regions.append(Region(rand.choice(['chr1', 'chr3', 'chr4']),
+                                       left, right, 'R%d' % i))
+
+    def test_external_sort(self):
+
+        true_sorted = sorted(self.genes, key=interval_key)
+
+        # In memory, then spilled to several runs on disk
+        for run_size in [1000, 37]:
+            code_sorted = list(external_sort(self.genes, run_size=run_size))
+            self.assertEquals([str(g) for g in code_sorted],
+                              [str(g) for g in true_sorted])
+
+        self.assertEquals(list(external_sort([], run_size=10)), [])
+
+    def test_sweep_features(self):
+
+        sort_intervals(self.genes)
+        sort_intervals(self.regions)
+
+        true_found = find_features(self.regions, gene_list=self.genes)
+
+        code_found = list(sweep_features(iter(self.regions),
+                                         iter(self.genes)))
+
+        self.assertEquals([r for r, f in code_found], self.regions)
+        self.assertEquals(dict(code_found), true_found)
+
+    def test_stream_find_features(self):
+
+        gene_file = \
+"""#chrom	strand	txStart	txEnd	exonCount	exonStarts	exonEnds	geneSymbol	refseq
+chr1	+	61	67	1	61,	67,	G5,	G5,
+chr1	+	17	32	1	17,	32,	G2,	G2,
+chr1	+	5	10	1	5,	10,	G1,	G1,
+chr1	+	48	50	1	48,	50,	G4,	G4,
+chr1	+	37	45	1	37,	45,	G3,	G3,"""
+
+        region_file = \
+"""#Chromosome	StartPosition	EndPosition	RegionName
+chr1	35	53	R4
+chr1	1	6	R1
+chr1	59	70	R5
+chr1	12	14	R2
+chr1	20	24	R3"""
+
+        code_found = [(region.name, [f.name for f in found])
+                      for region, found in
+                      stream_find_features(StringIO.StringIO(region_file),
+                                           StringIO.StringIO(gene_file),
+                                           run_size=2)]
+
+        self.assertEquals(code_found, [('R1', ['G1']),
+                                       ('R2', []),
+                                       ('R3', ['G2']),
+                                       ('R4', ['G3', 'G4']),
+                                       ('R5', ['G5'])])
+
+
+class TestParallel(unittest.TestCase):
+    """Make sure the parallel join finds the same features"""
+
+    def setUp(self):
+
+        rand = random.Random(17)
+        self.genes = []
+        for i in xrange(400):
+            left = rand.randint(0, 5000)
+            right = left + rand.choice([5, 50, 500, 3000])
+            self.genes.append(Feature(rand.choice(['chr1', 'chr2', 'chr3']),
+                                      left, right, 'G%d' % i))
+        self.regions = []
+        for i in xrange(300):
+            left = rand.randint(0, 6000)
+            self.regions.append(Region(rand.choice(['chr1', 'chr3', 'chr4']),
+                                       left, left + rand.randint(1, 200),
+                                       'R%d' % i))
+        sort_intervals(self.genes)
+        sort_intervals(self.regions)
+        self.true_found = find_features(self.regions, gene_list=self.genes)
+
+    def test_workers(self):
+
+        for workers in [1, 3]:
+            code_found = find_features_parallel(self.regions,
+                                                gene_list=self.genes,
+                                                workers=workers,
+                                                chunk_size=40)
+            self.assertEquals(code_found, self.true_found)
+
+    def test_existing_pool(self):
+
+        pool = multiprocessing.Pool(2)
+        try:
+            code_found = find_features_parallel(self.regions,
+                                                FeatureIndex(self.genes),
+                                                pool=pool)
+        finally:
+            pool.close()
+            pool.join()
+
+        self.assertEquals(code_found, self.true_found)
+
+
+class TestGeneCache(unittest.TestCase):
+    """Make sure cached genes come back the same and stale caches are
+    ignored
+
+    """
+
+    gene_file = \
+"""#chrom	strand	txStart	txEnd	exonCount	exonStarts	exonEnds	geneSymbol	refseq
+chr2	-	40	90	2	40,70,	50,90,	G3,	NM_3,
+chr1	+	8	60	3	8,20,50,	12,30,60,	G1,	NM_1,
+chr1	+	5	9	1	5,	9,	n/a	n/a
+"""
+
+    def setUp(self):
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self.gene_filename = os.path.join(self.tmp_dir, 'genes')
+        with open(self.gene_filename, 'w') as fp:
+            fp.write(self.gene_file)
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmp_dir)
+
+    def test_cache(self):
+
+        parsed, parsed_index = load_cached_genes(self.gene_filename,
+                                                 self.cache_dir)
+        self.assertEquals(len(os.listdir(self.cache_dir)), 1)
+
+        cache_filename = os.path.join(self.cache_dir,
+                                      os.listdir(self.cache_dir)[0])
+        fingerprint = feature_finder._file_fingerprint(self.gene_filename)
+        self.assertTrue(feature_finder._read_gene_cache(cache_filename,
+                                                        fingerprint))
+
+        cached, cached_index = load_cached_genes(self.gene_filename,
+                                                 self.cache_dir)
+
+        self.assertEquals(len(cached), len(parsed))
+        for gene, view in zip(parsed, cached):
+            for field in ['chrom', 'left', 'right', 'name', 'strand',
+                          'exons', 'refseq']:
+                self.assertEquals(getattr(view, field), getattr(gene, field))
+
+        self.assertEquals([str(f) for f in
+                           cached_index.overlapping('chr1', 0, 10)],
+                          ['GeneView n/a @ chr1 (5,9)',
+                           'GeneView G1 @ chr1 (8,60)'])
+
+    def test_stale_cache(self):
+
+        load_cached_genes(self.gene_filename, self.cache_dir)
+
+        with open(self.gene_filename, 'a') as fp:
+            fp.write('chr3\t+\t1\t2\t1\t1,\t2,\tG4,\tNM_4,\n')
+
+        genes, index = load_cached_genes(self.gene_filename, self.cache_dir)
+
+        self.assertEquals(len(genes), 4)
+        self.assertEquals(index.chroms(), ['chr1', 'chr2', 'chr3'])
+
+
+class TestMappedIndex(unittest.TestCase):
+    """Make sure a mapped index answers queries like the in-memory one"""
+
+    def setUp(self):
+
+        rand = random.Random(23)
+        self.genes = []
+        for i in xrange(300):
+            left = rand.randint(0, 20000)
+            right = left + rand.randint(1, 2000)
+            self.genes.append(Gene(rand.choice(['chr1', 'chr2', 'chrX']),
+                                   rand.choice('+-'), left, right, 1,
+                                   str(left), str(right), 'G%d' % i,
+                                   'NM_%d' % i))
+        self.index = FeatureIndex(self.genes)
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.index_filename = os.path.join(self.tmp_dir, 'genes.idx')
+        write_feature_index(self.genes, self.index_filename)
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmp_dir)
+
+    def assertSameFeatures(self, mapped_found, true_found):
+
+        self.assertEquals([(f.chrom, f.left, f.right, f.name, f.refseq,
+                            f.strand) for f in mapped_found],
+                          [(f.chrom, f.left, f.right, f.name, f.refseq,
+                            f.strand) for f in true_found])
+
+    def test_queries(self):
+
+        rand = random.Random(29)
+        with MappedFeatureIndex(self.index_filename) as mapped:
+
+            self.assertEquals(len(mapped), len(self.genes))
+            self.assertEquals(mapped.chroms(), self.index.chroms())
+
+            for i in xrange(100):
+                chrom = rand.choice(['chr1', 'chr2', 'chrX', 'chrY'])
+                left = rand.randint(0, 22000)
+                right = left + rand.randint(1, 300)
+
+                self.assertSameFeatures(
+                    mapped.overlapping(chrom, left, right),
+                    self.index.overlapping(chrom, left, right))
+                self.assertSameFeatures(
+                    mapped.within(chrom, left, right, 1000),
+                    self.index.within(chrom, left, right, 1000))
+
+                for direction in [None, 'upstream', 'downstream']:
+                    mapped_found = mapped.nearest(chrom, left, right, k=3,
+                                                  direction=direction)
+                    true_found = self.index.nearest(chrom, left, right, k=3,
+                                                    direction=direction)
+                    self.assertEquals([d for d, f in mapped_found],
+                                      [d for d, f in true_found])
+
+                nearest = mapped.nearest_before(chrom, left, right)
+                if nearest is not None:
+                    self.assertEquals(nearest.right,
+                                      self.index.nearest_before(
+                                          chrom, left, right).right)
+
+            found = mapped.overlapping('chr1', 0, 30000)
+
+        # Features outlive the mapping
+        self.assertSameFeatures(found, self.index.features('chr1'))
+
+    def test_not_an_index(self):
+
+        with open(self.index_filename, 'wb') as fp:
+            fp.write('#chrom\tstrand' + ' ' * 100)
+
+        self.assertRaises(ValueError, MappedFeatureIndex, self.index_filename)
+
+
+class TestInstrumentation(unittest.TestCase):
+    """Make sure the counters, timers and sinks see the work done"""
+
+    class ListSink(Sink):
+
+        def __init__(self):
+            self.phases = []
+            self.reports = []
+
+        def phase(self, name, seconds):
+            self.phases.append(name)
+
+        def report(self, counters, timers):
+            self.reports.append((counters, timers))
+
+    gene_file = \
+"""#chrom	strand	txStart	txEnd	exonCount	exonStarts	exonEnds	geneSymbol	refseq
+chr1	+	5	10	1	5,	10,	G1,	G1,
+chr1	+	17	32	1	17,	32,	G2,	G2,
+chr1	+	37	45	1	37,	45,	G3,	G3,
+chr1	+	48	50	1	48,	50,	G4,	G4,
+chr1	+	61	67	1	61,	67,	G5,	G5,"""
+
+    region_file = \
+"""#Chromosome	StartPosition	EndPosition	RegionName
+chr1	1	6	R1
+chr1	12	14	R2
+chr1	20	24	R3
+chr1	35	53	R4
+chr1	59	70	R5"""
+
+    def test_counters_and_phases(self):
+
+        sink = self.ListSink()
+        instrumentation = Instrumentation([sink])
+
+        gene_list = create_gene_list(StringIO.StringIO(self.gene_file),
+                                     instrumentation=instrumentation)
+        region_list = create_region_list(StringIO.StringIO(self.region_file),
+                                         instrumentation=instrumentation)
+        find_features(region_list, gene_list,
+                      instrumentation=instrumentation)
+
+        self.assertEquals(sink.phases, ['parse', 'sort', 'parse', 'sort',
+                                        'index', 'join'])
+
+        instrumentation.report()
+        counters, timers = sink.reports[0]
+        self.assertEquals(counters['rows'], 10)
+        self.assertEquals(counters['regions'], 5)
+        self.assertEquals(counters['hits'], 5)
+        self.assertEquals(counters['comparisons'] - counters['skips'], 5)
+        self.assertEquals(sorted(timers), ['index', 'join', 'parse', 'sort'])
+
+    def test_print_sink(self):
+
+        out = StringIO.StringIO()
+        instrumentation = Instrumentation([PrintSink(out)])
+        with instrumentation.phase('output'):
+            instrumentation.count('hits', 3)
+        instrumentation.report()
+
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('output: '))
+        self.assertTrue(lines[1].startswith('output total: '))
+        self.assertEquals(lines[2], 'hits: 3')
+
+    def test_silent_by_default(self):
+
+        region_list = create_region_list(StringIO.StringIO(self.region_file))
+        gene_list = create_gene_list(StringIO.StringIO(self.gene_file))
+
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            find_features(region_list, gene_list)
+            printed = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+        self.assertEquals(printed, '')
+
+
+class TestBenchmark(unittest.TestCase):
+    """Make sure the synthetic inputs load and the benchmark runs"""
+
+    def setUp(self):
+
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmp_dir)
+
+    def test_synthetic_files(self):
+
+        rand = random.Random(0)
+        gene_filename = os.path.join(self.tmp_dir, 'genes')
+        region_filename = os.path.join(self.tmp_dir, 'regions')
+        centres = benchmark_feature_finder.write_gene_file(gene_filename, 200,
+                                                           rand)
+        benchmark_feature_finder.write_region_file(region_filename, 100,
+                                                   rand, centres)
+
+        genes = create_gene_list(gene_filename)
+        self.assertEquals(len(genes), 200)
+        for gene in genes:
+            self.assertTrue(gene.left < gene.right)
+            self.assertEquals(gene.left, gene.exons[0][0])
+            self.assertEquals(gene.right, gene.exons[-1][-1])
+            self.assertEquals(int(gene.exonCount), len(gene.exons))
+
+        self.assertEquals(len(create_region_list(region_filename)), 100)
+
+    def test_run_benchmark(self):
+
+        results = benchmark_feature_finder.run_benchmark(300, self.tmp_dir,
+                                                         workers=[1, 2])
+
+        self.assertEquals(results['genes'], 300)
+        self.assertEquals(results['regions'], 150)
+        self.assertEquals(sorted(results['phases']),
+                          sorted(benchmark_feature_finder.PHASES))
+
+        # Too big to load: only streamed, in several runs, finding the same
+        streamed = benchmark_feature_finder.run_benchmark(
+            300, self.tmp_dir, max_load_size=299, run_size=50, workers=[2])
+        self.assertEquals(sorted(streamed['phases']),
+                          ['stream_find_features'])
+        self.assertEquals(streamed['hits'], results['hits'])
+        self.assertEquals(sorted(results['parallel']), ['1', '2'])
+        self.assertEquals(streamed['parallel'], {})
+        self.assertTrue(results['hits'] > 0)
+
+
+class TestExonOverlaps(unittest.TestCase):
+    """Make sure overlaps are split into exonic and intronic bases"""
+
+    def test_exon_overlaps(self):
+
+        #    5    10   15   20   25   30   35   40   45   50   55   60   65  70
+        #----|----|----|----|----|----|----|----|----|----|----|----|----|----|
+        # Genes (exons = and introns -):
+        #--------====-------==========--------------------==========----------
+        #-----------------------------------------------==---===--------------
+        # Regions:
+        #----------0==============-------------------1========================
+
+        gene_file = \
+"""#chrom	strand	txStart	txEnd	exonCount	exonStarts	exonEnds	geneSymbol	refseq
+chr1	+	8	60	3	8,20,50,	12,30,60,	G1,	NM_1,
+chr1	-	47	55	2	47,52,	49,55,	G2,	NM_2,"""
+
+        region_file = \
+"""#Chromosome	StartPosition	EndPosition	RegionName
+chr1	10	25	R1
+chr1	45	70	R2"""
+
+        gene_list = create_gene_list(StringIO.StringIO(gene_file))
+        region_list = create_region_list(StringIO.StringIO(region_file))
+
+        instrumentation = Instrumentation()
+        code_found = find_exon_overlaps(region_list, gene_list,
+                                        instrumentation)
+
+        # Only the gene lookups are counted, once per region
+        counters = instrumentation.counters
+        self.assertEquals(counters['hits'], 3)
+        self.assertEquals(counters['comparisons'] - counters['skips'], 3)
+
+        g1, g2 = gene_list
+        r1, r2 = region_list
+
+        overlap, = code_found[r1]
+        self.assertEquals(overlap.gene, g1)
+        self.assertEquals((overlap.exonic, overlap.intronic), (7, 8))
+        self.assertEquals([(e.number, e.left, e.right) for e in overlap.exons],
+                          [(1, 8, 12), (2, 20, 30)])
+
+        overlap_g1, overlap_g2 = code_found[r2]
+        self.assertEquals(overlap_g1.gene, g1)
+        self.assertEquals((overlap_g1.exonic, overlap_g1.intronic), (10, 5))
+        self.assertEquals([e.number for e in overlap_g1.exons], [3])
+
+        # Exons are numbered from txEnd on the - strand
+        self.assertEquals(overlap_g2.gene, g2)
+        self.assertEquals((overlap_g2.exonic, overlap_g2.intronic), (5, 3))
+        self.assertEquals([e.number for e in overlap_g2.exons], [2, 1])
+
+    def test_gene_index(self):
+
+        gene_file = \
+"""#chrom	strand	txStart	txEnd	exonCount	exonStarts	exonEnds	geneSymbol	refseq
+chr1	+	8	60	3	8,20,50,	12,30,60,	G1,	NM_1,
+chr2	-	47	55	2	47,52,	49,55,	G2,	NM_2,"""
+
+        gene_list = create_gene_list(StringIO.StringIO(gene_file))
+        genes = FeatureIndex(gene_list)
+
+        # A FeatureIndex of Genes is reused, not rebuilt
+        index = ExonIndex(genes)
+        self.assertTrue(index.genes is genes)
+        self.assertEquals(len(index), 5)
+
+        g1, g2 = gene_list
+        overlap, = index.exon_overlaps('chr2', 45, 50)
+        self.assertEquals(overlap.gene, g2)
+        self.assertEquals((overlap.exonic, overlap.intronic), (2, 1))
+
+    def test_exon_list(self):
+
+        gene = Gene('chr1', '-', '8', '60', '3', '8,20,50,', '12,30,60,',
+                    'G1,', 'NM_1,')
+
+        exons = create_exon_list([gene])
+
+        self.assertEquals([str(e) for e in exons],
+                          ['Exon G1 exon 3 @ chr1 (8,12)',
+                           'Exon G1 exon 2 @ chr1 (20,30)',
+                           'Exon G1 exon 1 @ chr1 (50,60)'])
+        self.assertTrue(all(e.gene is gene for e in exons))
+
+
+class TestTracks(unittest.TestCase):
+    """Make sure BED-like tracks load and annotate alongside genes"""
+
+    cpg_file = \
+"""#bin	chrom	chromStart	chromEnd	name	length	cpgNum
+585	chr1	28735	29810	CpG: 116	1075	116
+585	chr1	135124	135563	CpG: 30	439	30
+586	chr2	327790	328229	CpG: 29	439	29"""
+
+    bed_file = \
+"""browser position chr1:1-1000000
+track name="enhancers" description="test"
+chr1	29000	29400	E1	5.5	+
+chr1	500000	501000	E2	1.0	-
+chr1	600000	601000	E3	.	.
+chr2	10	20"""
+
+    def test_named_columns(self):
+
+        cpgs = create_track_list(StringIO.StringIO(self.cpg_file), CpGIsland,
+                                 {'chrom': 'chrom', 'left': 'chromStart',
+                                  'right': 'chromEnd', 'name': 'name'})
+
+        self.assertEquals([str(c) for c in cpgs],
+                          ['CpGIsland CpG: 116 @ chr1 (28735,29810)',
+                           'CpGIsland CpG: 30 @ chr1 (135124,135563)',
+                           'CpGIsland CpG: 29 @ chr2 (327790,328229)'])
+        self.assertEquals(cpgs[0].score, None)
+
+    def test_bed_columns(self):
+
+        elements = create_track_list(StringIO.StringIO(self.bed_file),
+                                     RegulatoryElement)
+
+        self.assertEquals([(e.name, e.score, e.strand, e.positive_strand)
+                           for e in elements],
+                          [('E1', 5.5, '+', True),
+                           ('E2', 1.0, '-', False),
+                           ('E3', None, None, True),
+                           ('chr2:10-20', None, None, True)])
+
+    def test_annotate_tracks(self):
+
+        cpgs = create_track_list(StringIO.StringIO(self.cpg_file), CpGIsland,
+                                 {'chrom': 1, 'left': 2, 'right': 3,
+                                  'name': 4})
+        elements = create_track_list(StringIO.StringIO(self.bed_file),
+                                     RegulatoryElement)
+        genes = [Gene('chr1', '+', '28000', '40000', '1', '28000,',
+                      '40000,', 'G1,', 'NM_1,')]
+
+        r1 = Region('chr1', 29300, 29500, 'R1')
+        r2 = Region('chr2', 0, 100, 'R2')
+        r3 = Region('chr3', 0, 100, 'R3')
+
+        code_found = annotate_tracks([r1, r2, r3],
+                                     {'genes': genes, 'cpg': cpgs,
+                                      'enhancers': FeatureIndex(elements)})
+
+        self.assertEquals(code_found,
+                          {r1: {'genes': genes, 'cpg': [cpgs[0]],
+                                'enhancers': [elements[0]]},
+                           r2: {'genes': [], 'cpg': [],
+                                'enhancers': [elements[3]]},
+                           r3: {'genes': [], 'cpg': [], 'enhancers': []}})
+
+
+class TestMain(unittest.TestCase):
+    """Make sure the command line annotates every region file it is given"""
+
+    def setUp(self):
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.out_dir = os.path.join(self.tmp_dir, 'out')
+        self.gene_filename = os.path.join(self.tmp_dir, 'genes')
+        with open(self.gene_filename, 'w') as fp:
+            fp.write(TestGeneCache.gene_file)
+
+        self.region_filenames = []
+        for i, line in enumerate(['chr1\t0\t10\tr1', 'chr2\t100\t200\tr2',
+                                  'chr2\t45\t75\tr3']):
+            filename = os.path.join(self.tmp_dir, 'regions_{}'.format(i))
+            with open(filename, 'w') as fp:
+                fp.write('#Chromosome\tStartPosition\tEndPosition\t'
+                         'RegionName\n' + line + '\n')
+            self.region_filenames.append(filename)
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmp_dir)
+
+    def _output(self, region_filename):
+
+        filename = os.path.join(self.out_dir, os.path.basename(
+            region_filename) + '.features.tsv')
+        with open(filename) as fp:
+            return [line.split('\t')[3:5] for line in fp][1:]
+
+    def _check_outputs(self):
+
+        self.assertEquals(sorted(os.listdir(self.out_dir)),
+                          ['regions_{}.features.tsv'.format(i)
+                           for i in range(3)])
+        self.assertEquals(self._output(self.region_filenames[0]),
+                          [['r1', 'n/a'], ['r1', 'G1']])
+        self.assertEquals(self._output(self.region_filenames[1]),
+                          [['r2', '']])
+        self.assertEquals(self._output(self.region_filenames[2]),
+                          [['r3', 'G3']])
+
+    def test_glob_and_manifest(self):
+
+        manifest = os.path.join(self.tmp_dir, 'manifest')
+        with open(manifest, 'w') as fp:
+            fp.write('# more regions\n' + self.region_filenames[2] + '\n')
+
+        feature_finder.main(['-g', self.gene_filename, '-o', self.out_dir,
+                             '-m', manifest,
+                             os.path.join(self.tmp_dir, 'regions_[01]')])
+
+        self._check_outputs()
+
+    def test_columns(self):
+
+        with open(self.region_filenames[0], 'w') as fp:
+            fp.write('#Chromosome\tStartPosition\tEndPosition\t'
+                     'RegionName\tScore\nchr1\t0\t10\tr1\t2.5\n')
+
+        feature_finder.main(['-g', self.gene_filename, '-o', self.out_dir,
+                             '--csv', '-z', '-c', 'RegionName,Score,refseq',
+                             self.region_filenames[0]])
+
+        filename = os.path.join(self.out_dir,
+                                'regions_0.features.csv.gz')
+        fp = open_input(filename)
+        try:
+            self.assertEquals(fp.read(), 'RegionName,Score,refseq\n'
+                                         'r1,2.5,n/a\nr1,2.5,NM_1\n')
+        finally:
+            fp.close()
+
+    def test_jobs(self):
+
+        feature_finder.main(['-g', self.gene_filename, '-o', self.out_dir,
+                             '-j', '2', '--cache-dir',
+                             os.path.join(self.tmp_dir, 'cache')]
+                            + self.region_filenames)
+
+        self._check_outputs()
+
+    def test_verbose(self):
+
+        # Phases timed in the worker processes are reported by the main one
+        stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            feature_finder.main(['-g', self.gene_filename, '-o', self.out_dir,
+                                 '-j', '2', '-v'] + self.region_filenames)
+            lines = sys.stderr.getvalue().splitlines()
+        finally:
+            sys.stderr = stderr
+
+        self._check_outputs()
+        totals = [line.split(' total:')[0] for line in lines
+                  if ' total: ' in line]
+        self.assertEquals(totals, ['annotate', 'join', 'load genes',
+                                   'output', 'parse', 'sort'])
+        self.assertTrue('regions: 3' in lines)
+        self.assertTrue('output rows: 4' in lines)
+        self.assertTrue('region files: 3' in lines)
+
+    def test_bad_files(self):
+
+        # A missing column is found before any work is done
+        self.assertRaises(SystemExit, feature_finder.main,
+                          ['-g', self.gene_filename, '-o', self.out_dir,
+                           '-j', '2', '-c', 'Chromosome,Foo']
+                          + self.region_filenames)
+        self.assertFalse(os.path.exists(self.out_dir))
+
+        # A bad row fails in a worker; the other files are still done
+        with open(self.region_filenames[1], 'a') as fp:
+            fp.write('chr2\tx\t200\tr4\n')
+        self.assertEquals(feature_finder.main(
+            ['-g', self.gene_filename, '-o', self.out_dir, '-j', '2']
+            + self.region_filenames), 1)
+        self.assertEquals(sorted(os.listdir(self.out_dir)),
+                          ['regions_0.features.tsv',
+                           'regions_2.features.tsv'])
+
+    def test_coalesce(self):
+
+        feature_finder.main(['-g', self.gene_filename, '-o', self.out_dir,
+                             '--coalesce', '100'] + self.region_filenames)
+
+        self._check_outputs()
+
+
+class TestQueryServer(unittest.TestCase):
+    """Make sure the server answers single and batched queries like the
+    index it serves
+
+    """
+
+    def setUp(self):
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.genes = create_gene_list(
+            StringIO.StringIO(TestGeneCache.gene_file))
+        self.index = FeatureIndex(self.genes)
+
+        self.socket_path = os.path.join(self.tmp_dir, 'socket')
+        self.server = QueryServer(self.socket_path, self.index)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_socket_path(self):
+
+        # Something that isn't a socket is left alone
+        filename = os.path.join(self.tmp_dir, 'data')
+        with open(filename, 'w') as fp:
+            fp.write('keep me')
+        self.assertRaises(IOError, QueryServer, filename, self.index)
+        with open(filename) as fp:
+            self.assertEquals(fp.read(), 'keep me')
+
+        # A socket left behind by a server that died is replaced
+        stale_path = os.path.join(self.tmp_dir, 'stale')
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(stale_path)
+        stale.close()
+        server = QueryServer(stale_path, self.index)
+        server.server_close()
+        self.assertFalse(os.path.exists(stale_path))
+
+    def test_queries(self):
+
+        with QueryClient(self.socket_path) as client:
+            self.assertEquals(
+                [f['name'] for f in client.query('overlapping', 'chr1', 0, 10)],
+                ['n/a', 'G1'])
+
+            nearest = client.query('nearest', 'chr2', 0, 10, k=1)
+            self.assertEquals(nearest[0]['distance'], 30)
+            self.assertEquals(nearest[0]['feature'],
+                              {'name': 'G3', 'chrom': 'chr2', 'left': 40,
+                               'right': 90, 'strand': '-', 'refseq': 'NM_3'})
+
+            results = client.batch([
+                {'op': 'overlapping', 'chrom': 'chr3', 'left': 0,
+                 'right': 10},
+                {'op': 'within', 'chrom': 'chr1', 'left': 62, 'right': 70,
+                 'distance': 2},
+                {'op': 'overlapping', 'chrom': 'chr1'},
+                {'op': 'sideways', 'chrom': 'chr1', 'left': 0, 'right': 1}])
+            self.assertEquals(results[0], [])
+            self.assertEquals([f['name'] for f in results[1]], ['G1'])
+            self.assertTrue('error' in results[2])
+            self.assertTrue('error' in results[3])
+
+    def test_matches_index(self):
+
+        rand = random.Random(14)
+        queries = []
+        for i in range(200):
+            left = rand.randint(0, 100)
+            queries.append({'op': 'overlapping',
+                            'chrom': rand.choice(['chr1', 'chr2']),
+                            'left': left, 'right': left + rand.randint(1, 20)})
+
+        with QueryClient(self.socket_path) as client:
+            results = client.batch(queries)
+
+        for query, result in zip(queries, results):
+            expected = self.index.overlapping(query['chrom'], query['left'],
+                                              query['right'])
+            self.assertEquals([f['name'] for f in result],
+                              [f.name for f in expected])
+
+
+class TestCompressedInput(unittest.TestCase):
+    """Make sure gzipped and BGZF files load the same as plain ones"""
+
+    def setUp(self):
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.gene_filename = os.path.join(self.tmp_dir, 'genes')
+        self.region_filename = os.path.join(self.tmp_dir, 'regions')
+        rand = random.Random(15)
+        centres = benchmark_feature_finder.write_gene_file(
+            self.gene_filename, 300, rand)
+        benchmark_feature_finder.write_region_file(
+            self.region_filename, 500, rand, centres)
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmp_dir)
+
+    def _write_bgzf(self, filename, data, block_size=1000):
+        """Writes data as BGZF blocks of block_size bytes, plus the empty
+        end of file block
+
+        """
+
+        with open(filename, 'wb') as fp:
+            for i in range(0, len(data), block_size) + [len(data)]:
+                block = data[i:i + block_size]
+                compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                              -zlib.MAX_WBITS)
+                deflated = compressor.compress(block) + compressor.flush()
+                fp.write('\x1f\x8b\x08\x04\0\0\0\0\0\xff\x06\0BC\x02\0')
+                fp.write(struct.pack('<H', len(deflated) + 25))
+                fp.write(deflated)
+                fp.write(struct.pack('<Ii', zlib.crc32(block) & 0xffffffff,
+                                     len(block)))
+
+    def _check(self, filename, compressed_filename):
+
+        self.assertEquals(
+            [str(g) for g in create_gene_list(compressed_filename)],
+            [str(g) for g in create_gene_list(filename)])
+
+    def test_gzip(self):
+
+        with open(self.gene_filename) as fp:
+            data = fp.read()
+        gz_filename = self.gene_filename + '.gz'
+        with gzip.open(gz_filename, 'wb') as fp:
+            fp.write(data)
+        self._check(self.gene_filename, gz_filename)
+
+        # Several members, as from cat a.gz b.gz
+        halves = [data[:len(data) // 2], data[len(data) // 2:]]
+        with open(gz_filename, 'wb') as fp:
+            for half in halves:
+                member = StringIO.StringIO()
+                with gzip.GzipFile(fileobj=member, mode='wb') as gz:
+                    gz.write(half)
+                fp.write(member.getvalue())
+        self._check(self.gene_filename, gz_filename)
+
+    def test_bgzf(self):
+
+        with open(self.region_filename) as fp:
+            data = fp.read()
+        bgzf_filename = self.region_filename + '.gz'
+        self._write_bgzf(bgzf_filename, data)
+
+        with open(bgzf_filename, 'rb') as fp:
+            self.assertTrue(feature_finder._is_bgzf(fp.read(18)))
+
+        for threads in [1, 3]:
+            fp = open_input(bgzf_filename, threads)
+            try:
+                self.assertEquals(fp.readline(), data.splitlines(True)[0])
+                self.assertEquals(''.join(fp), data.split('\n', 1)[1])
+            finally:
+                fp.close()
+
+        self.assertEquals(
+            [str(r) for r in create_region_list(bgzf_filename)],
+            [str(r) for r in create_region_list(self.region_filename)])
+
+    def test_gzip_track(self):
+
+        # The header is read in one loop and the data in another
+        data = ('track name="probes"\n#chrom\tchromStart\tchromEnd\n' +
+                ''.join('chr1\t{}\t{}\n'.format(i * 100, i * 100 + 50)
+                        for i in range(5000)))
+        track_filename = os.path.join(self.tmp_dir, 'track.bed')
+        with open(track_filename, 'w') as fp:
+            fp.write(data)
+        gz_filename = track_filename + '.gz'
+        with gzip.open(gz_filename, 'wb') as fp:
+            fp.write(data)
+        bgzf_filename = os.path.join(self.tmp_dir, 'track.bgzf.gz')
+        self._write_bgzf(bgzf_filename, data)
+
+        self.assertEquals(len(create_track_list(track_filename)), 5000)
+        self.assertEquals(len(create_track_list(gz_filename)), 5000)
+        self.assertEquals(len(create_track_list(bgzf_filename)), 5000)
+
+    def test_truncated_gzip(self):
+
+        gzip_filename = self.region_filename + '.gz'
+        gzip_fp = gzip.open(gzip_filename, 'wb')
+        gzip_fp.write(open(self.region_filename).read() +
+                      'chr2\t100\t200\tr\n' * 3000)
+        gzip_fp.close()
+        with open(gzip_filename, 'rb') as fp:
+            data = fp.read()
+
+        # Cut in the deflate data and in the trailer
+        for size in [len(data) // 2, len(data) - 1]:
+            with open(gzip_filename, 'wb') as fp:
+                fp.write(data[:size])
+            self.assertRaises(IOError, create_region_list, gzip_filename)
+
+        # An empty or damaged file isn't taken for a complete one either
+        with open(gzip_filename, 'wb') as fp:
+            fp.write(data[:10])
+        self.assertRaises(IOError, create_region_list, gzip_filename)
+
+        with open(gzip_filename, 'wb') as fp:
+            fp.write(data[:20] + '\xff' * 8 + data[28:])
+        self.assertRaises(IOError, create_region_list, gzip_filename)
+
+    def test_corrupt_bgzf(self):
+
+        bgzf_filename = self.region_filename + '.gz'
+        self._write_bgzf(bgzf_filename, 'chr1\t1\t2\tr\n' * 500)
+        with open(bgzf_filename, 'rb') as fp:
+            data = fp.read()
+
+        # A bad CRC, and deflate data zlib can't make sense of
+        for offset, damage in [(len(data) - 30, '\0\0\0\0'),
+                               (18, '\xff\xff\xff\xff')]:
+            with open(bgzf_filename, 'wb') as fp:
+                fp.write(data[:offset] + damage + data[offset + 4:])
+            for threads in [1, 2]:
+                fp = open_input(bgzf_filename, threads)
+                try:
+                    self.assertRaises(IOError, fp.read)
+                finally:
+                    fp.close()
+
+    def test_truncated_bgzf(self):
+
+        bgzf_filename = self.region_filename + '.gz'
+        self._write_bgzf(bgzf_filename, 'chr1\t1\t2\tr\n' * 5000)
+        with open(bgzf_filename, 'rb') as fp:
+            data = fp.read()
+
+        # Cut inside a block, inside a header, and between blocks (losing
+        # only the end of file block)
+        for size in [len(data) // 2, len(data) // 2 + 5, len(data) - 28]:
+            with open(bgzf_filename, 'wb') as fp:
+                fp.write(data[:size])
+            for threads in [1, 4]:
+                fp = open_input(bgzf_filename, threads)
+                try:
+                    self.assertRaises(IOError, fp.read)
+                finally:
+                    fp.close()
+
+
+class TestChromosomes(unittest.TestCase):
+    """Make sure chromosomes sort in natural order and aliases match"""
+
+    def setUp(self):
+
+        self.chromosomes = feature_finder.chromosomes
+
+    def tearDown(self):
+
+        set_chromosomes(self.chromosomes)
+
+    def test_natural_order(self):
+
+        names = ['chr10', 'chrM', 'chr2', 'chrUn_gl000220', 'chrY', 'chr1',
+                 'chr1_gl000191_random', 'chrX', 'chr22']
+        self.assertEquals(sorted(names, key=natural_chrom_key),
+                          ['chr1', 'chr2', 'chr10', 'chr22', 'chrX', 'chrY',
+                           'chrM', 'chr1_gl000191_random', 'chrUn_gl000220'])
+
+        dictionary = ChromosomeDictionary()
+        ids = [dictionary.chrom_id(name) for name in names]
+        self.assertEquals(ids, range(len(names)))
+        self.assertEquals(sorted(names, key=dictionary.rank),
+                          sorted(names, key=natural_chrom_key))
+
+        intervals = [Interval(name, 5, 10, name) for name in names]
+        sort_intervals(intervals)
+        self.assertEquals([i.chrom for i in intervals],
+                          sorted(names, key=natural_chrom_key))
+        self.assertTrue(before(Interval('chr2', 100, 200, 'a'),
+                               Interval('chr10', 0, 10, 'b')))
+        self.assertTrue(after(Interval('chr10', 0, 10, 'b'),
+                              Interval('chr2', 100, 200, 'a')))
+
+    def test_many_contigs(self):
+
+        rand = random.Random(16)
+        names = ['chr{}_KI{:06d}v1_alt'.format(rand.randint(1, 22), i)
+                 for i in range(4000)]
+        names += ['chr{}'.format(i) for i in range(1, 23)]
+        rand.shuffle(names)
+        expected = sorted(set(names), key=natural_chrom_key)
+
+        started = time.time()
+        dictionary = ChromosomeDictionary()
+        for name in names:
+            dictionary.chrom_id(name)
+        self.assertEquals(sorted(names, key=dictionary.rank), expected)
+
+        # Reading a rank after every new name ranks one name at a time
+        dictionary = ChromosomeDictionary()
+        for name in names:
+            dictionary.rank(name)
+        self.assertEquals(sorted(names, key=dictionary.rank), expected)
+        self.assertTrue(time.time() - started < 10)
+
+    def test_threads(self):
+
+        dictionary = ChromosomeDictionary()
+        names = ['contig{}'.format(i) for i in range(2000)]
+        ids = {}
+
+        def intern(offset):
+            ids[offset] = [dictionary.chrom_id(names[(i + offset) % 2000])
+                           for i in range(2000)]
+
+        threads = [threading.Thread(target=intern, args=(offset,))
+                   for offset in range(0, 2000, 500)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(sorted(dictionary.names), sorted(names))
+        for offset, thread_ids in ids.iteritems():
+            self.assertEquals([dictionary.names[i] for i in thread_ids],
+                              [names[(i + offset) % 2000]
+                               for i in range(2000)])
+        self.assertEquals(sorted(dictionary.ranks), range(2000))
+
+    def test_aliases(self):
+
+        dictionary = ChromosomeDictionary(aliases={'chr23': 'chrX'})
+        for alias, name in [('1', 'chr1'), ('chr1', 'chr1'), ('MT', 'chrM'),
+                            ('M', 'chrM'), ('chrMT', 'chrM'), ('X', 'chrX'),
+                            ('chr23', 'chrX'), ('GL000220.1', 'GL000220.1')]:
+            self.assertEquals(dictionary.canonical(alias), name)
+            self.assertEquals(dictionary.chrom_id(alias),
+                              dictionary.chrom_id(name))
+
+        # Regions and genes named differently still meet
+        genes = create_gene_list(StringIO.StringIO(
+            '#chrom\tstrand\ttxStart\ttxEnd\texonCount\texonStarts\t'
+            'exonEnds\tgeneSymbol\trefseq\n'
+            'chr1\t+\t10\t50\t1\t10,\t50,\tG1,\tNM_1,\n'
+            'chrM\t+\t10\t50\t1\t10,\t50,\tG2,\tNM_2,\n'))
+        regions = create_region_list(StringIO.StringIO(
+            '#Chromosome\tStartPosition\tEndPosition\tRegionName\n'
+            '1\t20\t30\tr1\nMT\t20\t30\tr2\n'))
+        found = find_features(regions, genes)
+        self.assertEquals([[f.name for f in found[r]] for r in regions],
+                          [['G1'], ['G2']])
+        self.assertEquals(regions[0].Chromosome, '1')
+        self.assertEquals(regions[0].chrom, 'chr1')
+        self.assertEquals(FeatureIndex(genes).overlapping('1', 0, 20),
+                          genes[:1])
+
+        table = create_region_table(StringIO.StringIO(
+            '#Chromosome\tStartPosition\tEndPosition\tRegionName\n'
+            '1\t20\t30\tr1\nchr1\t10\t30\tr2\n'))
+        self.assertEquals(table.chrom_names, ['chr1'])
+        self.assertEquals([r.name for r in table], ['r2', 'r1'])
+
+    def test_karyotype(self):
+
+        set_chromosomes(ChromosomeDictionary(karyotype=['chrM', 'chrX', '1']))
+        intervals = [Interval(name, 0, 1, name)
+                     for name in ['chr2', 'chr1', 'chrX', 'chrM', 'chr10']]
+        sort_intervals(intervals)
+        self.assertEquals([i.chrom for i in intervals],
+                          ['chrM', 'chrX', 'chr1', 'chr2', 'chr10'])
+        self.assertEquals([i.chrom for i in external_sort(intervals[::-1],
+                                                          run_size=2)],
+                          ['chrM', 'chrX', 'chr1', 'chr2', 'chr10'])
+
+
+class TestBatchPairs(unittest.TestCase):
+    """Make sure the batch pair functions agree with the pairwise ones, with
+    and without NumPy
+
+    """
+
+    def setUp(self):
+
+        self.numpy = feature_finder.numpy
+
+        rand = random.Random(17)
+        genes = []
+        for i in range(300):
+            left = rand.randint(0, 5000)
+            genes.append(Feature('chr1', left, left + rand.randint(1, 800),
+                                 'g{}'.format(i)))
+        regions = []
+        for i in range(100):
+            left = rand.randint(0, 5000)
+            regions.append(Region('chr1', left, left + rand.randint(1, 300),
+                                  'r{}'.format(i)))
+        # Every region with every gene, so some pairs don't overlap
+        self.found = dict((region, genes) for region in regions)
+
+    def tearDown(self):
+
+        feature_finder.numpy = self.numpy
+
+    def test_against_pairwise(self):
+
+        for numpy in set([self.numpy, None]):
+            feature_finder.numpy = numpy
+
+            columns = pair_coordinates(self.found)
+            pairs = columns[0]
+            self.assertEquals(len(pairs), 30000)
+            lengths = overlap_lengths(*columns[1:])
+            distances = signed_distances(*columns[1:])
+            flags = containment(*columns[1:])
+
+            for i, (region, feature) in enumerate(pairs):
+                self.assertEquals(lengths[i] > 0, overlaps(feature, region))
+                if lengths[i] > 0:
+                    self.assertEquals(lengths[i] + 1,
+                                      get_overlap(region, feature))
+                self.assertEquals(abs(distances[i]),
+                                  get_distance(feature, region))
+                self.assertEquals(distances[i] < 0,
+                                  feature.right < region.left)
+
+                expected = 0
+                if region.left <= feature.left <= feature.right <= region.right:
+                    expected |= FEATURE_IN_REGION
+                if feature.left <= region.left <= region.right <= feature.right:
+                    expected |= REGION_IN_FEATURE
+                self.assertEquals(flags[i], expected)
+
+    def test_empty(self):
+
+        for numpy in set([self.numpy, None]):
+            feature_finder.numpy = numpy
+            columns = pair_coordinates({})
+            self.assertEquals(columns[0], [])
+            self.assertEquals(len(overlap_lengths(*columns[1:])), 0)
+            self.assertEquals(len(containment(*columns[1:])), 0)
+
+
+class TestResultWriter(unittest.TestCase):
+    """Make sure results are written with the asked for columns, split at
+    the row limit and compressed on request
+
+    """
+
+    region_file = \
+"""#Chromosome	StartPosition	EndPosition	RegionName	Score
+chr1	0	10	r1	1.5
+chr2	100	200	r2	-0.25
+chr2	45	75	r3	3
+"""
+
+    def setUp(self):
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.genes = create_gene_list(
+            StringIO.StringIO(TestGeneCache.gene_file))
+        self.regions = create_region_list(
+            StringIO.StringIO(self.region_file), extras=['Score'])
+        self.found = find_features(self.regions, self.genes)
+
+    def tearDown(self):
+
+        shutil.rmtree(self.tmp_dir)
+
+    def _read(self, filename):
+
+        fp = open_input(filename)
+        try:
+            return [line.rstrip('\n').split('\t') for line in fp]
+        finally:
+            fp.close()
+
+    def test_columns(self):
+
+        filename = os.path.join(self.tmp_dir, 'out.tsv')
+        columns = ['RegionName', 'Score', 'geneSymbol', 'featureStart',
+                   'overlap', 'distance']
+        with ResultWriter(filename, columns) as writer:
+            writer.write_all(self.found)
+
+        self.assertEquals(writer.filenames, [filename])
+        self.assertEquals(writer.rows, 4)
+        self.assertEquals(self._read(filename), [
+            columns,
+            ['r1', '1.5', 'n/a', '5', '4', '0'],
+            ['r1', '1.5', 'G1', '8', '2', '0'],
+            ['r3', '3', 'G3', '40', '30', '0'],
+            ['r2', '-0.25', '', '', '', '']])
+
+        table = create_region_table(StringIO.StringIO(self.region_file),
+                                    extras=['Score'])
+        self.assertEquals([r.extras for r in table],
+                          [{'Score': '1.5'}, {'Score': '3'},
+                           {'Score': '-0.25'}])
+
+    def test_split_and_compress(self):
+
+        filename = os.path.join(self.tmp_dir, 'out.tsv.gz')
+        with ResultWriter(filename, ['RegionName', 'geneSymbol'],
+                          max_rows=3, buffer_rows=1) as writer:
+            writer.write_all(self.found, self.regions)
+
+        self.assertEquals(writer.filenames,
+                          [filename, os.path.join(self.tmp_dir, 'out_2.tsv.gz')])
+        self.assertEquals(sorted(os.listdir(self.tmp_dir)),
+                          ['out.tsv.gz', 'out_2.tsv.gz'])
+        with open(filename, 'rb') as fp:
+            self.assertEquals(fp.read(2), '\x1f\x8b')
+        self.assertEquals(self._read(filename), [
+            ['RegionName', 'geneSymbol'], ['r1', 'n/a'], ['r1', 'G1']])
+        self.assertEquals(self._read(writer.filenames[1]), [
+            ['RegionName', 'geneSymbol'], ['r3', 'G3'], ['r2', '']])
+
+        # Files too small for a header and a row are refused
+        for max_rows in [0, 1, -5]:
+            self.assertRaises(ValueError, ResultWriter, filename,
+                              max_rows=max_rows)
+        ResultWriter(filename, max_rows=2).close()
+
+    def test_csv_and_streaming(self):
+
+        genes = [Gene('chr1', '+', '0', '100', '1', '0,', '100,',
+                      'GENE, "ONE",', 'NM_1,')]
+        regions = [Region('chr1', '10', '20', 'r,1')]
+        filename = os.path.join(self.tmp_dir, 'out.csv')
+        with ResultWriter(filename, ['RegionName', 'geneSymbol', 'overlap'],
+                          dialect='csv') as writer:
+            writer.write_all(sweep_features(regions, genes))
+
+        with open(filename) as fp:
+            self.assertEquals(fp.read(),
+                              'RegionName,geneSymbol,overlap\n'
+                              '"r,1","GENE, ""ONE""",10\n')
+
+    def test_error_leaves_nothing(self):
+
+        filename = os.path.join(self.tmp_dir, 'out.tsv')
+        try:
+            with ResultWriter(filename) as writer:
+                writer.write(self.regions[0], self.found[self.regions[0]])
+                raise KeyError('stop')
+        except KeyError:
+            pass
+        self.assertEquals(os.listdir(self.tmp_dir), [])
+
+        # Nor are the parts finished before the error
+        try:
+            with ResultWriter(filename, max_rows=2) as writer:
+                writer.write_all(self.found, self.regions)
+                self.assertEquals(len(writer.filenames), 3)
+                raise KeyError('stop')
+        except KeyError:
+            pass
+        self.assertEquals(os.listdir(self.tmp_dir), [])
+        self.assertEquals(writer.filenames, [])
+
+
+class TestMutableIndex(unittest.TestCase):
+    """Make sure the mutable index answers like a rebuilt one through
+    inserts, deletes and batches, and that queries see whole updates
+
+    """
+
+    def setUp(self):
+
+        self.rand = random.Random(19)
+
+    def _feature(self, i):
+
+        left = self.rand.randint(0, 3000)
+        return Feature(self.rand.choice(['chr1', 'chr2', 'chrX']), left,
+                       left + self.rand.randint(1, 200), 'f{}'.format(i))
+
+    def _check(self, index, features):
+
+        true_index = FeatureIndex(features)
+        self.assertEquals(len(index), len(features))
+        self.assertEquals(index.chroms(), true_index.chroms())
+        for chrom in ['chr1', 'chr2', 'chrX']:
+            self.assertEquals(index.features(chrom),
+                              true_index.features(chrom))
+        for i in range(50):
+            chrom = self.rand.choice(['chr1', 'chr2', 'chrX'])
+            left = self.rand.randint(0, 3200)
+            right = left + self.rand.randint(1, 300)
+            self.assertEquals(index.overlapping(chrom, left, right),
+                              true_index.overlapping(chrom, left, right))
+            self.assertEquals(
+                [d for d, f in index.nearest(chrom, left, right, k=3)],
+                [d for d, f in true_index.nearest(chrom, left, right, k=3)])
+
+    def test_updates(self):
+
+        features = [self._feature(i) for i in range(500)]
+        index = MutableFeatureIndex(features)
+        self._check(index, features)
+
+        for step in range(300):
+            if features and self.rand.random() < 0.4:
+                feature = features.pop(self.rand.randrange(len(features)))
+                index.delete(feature)
+            else:
+                feature = self._feature(1000 + step)
+                features.append(feature)
+                index.insert(feature)
+            if step % 50 == 0:
+                self._check(index, features)
+
+        delta = [self._feature(2000 + i) for i in range(100)]
+        removed = features[:100]
+        index.update(add=delta, remove=removed)
+        features = features[100:] + delta
+        self._check(index, features)
+
+        regions = [Region(f.chrom, f.left, f.right, 'r') for f in delta]
+        self.assertEquals(find_features(regions, index),
+                          find_features(regions, features))
+        self.assertEquals(find_features_parallel(regions, index, workers=1),
+                          find_features(regions, features))
+
+    def test_snapshot_and_failed_update(self):
+
+        features = [self._feature(i) for i in range(100)]
+        index = MutableFeatureIndex(features)
+        snapshot = index.snapshot()
+
+        extra = self._feature(100)
+        index.insert(extra)
+        index.delete(features[0])
+        self._check(snapshot, features)
+        self._check(index, features[1:] + [extra])
+
+        # A batch with a feature that isn't there changes nothing
+        self.assertRaises(ValueError, index.update,
+                          [self._feature(101)], [features[1], features[0]])
+        self._check(index, features[1:] + [extra])
+
+        # Features with the same coordinates are told apart
+        twin = Feature(extra.chrom, extra.left, extra.right, 'twin')
+        index.insert(twin)
+        index.delete(extra)
+        self.assertTrue(twin in index.features(twin.chrom))
+        self.assertFalse(extra in index.features(twin.chrom))
+
+    def test_consistent_reads(self):
+
+        features = [Feature('chr1', i * 10, i * 10 + 5, str(i))
+                    for i in range(200)]
+        index = MutableFeatureIndex(features)
+        seen = []
+        done = threading.Event()
+
+        def read():
+            while not done.is_set():
+                seen.append(len(index.overlapping('chr1', 0, 10000)))
+
+        reader = threading.Thread(target=read)
+        reader.start()
+        try:
+            # Each update swaps one feature for another, so there are
+            # always 200
+            for i in range(300):
+                old = features.pop(0)
+                new = Feature('chr1', old.left, old.right, old.name + "'")
+                index.update(add=[new], remove=[old])
+                features.append(new)
+        finally:
+            done.set()
+            reader.join()
+
+        self.assertTrue(seen)
+        self.assertEquals(set(seen), set([200]))
+
+
+    def test_nearest_reads_one_version(self):
+
+        races = []
+
+        class RacedIndex(MutableFeatureIndex):
+            """Runs a race in the middle of a query, as a concurrent update
+            might
+
+            """
+
+            def overlapping(self, *args, **kwargs):
+
+                found = MutableFeatureIndex.overlapping(self, *args,
+                                                        **kwargs)
+                if races:
+                    races.pop()()
+                return found
+
+            def _layout(self, *args, **kwargs):
+
+                if races:
+                    races.pop()()
+                return MutableFeatureIndex._layout(self, *args, **kwargs)
+
+        overlapped = Feature('chr1', 100, 200, 'overlapped')
+        far = Feature('chr1', 500, 600, 'far')
+        close = Feature('chr1', 205, 210, 'close')
+        index = RacedIndex([overlapped, far])
+
+        races.append(lambda: index.insert(close))
+        self.assertEquals(index.nearest('chr1', 150, 160, k=2),
+                          [(0, overlapped), (340, far)])
+        self.assertEquals(index.nearest('chr1', 150, 160, k=2),
+                          [(0, overlapped), (45, close)])
+
+        races.append(lambda: index.delete(close))
+        self.assertEquals(index.within('chr1', 150, 160, 50),
+                          [overlapped, close])
+        self.assertEquals(index.within('chr1', 150, 160, 50), [overlapped])
+
+class TestFlanks(unittest.TestCase):
+    """Make sure flank windows follow the strand and match expanded copies
+    of the genes
+
+    """
+
+    def setUp(self):
+
+        rand = random.Random(20)
+        self.genes = []
+        for i in range(400):
+            left = rand.randint(0, 20000)
+            right = left + rand.randint(10, 3000)
+            strand = rand.choice('+-')
+            self.genes.append(Gene(rand.choice(['chr1', 'chr2']), strand,
+                                   str(left), str(right), '1',
+                                   '{},'.format(left), '{},'.format(right),
+                                   'G{},'.format(i), 'NM_{},'.format(i)))
+        self.regions = []
+        for i in range(200):
+            left = rand.randint(0, 22000)
+            self.regions.append(Region(rand.choice(['chr1', 'chr2']), left,
+                                       left + rand.randint(1, 500),
+                                       'r{}'.format(i)))
+
+    def test_bounds(self):
+
+        plus = Gene('chr1', '+', '1000', '5000', '1', '1000,', '5000,',
+                    'P,', 'NM_1,')
+        minus = Gene('chr1', '-', '1000', '5000', '1', '1000,', '5000,',
+                     'M,', 'NM_2,')
+        self.assertEquals(transcription_start(plus), 1000)
+        self.assertEquals(transcription_start(minus), 5000)
+        self.assertEquals(flank_bounds(plus, 2000, 100), (0, 1100))
+        self.assertEquals(flank_bounds(minus, 2000, 100), (4900, 7000))
+
+        flanks = FlankIndex([plus, minus])
+        found = flanks.overlapping('chr1', 6000, 6001, 2000, 100)
+        self.assertEquals([(f.name, f.left, f.right, f.strand, f.tss)
+                           for f in found], [('M', 4900, 7000, '-', 5000)])
+        self.assertTrue(flanks.window(2000, 100) is flanks.window(2000, 100))
+
+    def test_against_expanded_genes(self):
+
+        flanks = FlankIndex(FeatureIndex(self.genes))
+        for upstream, downstream in [(2000, 500), (500, 2000), (1000, 0),
+                                     (0, 0)]:
+            expanded = []
+            for gene in self.genes:
+                left, right = flank_bounds(gene, upstream, downstream)
+                expanded.append(Feature(gene.chrom, left, right, gene))
+
+            true_found = find_features(self.regions, expanded)
+            found = find_promoters(self.regions, flanks, upstream, downstream)
+            for region in self.regions:
+                # Windows with the same ends can come in either order
+                self.assertEquals(
+                    sorted((f.left, f.right, f.name) for f in found[region]),
+                    sorted((f.left, f.right, f.name.name)
+                           for f in true_found[region]))
+
+            window = flanks.window(upstream, downstream)
+            self.assertEquals(len(window), len(self.genes))
+            self.assertEquals(
+                [(f.left, f.right) for f in window.features('chr1')],
+                sorted((f.left, f.right) for f in expanded
+                       if f.chrom == 'chr1'))
+
+
+class TestLazyGenes(unittest.TestCase):
+    """Make sure lazy genes decode to the same fields as eager ones"""
+
+    GENE_FILE = (
+        '#hg19.refGene.refseq\thg19.refGene.chrom\thg19.refGene.strand\t'
+        'hg19.refGene.txStart\thg19.refGene.txEnd\thg19.refGene.exonCount\t'
+        'hg19.refGene.exonStarts\thg19.refGene.exonEnds\t'
+        'hg19.kgXref.geneSymbol\n'
+        'NM_2,\tchr2\t-\t50\t90\t2\t50,70,\t60,90,\tG2,\n'
+        'NM_1,\tchr1\t+\t10\t40\t1\t10,\t40,\tG1,\n'
+        '\n'
+        'n/a\tchr1\t-\t5\t30\t3\t5,12,20,\t8,15,30,\tG3,\n')
+
+    FIELDS = ('chrom', 'left', 'right', 'name', 'strand', 'positive_strand',
+              'txStart', 'txEnd', 'exonCount', 'exonStarts', 'exonEnds',
+              'geneSymbol', 'refseq', 'exons')
+
+    def test_fields(self):
+
+        eager = create_gene_list(StringIO.StringIO(self.GENE_FILE))
+        stats = ParseStats()
+        lazy = create_gene_list(StringIO.StringIO(self.GENE_FILE),
+                                stats=stats, lazy=True)
+
+        self.assertEquals(stats.rows, 3)
+        self.assertTrue(all(isinstance(gene, LazyGene) for gene in lazy))
+        self.assertEquals([gene.name for gene in lazy], ['G3', 'G1', 'G2'])
+        for e, l in zip(eager, lazy):
+            for field in self.FIELDS:
+                self.assertEquals(getattr(l, field), getattr(e, field))
+
+        regions = [Region('chr1', 0, 11, 'r1'), Region('chr1', 35, 45, 'r2'),
+                   Region('chr2', 60, 61, 'r3')]
+        self.assertEquals(
+            dict((region.name, [gene.name for gene in features])
+                 for region, features in find_features(regions,
+                                                       lazy).items()),
+            dict((region.name, [gene.name for gene in features])
+                 for region, features in find_features(regions,
+                                                       eager).items()))
+
+    def test_caching(self):
+
+        cached = list(iter_genes(StringIO.StringIO(self.GENE_FILE),
+                                 lazy=True))[0]
+        self.assertNotIn('exons', vars(cached))
+        exons = cached.exons
+        self.assertIn('exons', vars(cached))
+        self.assertIs(cached.exons, exons)
+
+        uncached = list(iter_genes(StringIO.StringIO(self.GENE_FILE),
+                                   lazy=True, cache_fields=False))[0]
+        exons = uncached.exons
+        self.assertEquals(exons, [(50, 60), (70, 90)])
+        self.assertNotIn('exons', vars(uncached))
+        self.assertIsNot(uncached.exons, exons)
+
+
+class TestCoalesce(unittest.TestCase):
+    """Make sure coalesced searches give every region the same features"""
+
+    def setUp(self):
+
+        rand = random.Random(22)
+        self.genes = []
+        for i in range(300):
+            left = rand.randint(0, 20000)
+            right = left + rand.randint(1, 2000)
+            self.genes.append(Feature(rand.choice(['chr1', 'chr2']), left,
+                                      right, 'f{}'.format(i)))
+        # Tiling probes, some repeated and some touching
+        self.regions = []
+        for i in range(500):
+            left = rand.randint(0, 22000) // 30 * 30
+            self.regions.append(Region(rand.choice(['chr1', 'chr2']), left,
+                                       left + rand.choice([0, 30, 60]),
+                                       'r{}'.format(i)))
+        self.regions.append(Region('chr3', 5, 10, 'alone'))
+
+    def test_clusters(self):
+
+        regions = [Region('chr1', 60, 120, 'b'), Region('chr1', 0, 60, 'a'),
+                   Region('chr1', 0, 60, 'a2'), Region('chr1', 125, 185, 'c'),
+                   Region('chr2', 130, 140, 'd')]
+
+        clusters = coalesce_regions(regions)
+        self.assertEquals([(c.chrom, c.left, c.right, c.name,
+                            [r.name for r in c.regions]) for c in clusters],
+                          [('chr1', 0, 120, 'a', ['a', 'a2', 'b']),
+                           ('chr1', 125, 185, 'c', ['c']),
+                           ('chr2', 130, 140, 'd', ['d'])])
+
+        self.assertEquals([len(c.regions)
+                           for c in coalesce_regions(regions, 5)], [4, 1])
+
+    def test_find_features(self):
+
+        expected = find_features(self.regions, self.genes)
+        for gap in [0, 10, 1000]:
+            instrumentation = Instrumentation()
+            self.assertEquals(find_features(self.regions, self.genes,
+                                            instrumentation, coalesce=gap),
+                              expected)
+            counters = instrumentation.counters
+            self.assertEquals(counters['regions'], len(self.regions))
+            self.assertEquals(counters['hits'],
+                              sum(len(f) for f in expected.itervalues()))
+            self.assertEquals(counters['clusters'],
+                              len(coalesce_regions(self.regions, gap)))
+            self.assertTrue(counters['clusters'] < len(self.regions))
+
+
+class TestSortPaths(unittest.TestCase):
+    """Make sure sorted input is left alone, sorted runs are merged, and
+    every path gives the order (stable) sort would
+
+    """
+
+    GENE_HEADER = ('#chrom\tstrand\ttxStart\ttxEnd\texonCount\texonStarts\t'
+                   'exonEnds\tgeneSymbol\trefseq\n')
+
+    def setUp(self):
+
+        rand = random.Random(23)
+        self.intervals = []
+        for i in range(2000):
+            left = rand.randint(0, 500)
+            self.intervals.append(Feature(
+                rand.choice(['chr1', 'chr2', 'chr10', 'chrX']), left,
+                left + rand.randint(0, 3), 'f{}'.format(i)))
+
+    def _check(self, intervals, how):
+
+        expected = sorted(intervals, key=interval_key)
+        self.assertEquals(sort_intervals(intervals), how)
+        self.assertEquals([id(i) for i in intervals],
+                          [id(i) for i in expected])
+
+    def test_paths(self):
+
+        self._check(list(self.intervals), SORT_FULL)
+        sort_intervals(self.intervals)
+        self._check(list(self.intervals), SORT_PRESORTED)
+        self._check([], SORT_PRESORTED)
+
+        # Per-chromosome runs in name order, and overlapping runs with equal
+        # keys across them
+        by_name = sorted(self.intervals, key=lambda i: i.chrom)
+        self._check(by_name, SORT_MERGED)
+        self._check(self.intervals[1000:] + self.intervals[:1000] +
+                    self.intervals[990:1010], SORT_MERGED)
+
+        # Finely interleaved runs are given up on
+        self._check(self.intervals[::2] + self.intervals[1::2], SORT_FULL)
+
+    def test_loaders(self):
+
+        lines = ['chr{}\t+\t{}\t{}\t1\t{},\t{},\tG{},\tNM_{},\n'.format(
+            chrom, left, left + 10, left, left + 10, left, left)
+            for chrom in (1, 2, 10) for left in range(0, 100, 10)]
+        files = [lines[20:], lines[:10], lines[10:20]]
+
+        for create in create_gene_list, create_gene_table:
+            stats = ParseStats()
+            instrumentation = Instrumentation()
+            genes = create([StringIO.StringIO(self.GENE_HEADER + ''.join(f))
+                            for f in files], stats=stats,
+                           instrumentation=instrumentation)
+            self.assertEquals([(g.chrom, g.left) for g in genes],
+                              [('chr' + str(chrom), left)
+                               for chrom in (1, 2, 10)
+                               for left in range(0, 100, 10)])
+            self.assertEquals(stats.rows, 30)
+            self.assertEquals(stats.sort, SORT_MERGED)
+            self.assertEquals(instrumentation.counters['sort merged'], 1)
+
+            stats = ParseStats()
+            create(StringIO.StringIO(self.GENE_HEADER + ''.join(lines)),
+                   stats=stats)
+            self.assertEquals(stats.sort, SORT_PRESORTED)
+
+
+class TestDensity(unittest.TestCase):
+    """Make sure density queries and bins match counting by hand"""
+
+    def setUp(self):
+
+        rand = random.Random(24)
+        self.features = []
+        for i in range(300):
+            left = rand.randint(0, 5000)
+            self.features.append(Feature(rand.choice(['chr1', 'chr2']), left,
+                                         left + rand.randint(0, 300),
+                                         'f{}'.format(i)))
+        self.density = FeatureDensity(self.features)
+
+    def _expected(self, chrom, left, right):
+
+        found = [f for f in self.features
+                 if f.chrom == chrom and overlaps(f, Region(chrom, left,
+                                                            right, 'r'))]
+        bases = sum(max(0, min(f.right, right) - max(f.left, left))
+                    for f in found)
+        covered = set()
+        for f in found:
+            covered.update(xrange(max(f.left, left), min(f.right, right)))
+        return Density(len(found), bases, len(covered))
+
+    def test_query(self):
+
+        rand = random.Random(1)
+        for i in range(300):
+            left = rand.randint(-10, 5500)
+            right = left + rand.choice([0, 1, 50, 1000])
+            chrom = rand.choice(['chr1', 'chr2'])
+            self.assertEquals(self.density.query(chrom, left, right),
+                              self._expected(chrom, left, right))
+
+        self.assertEquals(self.density.query('chr3', 0, 100), (0, 0, 0))
+        self.assertEquals(self.density.count('2', 0, 10000),
+                          len([f for f in self.features
+                               if f.chrom == 'chr2' and f.right > f.left]))
+
+        regions = [Region('chr1', 100, 600, 'a'), Region('chr2', 7, 8, 'b')]
+        self.assertEquals(self.density.regions(regions),
+                          dict((r, self._expected(r.chrom, r.left, r.right))
+                               for r in regions))
+
+    def test_bins(self):
+
+        for bin_size in [97, 1000, 10000]:
+            bins = list(FeatureDensity(FeatureIndex(self.features)).bins(
+                bin_size, {'chr2': 6000}))
+            self.assertEquals([(c, l, r, d) for c, l, r, d in bins],
+                              [(c, l, r, self._expected(c, l, r))
+                               for c, l, r, d in bins])
+            self.assertEquals(bins[0][:2], ('chr1', 0))
+            last = [b for b in bins if b[0] == 'chr2'][-1]
+            self.assertEquals(last[2], 6000)
+
+        self.assertRaises(ValueError, list, self.density.bins(0))
+
+class TestLoadInputs(unittest.TestCase):
+    """Make sure loading both inputs at once gives what loading them one
+    after the other does, and that errors in either come back
+
+    """
+
+    def setUp(self):
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.gene_filename = os.path.join(self.tmp_dir, 'genes.gz')
+        gene_fp = gzip.open(self.gene_filename, 'wb')
+        gene_fp.write(TestGeneCache.gene_file)
+        gene_fp.close()
+
+        rand = random.Random(25)
+        self.region_filename = os.path.join(self.tmp_dir, 'regions')
+        with open(self.region_filename, 'w') as fp:
+            fp.write('#Chromosome\tStartPosition\tEndPosition\tRegionName\t'
+                     'Score\n')
+            for i in range(2000):
+                left = rand.randint(0, 300)
+                fp.write('chr{}\t{}\t{}\tr{}\t{}\n'.format(
+                    rand.randint(1, 3), left, left + rand.randint(1, 50), i,
+                    rand.randint(0, 9)))
+
+        # Small chunks, so readers fill their queues and wait
+        self.read_size = feature_finder._READ_SIZE
+        feature_finder._READ_SIZE = 1000
+
+    def tearDown(self):
+
+        feature_finder._READ_SIZE = self.read_size
+        shutil.rmtree(self.tmp_dir)
+
+    def _rows(self, intervals):
+
+        return [(i.chrom, i.left, i.right, i.name) for i in intervals]
+
+    def test_lists_and_tables(self):
+
+        genes = create_gene_list(self.gene_filename)
+        regions = create_region_list(self.region_filename, extras=['Score'])
+
+        gene_stats, region_stats = ParseStats(), ParseStats()
+        loaded_genes, loaded_regions = load_inputs(
+            self.gene_filename, self.region_filename, extras=['Score'],
+            gene_stats=gene_stats, region_stats=region_stats,
+            queue_chunks=1)
+        self.assertEquals(self._rows(loaded_genes), self._rows(genes))
+        self.assertEquals(self._rows(loaded_regions), self._rows(regions))
+        self.assertEquals([r.extras for r in loaded_regions],
+                          [r.extras for r in regions])
+        self.assertEquals((gene_stats.rows, region_stats.rows),
+                          (len(genes), len(regions)))
+
+        table_genes, table_regions = load_inputs(
+            [self.gene_filename],
+            [StringIO.StringIO(open(self.region_filename).read())],
+            tables=True)
+        self.assertTrue(isinstance(table_genes, GeneTable))
+        self.assertEquals(self._rows(table_genes), self._rows(genes))
+        self.assertEquals(self._rows(table_regions), self._rows(regions))
+
+    def test_errors(self):
+
+        threads = threading.active_count()
+
+        self.assertRaises(IOError, load_inputs, self.gene_filename,
+                          os.path.join(self.tmp_dir, 'missing'))
+
+        # The region file has no gene header, so its parser gives up with
+        # its reader still waiting on a full queue
+        self.assertRaises(SystemExit, load_inputs, self.region_filename,
+                          self.region_filename, queue_chunks=1)
+
+        for i in range(50):
+            if threading.active_count() == threads:
+                break
+            threading.Event().wait(0.1)
+        self.assertEquals(threading.active_count(), threads)
+
+
+
+    def test_new_chromosomes(self):
+
+        # Both parsers intern contigs nothing has seen yet, at the same time
+        with gzip.open(self.gene_filename, 'wb') as fp:
+            fp.write(TestGeneCache.gene_file.splitlines(True)[0])
+            for i in range(1000):
+                fp.write('contig{0}\t+\t10\t20\t1\t10,\t20,\tG{0},\t'
+                         'NM_{0},\n'.format(i))
+        region_filename = self.region_filename + '.gz'
+        with gzip.open(region_filename, 'wb') as fp:
+            fp.write('#Chromosome\tStartPosition\tEndPosition\tRegionName\n')
+            for i in range(500, 1500):
+                fp.write('contig{0}\t15\t30\tr{0}\n'.format(i))
+
+        saved = feature_finder.chromosomes
+        set_chromosomes(ChromosomeDictionary())
+        try:
+            genes, regions = load_inputs(self.gene_filename, region_filename,
+                                         queue_chunks=1)
+            names = feature_finder.chromosomes.names
+            self.assertEquals(sorted(names),
+                              sorted('contig{}'.format(i)
+                                     for i in range(1500)))
+            for interval in genes + regions:
+                self.assertEquals(names[interval.chrom_id], interval.chrom)
+            found = find_features(regions, genes)
+            self.assertEquals(sum(len(f) for f in found.itervalues()), 500)
+        finally:
+            set_chromosomes(saved)
+
+
 if __name__ == '__main__':
     unittest.main()
 